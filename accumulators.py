@@ -0,0 +1,119 @@
+import math
+
+import numpy as np
+
+from titers import average_standard_errors, confidence_interval, log_titers_and_errors
+
+
+class RunningStats:
+    """
+    Count, mean and sum of squared deviations (M2) of a set of values that grows and shrinks: batches of values are
+    merged in and taken out with Chan's update of Welford's algorithm, so the values themselves are not needed.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) > 0:
+            mean = float(np.mean(values))
+            self.merge(len(values), mean, float(np.sum((values - mean) ** 2)))
+
+    def merge(self, count: int, mean: float, m2: float):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+    def remove(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        total = self.count - len(values)
+        if total <= 0:
+            self.clear()
+            return
+        mean = float(np.mean(values))
+        remaining_mean = (self.count * self.mean - len(values) * mean) / total
+        delta = mean - remaining_mean
+        m2 = self.m2 - float(np.sum((values - mean) ** 2)) - delta * delta * total * len(values) / self.count
+        # rounding must not make the spread of what is left negative
+        self.count, self.mean, self.m2 = total, remaining_mean, max(m2, 0.)
+
+    def clear(self):
+        self.count, self.mean, self.m2 = 0, 0., 0.
+
+    def deviation(self) -> float:
+        # population standard deviation, as np.std()
+        return math.sqrt(self.m2 / self.count) if self.count > 0 else math.nan
+
+
+class TiterSums:
+    """
+    Count, sum and sum of squares of titers, with the count and sum of squares of their standard errors, and the same
+    sums of the log10 titers for the confidence interval, so averages follow titers being added and removed in O(1).
+    Empty sums have no average.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.total = 0.
+        self.squares = 0.
+        self.error_count = 0
+        self.error_squares = 0.
+        self.log_total = 0.
+        self.log_squares = 0.
+        self.log_error_squares = 0.
+
+    def add(self, titer: float, error: float | None = None):
+        log_titer, log_error = log_titers_and_errors(titer, math.nan if error is None else error)
+        self.count += 1
+        self.total += titer
+        self.squares += titer * titer
+        self.log_total += log_titer
+        self.log_squares += log_titer * log_titer
+        if error is not None:
+            self.error_count += 1
+            self.error_squares += error * error
+            self.log_error_squares += log_error * log_error
+
+    def remove(self, titer: float, error: float | None = None):
+        self.count -= 1
+        if self.count == 0:
+            # start over exactly instead of keeping the rounding residue
+            self.clear()
+            return
+        log_titer, log_error = log_titers_and_errors(titer, math.nan if error is None else error)
+        self.total -= titer
+        self.squares = max(self.squares - titer * titer, 0.)
+        self.log_total -= log_titer
+        self.log_squares = max(self.log_squares - log_titer * log_titer, 0.)
+        if error is not None:
+            self.error_count -= 1
+            self.error_squares = max(self.error_squares - error * error, 0.) if self.error_count > 0 else 0.
+            self.log_error_squares = max(self.log_error_squares - log_error * log_error, 0.) \
+                if self.error_count > 0 else 0.
+
+    def mean(self) -> float | None:
+        return self.total / self.count if self.count > 0 else None
+
+    def standard_error(self) -> float | None:
+        # standard error of the mean titer, see titers.average_standard_errors()
+        error = float(average_standard_errors(self.count, self.total, self.squares, self.error_count,
+                                              self.error_squares))
+        return None if math.isnan(error) else error
+
+    def confidence_interval(self) -> tuple | None:
+        # (low, high) around the geometric mean, see titers.confidence_interval(); None without a standard error
+        low, high = confidence_interval(self.count, self.log_total, self.log_squares, self.error_count,
+                                        self.log_error_squares)
+        return None if math.isnan(low) else (float(low), float(high))
@@ -0,0 +1,465 @@
+import argparse
+import csv
+import json
+import sys
+import time
+import tracemalloc
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+from fit_budget import FitBudget, fit_with_budget, SAMPLE_SECONDS, INTERPOLATED
+from immuno_calculator import letters, detect_outlier
+from plate_reader import load_plate_blocks
+from qc import screen, BELOW_CUTOFF
+from titers import orient, curve_r2, curve_titers, cutoffs_from_stats, average_standard_errors, confidence_interval, \
+    log_titers_and_errors, cutoff_multiplier_accuracies
+from accumulators import RunningStats
+from diagnostics import diagnose, lacks_fit
+from xlsx_export import write_workbook, sample_columns, SUMMARY_SHEET_COLUMNS
+from summary import titers_summary_row, SWEEP_COLUMNS
+
+
+# Chunked batch mode for long re-analyses. Instead of keeping every Sample, fit and group in memory until the end,
+# plates stream through load -> QC -> fit one at a time and the per-sample results are appended to a record file in
+# the output folder. Group aggregates are updated plate by plate: the negative control statistics while fitting, the
+# titer count and sums while the titers are read back from the memory-mapped records chunk by chunk. Peak traced
+# memory is reported with tracemalloc and compared to the configured limit.
+#
+#     batch.json     record dtype, sample count, groups and the run report
+#     results.bin    one record per sample (RESULT_DTYPE), np.memmap compatible
+#     samples.csv    per-sample results, written chunk by chunk
+#     groups.csv     per-group cutoffs and averages, with the average titers of every accuracy on a sweep
+#     results.xlsx   summary and per-group sheets, optional, streamed from the records in a third pass
+
+PLATE = 'plate'
+WORKBOOK = 'workbook'
+
+CHUNK_SIZE = 4096
+POINT_COUNT = len(letters)
+
+RESULT_DTYPE = np.dtype([
+    ('group', np.int64),
+    ('name', 'U64'),
+    ('xdata', np.float64, (POINT_COUNT,)),
+    ('readings', np.float64, (POINT_COUNT,)),
+    ('point_count', np.int64),
+    ('lo', np.float64), ('hi', np.float64),
+    ('popt', np.float64, (3,)),
+    ('pcov', np.float64, (3, 3)),
+    ('r2', np.float64),
+    ('fit_status', 'U12'),
+    ('qc_reason', 'U16'),
+    ('cutoff', np.float64),
+    ('titer', np.float64),
+    ('titer_se', np.float64),
+    ('bad_data', np.bool_),
+])
+
+
+class GroupAggregates:
+    """
+    Per-group negative control statistics merged plate by plate (see accumulators.RunningStats), so the standard
+    deviation does not need the control values themselves.
+    """
+
+    def __init__(self):
+        self.names = list()
+        self.ids = dict()
+        self.controls = list()
+
+    def get_id(self, name: str) -> int:
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.controls.append(RunningStats())
+        return self.ids[name]
+
+    def add_controls(self, group_id: int, values: np.ndarray):
+        self.controls[group_id].add(values)
+
+    def cutoffs(self, accuracy: float) -> np.ndarray:
+        # the same as group_cutoffs() over all control values of the group
+        return np.array([cutoffs_from_stats(stats.count, stats.mean, stats.deviation(), accuracy)[0]
+                         for stats in self.controls], dtype=np.float64)
+
+
+def memory_chunk_size(chunk_size: int, memory_limit: int | None) -> int:
+    # a chunk of records and the temporaries derived from it should stay well within the memory limit, a limit that
+    # does not even hold one record fails before any work is done
+    if memory_limit is None:
+        return chunk_size
+    if memory_limit < 4 * RESULT_DTYPE.itemsize:
+        raise ValueError(f'memory limit of {memory_limit} bytes is below the {4 * RESULT_DTYPE.itemsize} bytes one '
+                         f'record needs')
+    return min(chunk_size, memory_limit // (4 * RESULT_DTYPE.itemsize))
+
+
+def check_memory(memory_limit: int | None, stage: str):
+    # stop as soon as the traced peak goes over the limit instead of reporting it once the run is over
+    if memory_limit is None:
+        return
+    peak = tracemalloc.get_traced_memory()[1]
+    if peak > memory_limit:
+        raise MemoryError(f'{stage}: peak traced memory {peak / 2**20:.1f} MB is over the limit of '
+                          f'{memory_limit / 2**20:.1f} MB')
+
+
+def plate_records(readings: np.ndarray, xdata: np.ndarray, sample_names: list, group_id: int,
+                  budget: FitBudget) -> np.ndarray:
+    # QC and fit one plate, readings are (samples, points)
+    records = np.zeros(len(readings), dtype=RESULT_DTYPE)
+    point_count = readings.shape[1]
+    records['group'] = group_id
+    records['name'] = [str(name)[:64] for name in sample_names]
+    records['xdata'] = records['readings'] = np.nan
+    records['xdata'][:, :point_count] = xdata
+    records['readings'][:, :point_count] = readings
+    records['point_count'] = point_count
+    records['qc_reason'] = [reason or '' for reason in screen(readings, np.ones(readings.shape, dtype=bool))]
+    records['popt'] = records['pcov'] = records['cutoff'] = records['titer'] = records['titer_se'] = np.nan
+
+    for index in np.flatnonzero(records['qc_reason'] == ''):
+        popt, pcov, status, _ = fit_with_budget(xdata, readings[index], budget)
+        records['fit_status'][index] = status
+        if popt is not None:
+            records['popt'][index] = popt
+            records['pcov'][index] = pcov
+
+    # rows with missing wells only are flagged by QC already
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        records['lo'] = np.nanmin(readings, axis=1)
+        records['hi'] = np.nanmax(readings, axis=1)
+    interpolated = records['fit_status'] == INTERPOLATED
+    records['r2'] = curve_r2(readings, np.broadcast_to(xdata, readings.shape), records['lo'], records['hi'],
+                             records['popt'], interpolated)
+    return records
+
+
+def stream_plates(file_paths: list, base_dilution: float, coefficient: float, group_by: str):
+    # yields (group name, plate readings, log dilutions, sample names) one plate at a time
+    for file_path in file_paths:
+        for name, rows, sample_names in load_plate_blocks(file_path):
+            readings = np.array([[row[index] if index < len(row) else np.nan for row in rows]
+                                 for index in range(len(sample_names))], dtype=np.float64).reshape(-1, len(rows))
+            xdata = np.log10(base_dilution * coefficient ** np.arange(len(rows)))
+            group = f'{file_path}:{name}' if group_by == PLATE else str(file_path)
+            yield group, orient(readings), xdata, sample_names
+
+
+def chunk_titers(chunk: np.ndarray, cutoffs: np.ndarray):
+    # titers and their errors for a chunk of records, written in place
+    chunk['cutoff'] = cutoffs[chunk['group']]
+    chunk['titer'], chunk['titer_se'], below_cutoff = curve_titers(
+        chunk['readings'], chunk['xdata'], chunk['cutoff'], chunk['lo'], chunk['hi'], chunk['popt'], chunk['pcov'],
+        chunk['fit_status'] == INTERPOLATED, chunk['qc_reason'] == '')
+    chunk['qc_reason'][below_cutoff] = BELOW_CUTOFF
+    chunk['bad_data'] = chunk['qc_reason'] != ''
+
+
+def chunk_sweep(chunk: np.ndarray, sweep_cutoffs: np.ndarray, group_count: int) -> tuple:
+    """
+    Per-group (counts, sums) of the good titers of a chunk of records for every accuracy of the sweep, sweep_cutoffs
+    being (accuracies, groups). Call it before chunk_titers(), which marks the records below the current cutoff.
+    """
+    passed = chunk['qc_reason'] == ''
+    interpolated = chunk['fit_status'] == INTERPOLATED
+    counts = np.zeros((len(sweep_cutoffs), group_count), dtype=np.int64)
+    sums = np.zeros((len(sweep_cutoffs), group_count))
+    for index, cutoffs in enumerate(sweep_cutoffs):
+        titers, _, below_cutoff = curve_titers(chunk['readings'], chunk['xdata'], cutoffs[chunk['group']], chunk['lo'],
+                                               chunk['hi'], chunk['popt'], chunk['pcov'], interpolated, passed)
+        good = passed & ~below_cutoff & ~np.isnan(titers)
+        counts[index] = np.bincount(chunk['group'][good], minlength=group_count)
+        sums[index] = np.bincount(chunk['group'][good], weights=titers[good], minlength=group_count)
+    return counts, sums
+
+
+def _optional(value):
+    return '' if np.isnan(value) else value
+
+
+def group_runs(results: np.ndarray, chunk_size: int) -> list:
+    # (group id, start, stop) of every run of consecutive records of one group, the records are read chunk by chunk
+    runs = list()
+    for start in range(0, len(results), chunk_size):
+        groups = np.array(results['group'][start:start + chunk_size])
+        for offset in np.flatnonzero(np.diff(groups, prepend=-1)):
+            if len(runs) > 0 and runs[-1][0] == groups[offset] and runs[-1][2] == start + offset:
+                # the run goes on in the next chunk
+                continue
+            if len(runs) > 0:
+                runs[-1][2] = start + offset
+            runs.append([int(groups[offset]), start + offset, None])
+        if len(runs) > 0:
+            runs[-1][2] = start + len(groups)
+    return runs
+
+
+def chunk_diagnostics(chunk: np.ndarray) -> tuple:
+    # (fit diagnostics, quality vectors) of a chunk of records; the vectors are Sample.get_quality_vector() of every
+    # record, NaN for records without a fit
+    diagnostics, _ = diagnose(chunk['readings'], chunk['xdata'], chunk['lo'], chunk['hi'], chunk['popt'],
+                              chunk['fit_status'] == INTERPOLATED)
+    mean_y = (chunk['lo'] + chunk['hi']) / 2
+    return diagnostics, np.sqrt(mean_y ** 2 + diagnostics['midpoint'] ** 2 + chunk['r2'] ** 2)
+
+
+def group_statistics(results: np.ndarray, runs: list, group_count: int, chunk_size: int, sweeps: list,
+                     memory_limit: int | None = None) -> tuple:
+    """
+    Summary rows (see summary.titers_summary_row()) and outlier quality vectors of every group, read run by run from
+    the records and the sweeps of the groups (or None). Outliers are detected among the fitted records of a group as
+    in AnalyticalGroup.detect_outliers().
+    """
+    titers = [list() for _ in range(group_count)]
+    vectors = [list() for _ in range(group_count)]
+    for group_id, start, stop in runs:
+        for chunk_start in range(start, stop, chunk_size):
+            check_memory(memory_limit, 'xlsx')
+            chunk = np.array(results[chunk_start:min(chunk_start + chunk_size, stop)])
+            good = ~chunk['bad_data'] & ~np.isnan(chunk['titer'])
+            titers[group_id].append(chunk['titer'][good])
+            chunk_vectors = chunk_diagnostics(chunk)[1]
+            vectors[group_id].append(chunk_vectors[np.isfinite(chunk_vectors)])
+    rows = [titers_summary_row(np.concatenate(group_titers or [np.zeros(0)]), sweep)
+            for group_titers, sweep in zip(titers, sweeps)]
+    outliers = list()
+    for group_vectors in vectors:
+        group_vectors = np.concatenate(group_vectors or [np.zeros(0)])
+        outliers.append(np.array(detect_outlier(group_vectors, 30, 70) if len(group_vectors) > 0 else []))
+    return rows, outliers
+
+
+def record_rows(results: np.ndarray, start: int, stop: int, chunk_size: int, outliers: np.ndarray,
+                memory_limit: int | None = None):
+    # `outliers` are the quality vectors of the outliers of the group, see group_statistics()
+    yield sample_columns(POINT_COUNT)
+    for chunk_start in range(start, stop, chunk_size):
+        check_memory(memory_limit, 'xlsx')
+        chunk = np.array(results[chunk_start:min(chunk_start + chunk_size, stop)])
+        diagnostics, vectors = chunk_diagnostics(chunk)
+        flags = np.isin(vectors, outliers)
+        for record, record_diagnostics, outlier in zip(chunk, diagnostics, flags):
+            yield [record['name']] + list(record['readings']) + list(record['popt']) + \
+                [record['r2'], record_diagnostics['adjusted_r2'], record_diagnostics['rmse'], record['titer'],
+                 record['titer_se'], record['fit_status'], record['qc_reason'], record['bad_data'],
+                 lacks_fit(record_diagnostics), outlier, '']
+
+
+def run_batch(file_paths: list, output_dir: str, base_dilution: float = 100., coefficient: float = 3.,
+              negative_control_indices: list | None = None, accuracy: float = 99.0, group_by: str = PLATE,
+              chunk_size: int = CHUNK_SIZE, memory_limit: int | None = None, budget: FitBudget | None = None,
+              xlsx: bool = False, sweep: bool = False) -> dict:
+    """
+    Calculate titers for all plates of the workbooks without keeping them in memory. Every plate is a group with
+    `group_by=PLATE`, every workbook is one with `group_by=WORKBOOK`. `memory_limit` is in bytes, the chunks are sized
+    to fit it and the run stops with MemoryError once the traced peak goes over it. With `xlsx` the results are also
+    written to results.xlsx. With `sweep` the average titers of every accuracy of cutoff_multiplier_accuracies are
+    added to the group results.
+    Returns the run report, which is also stored in batch.json.
+    """
+    if negative_control_indices is None:
+        negative_control_indices = [POINT_COUNT - 1]
+    output = Path(output_dir)
+    output.mkdir(parents=True, exist_ok=True)
+    chunk_size = memory_chunk_size(chunk_size, memory_limit)
+    if budget is None:
+        budget = FitBudget()
+    budget.start_run()
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        started = time.monotonic()
+
+        # pass 1: load, screen and fit plate by plate, the records are appended to the results file
+        aggregates = GroupAggregates()
+        sample_count = 0
+        plate_count = 0
+        with open(output / 'results.bin', 'wb') as f:
+            for group, readings, xdata, sample_names in stream_plates(file_paths, base_dilution, coefficient, group_by):
+                group_id = aggregates.get_id(group)
+                indices = [index for index in negative_control_indices if index < readings.shape[1]]
+                aggregates.add_controls(group_id, readings[:, indices].ravel())
+                records = plate_records(readings, xdata, sample_names, group_id, budget)
+                f.write(records.tobytes())
+                sample_count += len(records)
+                plate_count += 1
+                check_memory(memory_limit, 'fitting')
+        fit_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+
+        # pass 2: titers chunk by chunk from the memory-mapped records, group sums are accumulated along the way
+        cutoffs = aggregates.cutoffs(accuracy)
+        group_count = len(aggregates.names)
+        titer_counts = np.zeros(group_count, dtype=np.int64)
+        titer_sums = np.zeros(group_count)
+        titer_squares = np.zeros(group_count)
+        error_counts = np.zeros(group_count, dtype=np.int64)
+        error_sums = np.zeros(group_count)
+        # the same sums of the log10 titers and errors for the confidence intervals
+        log_sums = np.zeros(group_count)
+        log_squares = np.zeros(group_count)
+        log_error_sums = np.zeros(group_count)
+        # the good titers of every swept accuracy
+        sweep_cutoffs = np.array([aggregates.cutoffs(sweep_accuracy)
+                                  for sweep_accuracy in cutoff_multiplier_accuracies])
+        sweep_counts = np.zeros((len(cutoff_multiplier_accuracies), group_count), dtype=np.int64)
+        sweep_sums = np.zeros((len(cutoff_multiplier_accuracies), group_count))
+        if sample_count > 0:
+            results = np.memmap(output / 'results.bin', dtype=RESULT_DTYPE, mode='r+', shape=(sample_count,))
+            with open(output / 'samples.csv', 'w', encoding='UTF8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['Group', 'Sample', 'Fit status', 'QC', 'R2', 'Cutoff', 'Endpoint titer', 'Titer SE'])
+                for start in range(0, sample_count, chunk_size):
+                    chunk = np.array(results[start:start + chunk_size])
+                    if sweep:
+                        counts, sums = chunk_sweep(chunk, sweep_cutoffs, group_count)
+                        sweep_counts += counts
+                        sweep_sums += sums
+                    chunk_titers(chunk, cutoffs)
+                    results[start:start + chunk_size] = chunk
+                    check_memory(memory_limit, 'titers')
+
+                    good = ~chunk['bad_data']
+                    titer_counts += np.bincount(chunk['group'][good], minlength=group_count)
+                    titer_sums += np.bincount(chunk['group'][good], weights=chunk['titer'][good], minlength=group_count)
+                    titer_squares += np.bincount(chunk['group'][good], weights=chunk['titer'][good] ** 2,
+                                                 minlength=group_count)
+                    known = good & ~np.isnan(chunk['titer_se'])
+                    error_counts += np.bincount(chunk['group'][known], minlength=group_count)
+                    error_sums += np.bincount(chunk['group'][known], weights=chunk['titer_se'][known] ** 2,
+                                              minlength=group_count)
+                    log_titers, log_errors = log_titers_and_errors(chunk['titer'], chunk['titer_se'])
+                    log_sums += np.bincount(chunk['group'][good], weights=log_titers[good], minlength=group_count)
+                    log_squares += np.bincount(chunk['group'][good], weights=log_titers[good] ** 2,
+                                               minlength=group_count)
+                    log_error_sums += np.bincount(chunk['group'][known], weights=log_errors[known] ** 2,
+                                                  minlength=group_count)
+
+                    for record in chunk:
+                        writer.writerow([aggregates.names[record['group']], record['name'], record['fit_status'],
+                                         record['qc_reason'], _optional(record['r2']), _optional(record['cutoff']),
+                                         _optional(record['titer']), _optional(record['titer_se'])])
+            results.flush()
+            del results
+        titer_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            averages = np.where(titer_counts > 0, titer_sums / titer_counts, np.nan)
+        errors = average_standard_errors(titer_counts, titer_sums, titer_squares, error_counts, error_sums)
+        lows, highs = confidence_interval(titer_counts, log_sums, log_squares, error_counts, log_error_sums)
+        # the sweep of every group in the form of AnalyticalGroup.sweep as far as the summary needs it
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sweep_averages = np.where(sweep_counts > 0, sweep_sums / sweep_counts, np.nan)
+        sweeps = [{'accuracies': cutoff_multiplier_accuracies, 'average_titers': sweep_averages[:, group_id]}
+                  if sweep else None for group_id in range(group_count)]
+        with open(output / 'groups.csv', 'w', encoding='UTF8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Group', 'Cutoff', 'Count', 'Endpoint Titer', 'Standard Error', 'CI Low', 'CI High'] +
+                            SWEEP_COLUMNS)
+            for group_id, name in enumerate(aggregates.names):
+                writer.writerow([name, _optional(cutoffs[group_id]), titer_counts[group_id],
+                                 _optional(averages[group_id]), _optional(errors[group_id]),
+                                 _optional(lows[group_id]), _optional(highs[group_id])] +
+                                [_optional(sweep_averages[index, group_id]) if sweep else ''
+                                 for index in range(len(cutoff_multiplier_accuracies))])
+
+        if xlsx:
+            # pass 3: the group statistics and outliers are read from the records run by run, then the group sheets
+            # are streamed from them, one run of records of a group after another
+            if sample_count > 0:
+                results = np.memmap(output / 'results.bin', dtype=RESULT_DTYPE, mode='r', shape=(sample_count,))
+                runs = group_runs(results, chunk_size)
+            else:
+                results, runs = None, list()
+            statistics, outliers = group_statistics(results, runs, group_count, chunk_size, sweeps, memory_limit)
+            summary = [SUMMARY_SHEET_COLUMNS] + \
+                [[name, cutoffs[group_id], accuracy, averages[group_id], errors[group_id], lows[group_id],
+                  highs[group_id]] + statistics[group_id] for group_id, name in enumerate(aggregates.names)]
+            sheets = ((aggregates.names[group_id],
+                       record_rows(results, start, stop, chunk_size, outliers[group_id], memory_limit))
+                      for group_id, start, stop in runs)
+            write_workbook(str(output / 'results.xlsx'), summary, sheets)
+        xlsx_peak = tracemalloc.get_traced_memory()[1] if xlsx else 0
+    finally:
+        # a run stopped by the memory limit does not leave tracing on either
+        if not tracing:
+            tracemalloc.stop()
+
+    peak = max(fit_peak, titer_peak, xlsx_peak)
+    report = {
+        'plates': plate_count,
+        'samples': sample_count,
+        'groups': group_count,
+        'chunk_size': chunk_size,
+        'seconds': time.monotonic() - started,
+        'fit_peak_bytes': fit_peak,
+        'titer_peak_bytes': titer_peak,
+        'xlsx_peak_bytes': xlsx_peak,
+        'memory_limit_bytes': memory_limit,
+        'within_limit': memory_limit is None or peak <= memory_limit,
+    }
+    _write_metadata(output, sample_count, aggregates.names, report)
+
+    print(f'{plate_count} plates, {sample_count} samples, {group_count} groups in {report["seconds"]:.1f} s')
+    print(f'peak traced memory: fitting {fit_peak / 2**20:.1f} MB, titers {titer_peak / 2**20:.1f} MB' +
+          (f', xlsx {xlsx_peak / 2**20:.1f} MB' if xlsx else ''))
+    if not report['within_limit']:
+        print(f'peak traced memory {peak / 2**20:.1f} MB is over the limit of {memory_limit / 2**20:.1f} MB')
+    return report
+
+
+def _write_metadata(output: Path, sample_count: int, groups: list, report: dict):
+    metadata = {'dtype': RESULT_DTYPE.descr, 'sample_count': sample_count, 'groups': groups, 'report': report}
+    with open(output / 'batch.json', 'w') as f:
+        json.dump(metadata, f, indent=1)
+
+
+def open_results(output_dir: str) -> tuple:
+    # (records memmap, group names) of a finished run
+    with open(Path(output_dir) / 'batch.json') as f:
+        metadata = json.load(f)
+    if metadata['sample_count'] == 0:
+        return np.zeros(0, dtype=RESULT_DTYPE), metadata['groups']
+    results = np.memmap(Path(output_dir) / 'results.bin', dtype=RESULT_DTYPE, mode='r',
+                        shape=(metadata['sample_count'],))
+    return results, metadata['groups']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calculate titers for many workbooks with bounded memory')
+    parser.add_argument('output_dir')
+    parser.add_argument('workbooks', nargs='+')
+    parser.add_argument('--base-dilution', type=float, default=100.)
+    parser.add_argument('--coefficient', type=float, default=3.)
+    parser.add_argument('--negative-controls', type=int, nargs='+', default=[POINT_COUNT - 1])
+    parser.add_argument('--accuracy', type=float, default=99.0)
+    parser.add_argument('--group-by', choices=[PLATE, WORKBOOK], default=PLATE)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--memory-limit-mb', type=float, default=None)
+    parser.add_argument('--sample-seconds', type=float, default=SAMPLE_SECONDS,
+                        help='time limit of a single fit')
+    parser.add_argument('--xlsx', action='store_true', help='also write the results to results.xlsx')
+    parser.add_argument('--sweep', action='store_true', help='also average the titers of every cutoff accuracy')
+
+    args = parser.parse_args()
+    memory_limit = None if args.memory_limit_mb is None else int(args.memory_limit_mb * 2**20)
+    try:
+        report = run_batch(args.workbooks, args.output_dir, args.base_dilution, args.coefficient,
+                           args.negative_controls, args.accuracy, args.group_by, args.chunk_size, memory_limit,
+                           FitBudget(sample_seconds=args.sample_seconds), args.xlsx, args.sweep)
+    except (MemoryError, ValueError) as error:
+        print(error)
+        return 1
+    return 0 if report['within_limit'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+import re
+
+import numpy as np
+
+
+# Background correction of raw plate reads. Readers export the measurement read (e.g. OD450) and a reference read at a
+# longer wavelength (e.g. OD570) for every plate, and some wells hold blanks. All plates of a workbook are stacked
+# into one (plates, reads, rows, columns) array and corrected in one pass:
+#
+#     corrected = measurement - reference - blank level
+#
+# with the blank level being the mean of the reference-corrected blank wells of the plate. Plates without a
+# reference read skip that step. Blanks are subtracted and their columns dropped (they are not samples) only on plates
+# with a reference read, the layout of single-read plates is kept as it is unless blank correction is asked for.
+
+blank_name = re.compile(r'^\s*(blank|blk)\b', re.IGNORECASE)
+
+
+def is_blank(sample_name) -> bool:
+    return sample_name is not None and blank_name.match(str(sample_name)) is not None
+
+
+def read_roles(wavelengths: list) -> tuple:
+    """
+    Indices of the measurement and the reference read of a plate, the reference is None for a single read. Labelled
+    reads are told apart by their wavelength (the shortest one is measured, the longest one is the reference),
+    unlabelled ones by their order.
+    """
+    if len(wavelengths) < 2:
+        return 0, None
+    if all(wavelength is not None for wavelength in wavelengths):
+        values = [float(wavelength) for wavelength in wavelengths]
+        measurement, reference = int(np.argmin(values)), int(np.argmax(values))
+        if measurement != reference:
+            return measurement, reference
+    return 0, 1
+
+
+def stack_reads(blocks: list) -> np.ndarray:
+    # (plates, reads, rows, columns) array of all reads, NaN-padded to the largest plate
+    read_count = max(len(reads) for _, reads, _, _ in blocks)
+    row_count = max([len(rows) for _, reads, _, _ in blocks for rows in reads] + [0])
+    column_count = max([len(row) for _, reads, _, _ in blocks for rows in reads for row in rows] +
+                       [len(sample_names) for _, _, sample_names, _ in blocks])
+    stacked = np.full((len(blocks), read_count, row_count, column_count), np.nan)
+    for plate_index, (_, reads, _, _) in enumerate(blocks):
+        for read_index, rows in enumerate(reads):
+            for row_index, row in enumerate(rows):
+                stacked[plate_index, read_index, row_index, :len(row)] = row
+    return stacked
+
+
+def correct(stacked: np.ndarray, measurements: np.ndarray, references: np.ndarray, blanks: np.ndarray) -> np.ndarray:
+    """
+    Corrected (plates, rows, columns) readings. `measurements` and `references` are the read indices of every plate,
+    -1 for plates without a reference, `blanks` is the (plates, columns) mask of blank wells.
+    """
+    plates = np.arange(len(stacked))
+    corrected = stacked[plates, measurements]
+    has_reference = references >= 0
+    corrected[has_reference] -= stacked[plates[has_reference], references[has_reference]]
+
+    blank_wells = blanks[:, None, :] & ~np.isnan(corrected)
+    blank_counts = np.sum(blank_wells, axis=(1, 2))
+    blank_sums = np.sum(np.where(blank_wells, corrected, 0.), axis=(1, 2))
+    blank_levels = np.where(blank_counts > 0, blank_sums / np.maximum(blank_counts, 1), 0.)
+    return corrected - blank_levels[:, None, None]
+
+
+def correct_blocks(blocks: list, blank_correction: bool | None = None) -> list:
+    """
+    Turn raw (name, reads, sample_names, wavelengths) plate blocks into (name, rows, sample_names) plates of
+    corrected readings, see plate_reader.read_plate_blocks(). `blank_correction` subtracts the blanks and drops their
+    columns on every plate (True), on none (False) or on the plates with a reference read (None).
+    """
+    if len(blocks) == 0:
+        return list()
+    stacked = stack_reads(blocks)
+    roles = [read_roles(wavelengths) for _, _, _, wavelengths in blocks]
+    measurements = np.array([measurement for measurement, _ in roles], dtype=np.int64)
+    references = np.array([-1 if reference is None else reference for _, reference in roles], dtype=np.int64)
+    blanks = np.zeros((len(blocks), stacked.shape[3]), dtype=bool)
+    for plate_index, (_, _, sample_names, _) in enumerate(blocks):
+        blanks[plate_index, :len(sample_names)] = [is_blank(sample_name) for sample_name in sample_names]
+    if blank_correction is None:
+        blanks &= (references >= 0)[:, None]
+    elif not blank_correction:
+        blanks[:] = False
+    corrected = correct(stacked, measurements, references, blanks)
+
+    plates = list()
+    for plate_index, (name, reads, sample_names, _) in enumerate(blocks):
+        columns = [index for index, sample_name in enumerate(sample_names) if not blanks[plate_index, index]]
+        row_count = len(reads[measurements[plate_index]])
+        rows = corrected[plate_index, :row_count][:, columns]
+        # missing wells stay NaN, plain floats as the parser gives them
+        plates.append((name, rows.tolist(), [sample_names[index] for index in columns]))
+    return plates
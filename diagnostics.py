@@ -0,0 +1,90 @@
+import numpy as np
+
+from sigmoid import asymmetrical_reverse_sigmoid, revert_x
+
+
+# Goodness of fit of many curves at once. Every fitted curve is evaluated at every dilution point in one array
+# operation and the statistics are derived from the (samples, points) residual matrix:
+#
+#     r2              coefficient of determination
+#     adjusted_r2     R² penalized for the number of fitted parameters, NaN if there are too few points
+#     rmse            root mean square of the residuals
+#     durbin_watson   sum of squared differences of neighbouring residuals over the residual sum of squares; values
+#                     well below 2 mean the residuals run in long stretches of one sign, i.e. the curve shape does
+#                     not follow the data (lack of fit)
+#     rises           total rise of the readings along the dilutions as a fraction of their span, 0 for a
+#                     monotonically descending curve
+#     midpoint        log dilution at which the curve crosses the middle of the readings
+#
+# Readings are (samples, points) matrices of descending curves, NaN-padded for shorter samples.
+
+DIAGNOSTICS_DTYPE = np.dtype([
+    ('r2', np.float64),
+    ('adjusted_r2', np.float64),
+    ('rmse', np.float64),
+    ('durbin_watson', np.float64),
+    ('rises', np.float64),
+    ('midpoint', np.float64),
+])
+
+# a lower Durbin-Watson statistic is reported as lack of fit
+lack_of_fit_level = 1.
+
+
+def curve_values(xdata, lo, hi, popt, interpolated) -> np.ndarray:
+    # fitted curves at the dilution points; the interpolated estimate is NaN here, it passes through every point
+    with np.errstate(over='ignore', invalid='ignore'):
+        values = asymmetrical_reverse_sigmoid(xdata, lo[:, None], hi[:, None], popt[:, 0:1], popt[:, 1:2],
+                                              popt[:, 2:3])
+    values[interpolated] = np.nan
+    return values
+
+
+def diagnose(readings, xdata, lo, hi, popt, interpolated, parameter_counts=3) -> tuple:
+    """
+    Diagnostics of all curves. `popt` is (samples, 3) with NaN rows for samples without a fit, `interpolated` marks
+    samples estimated by interpolation, `parameter_counts` is the number of fitted parameters per sample (or one for
+    all). Returns a DIAGNOSTICS_DTYPE array and the (samples, points) residual matrix, both NaN for unfitted samples.
+    """
+    readings = np.asarray(readings, dtype=np.float64)
+    xdata = np.broadcast_to(np.asarray(xdata, dtype=np.float64), readings.shape)
+    interpolated = np.asarray(interpolated, dtype=bool)
+    fitted = ~np.isnan(popt[:, 0]) | interpolated
+
+    residuals = readings - curve_values(xdata, lo, hi, popt, interpolated)
+    residuals[interpolated] = np.where(np.isnan(readings[interpolated]), np.nan, 0.)
+    residuals[~fitted] = np.nan
+
+    diagnostics = np.zeros(len(readings), dtype=DIAGNOSTICS_DTYPE)
+    present = ~np.isnan(readings)
+    counts = np.sum(present, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ss_res = np.nansum(residuals ** 2, axis=1)
+        means = np.nansum(readings, axis=1) / counts
+        ss_tot = np.nansum((readings - means[:, None]) ** 2, axis=1)
+        r2 = 1 - ss_res / ss_tot
+        degrees = counts - np.asarray(parameter_counts) - 1
+        diagnostics['r2'] = r2
+        diagnostics['adjusted_r2'] = np.where(degrees > 0, 1 - (1 - r2) * (counts - 1) / degrees, np.nan)
+        diagnostics['rmse'] = np.sqrt(ss_res / counts)
+        diagnostics['durbin_watson'] = np.where(ss_res > 0, np.nansum(np.diff(residuals, axis=1) ** 2, axis=1) / ss_res,
+                                                np.nan)
+        diagnostics['rises'] = np.nansum(np.clip(np.diff(readings, axis=1), 0., None), axis=1) / (hi - lo)
+
+    x_min, x_max = np.nanmin(xdata, axis=1), np.nanmax(xdata, axis=1)
+    midpoints = revert_x((lo + hi) / 2, lo, hi, popt[:, 0], popt[:, 1], popt[:, 2], x_min, x_max)
+    for index in np.flatnonzero(interpolated):
+        # the interpolated curve is piecewise linear, invert it the same way (x is read for descending y)
+        known = present[index]
+        order = np.argsort(readings[index][known])
+        midpoints[index] = np.interp((lo[index] + hi[index]) / 2, readings[index][known][order],
+                                     xdata[index][known][order])
+    diagnostics['midpoint'] = midpoints
+
+    for name in DIAGNOSTICS_DTYPE.names:
+        diagnostics[name][~fitted] = np.nan
+    return diagnostics, residuals
+
+
+def lacks_fit(diagnostics: np.ndarray) -> np.ndarray:
+    return diagnostics['durbin_watson'] < lack_of_fit_level
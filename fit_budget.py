@@ -0,0 +1,139 @@
+import math
+import time
+
+import numpy as np
+from scipy.optimize import curve_fit
+
+from sigmoid import asymmetrical_reverse_sigmoid
+
+
+FITTED = 'fitted'
+SYMMETRIC = 'symmetric'
+INTERPOLATED = 'interpolated'
+
+
+# default time limit of a single fit, a fit that does not converge by then falls back to the non-parametric estimate
+SAMPLE_SECONDS = 2.0
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class FitBudget:
+    """
+    Limits for the sigmoid fits. Per-sample limits bound every single fit, per-run limits bound the whole run started
+    with start_run(); once the run budget is spent the remaining samples go straight to the non-parametric estimate.
+    None means 'no limit'.
+    """
+
+    def __init__(self, sample_nfev_per_point: int = 10000, sample_seconds: float | None = SAMPLE_SECONDS,
+                 run_nfev: int | None = None, run_seconds: float | None = None, fallback_nfev_per_point: int = 200):
+        self.sample_nfev_per_point = sample_nfev_per_point
+        self.sample_seconds = sample_seconds
+        self.run_nfev = run_nfev
+        self.run_seconds = run_seconds
+        self.fallback_nfev_per_point = fallback_nfev_per_point
+
+        self.run_started = time.monotonic()
+        self.run_nfev_used = 0
+
+    def start_run(self):
+        self.run_started = time.monotonic()
+        self.run_nfev_used = 0
+
+    def run_exhausted(self) -> bool:
+        if self.run_nfev is not None and self.run_nfev_used >= self.run_nfev:
+            return True
+        if self.run_seconds is not None and time.monotonic() - self.run_started >= self.run_seconds:
+            return True
+        return False
+
+    def sample_limits(self, point_count: int) -> tuple:
+        # the per-sample limits, cut down to whatever is left of the run budget
+        max_nfev = self.sample_nfev_per_point * point_count
+        run_nfev, run_deadline = self.run_remaining()
+        if run_nfev is not None:
+            max_nfev = min(max_nfev, run_nfev)
+
+        deadline = None
+        if self.sample_seconds is not None:
+            deadline = time.monotonic() + self.sample_seconds
+        if run_deadline is not None:
+            deadline = run_deadline if deadline is None else min(deadline, run_deadline)
+        return max_nfev, deadline
+
+    def run_remaining(self) -> tuple:
+        # evaluations left and the deadline of the run, None for no limit
+        run_nfev = None if self.run_nfev is None else self.run_nfev - self.run_nfev_used
+        run_deadline = None if self.run_seconds is None else self.run_started + self.run_seconds
+        return run_nfev, run_deadline
+
+
+def counted_model(function, max_nfev: float, deadline: float | None, counter: list):
+    # wrap a model or residual function so that every evaluation is counted in counter[0] and the limits are enforced
+    def model(*args):
+        counter[0] += 1
+        if counter[0] > max_nfev:
+            raise BudgetExceeded('evaluation limit')
+        if deadline is not None and time.monotonic() > deadline:
+            raise BudgetExceeded('time limit')
+        return function(*args)
+    return model
+
+
+def fit_with_budget(xdata, ydata, budget: FitBudget | None = None, sigma=None, p0=None) -> tuple:
+    """
+    Fit the asymmetrical reverse sigmoid within the budget limits. When the full fit fails or runs out of budget, fall
+    back to the symmetric sigmoid (asymmetry fixed to 1) and then to plain interpolation of the data.
+    `sigma` optionally weights the points, as in curve_fit, `p0` is the starting point of the full fit.
+    Returns (popt, pcov, status, note), popt and pcov are None for the interpolated estimate.
+    """
+    if budget is None:
+        budget = FitBudget()
+    xdata = np.asarray(xdata, dtype=float)
+    ydata = np.asarray(ydata, dtype=float)
+    lo, hi = np.min(ydata), np.max(ydata)
+
+    if budget.run_exhausted():
+        return None, None, INTERPOLATED, 'run budget exhausted'
+
+    max_nfev, deadline = budget.sample_limits(len(xdata))
+    evaluations = [0]
+    limited = counted_model(asymmetrical_reverse_sigmoid, max_nfev, deadline, evaluations)
+
+    def model(x, a, b, c):
+        return limited(x, lo, hi, a, b, c)
+
+    try:
+        popt, pcov = curve_fit(model, xdata, ydata, p0=p0, sigma=sigma, method='dogbox', max_nfev=max_nfev)
+        return popt, pcov, FITTED, ''
+    except (BudgetExceeded, RuntimeError, ValueError) as error:
+        note = str(error)
+    finally:
+        budget.run_nfev_used += evaluations[0]
+
+    # cheaper model: two parameters and a small fixed evaluation limit, so the fallback time is predictable; it is
+    # charged to the run budget and stops at the run deadline like the full fit
+    run_nfev, run_deadline = budget.run_remaining()
+    if run_nfev is not None and run_nfev <= 0:
+        return None, None, INTERPOLATED, f'{note}; run budget exhausted'
+    evaluations = [0]
+    limited = counted_model(asymmetrical_reverse_sigmoid, math.inf if run_nfev is None else run_nfev, run_deadline,
+                            evaluations)
+
+    def symmetric_model(x, a, b):
+        return limited(x, lo, hi, a, b, 1.)
+
+    try:
+        popt, pcov = curve_fit(symmetric_model, xdata, ydata, sigma=sigma, method='dogbox',
+                               max_nfev=budget.fallback_nfev_per_point * len(xdata))
+    except (BudgetExceeded, RuntimeError, ValueError) as error:
+        return None, None, INTERPOLATED, f'{note}; symmetric fit: {error}'
+    finally:
+        budget.run_nfev_used += evaluations[0]
+
+    # keep the (a, b, c) layout, the asymmetry is fixed so it has no variance
+    full_pcov = np.zeros((3, 3))
+    full_pcov[:2, :2] = pcov
+    return np.array([popt[0], popt[1], 1.]), full_pcov, SYMMETRIC, note
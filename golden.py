@@ -0,0 +1,453 @@
+import argparse
+import contextlib
+import io
+import math
+import sys
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+from immuno_calculator import Sample, AnalyticalGroup
+from batch import GroupAggregates, plate_records, chunk_titers
+from fit_budget import FitBudget
+from qc import screen_samples, to_matrix, saturation_level
+from sigmoid import asymmetrical_reverse_sigmoid
+from titers import compute_titers, orient
+from replicates import group_replicates
+from triage import triage_groups
+from work_queue import groups_from_workbooks, _write_json, _read_json
+
+
+# Golden-result regression harness. A corpus of plates (synthetic curves with the usual defects and, optionally, real
+# workbooks) is run once through the reference code path - the Sample/AnalyticalGroup methods the GUI uses - and the
+# titers, R² values and outlier sets are stored in a golden file together with the corpus:
+#
+#     python golden.py record golden.json --workbooks plates.xlsx
+#     python golden.py check golden.json
+#
+# `check` runs every engine on the stored corpus and compares its results with the golden ones within the tolerances
+# declared in ENGINES, reporting accuracy and speed side by side. The reference engine itself is checked too, so any
+# change of the reference path that moves a titer shows up. The exit code is 1 if an engine is out of tolerance.
+#
+# All groups are in the work_queue format: dicts with 'name', 'negative_control_indices' and 'samples' (dicts with
+# 'name', 'xdata' and 'ydata').
+
+FORMAT_VERSION = 1
+
+# synthetic plates: 8 dilution points, the last one is a blank used as the negative control
+BASE_DILUTION = 100.
+COEFFICIENT = 3.
+POINT_COUNT = 8
+NEGATIVE_CONTROL_INDICES = [POINT_COUNT - 1]
+# log-normal spread of the slope and asymmetry of the sera of a group around the shape of the group
+SHAPE_SPREAD = 0.1
+# fraction of the synthetic samples with each kind of defect
+DEFECT_RATES = {
+    'flat': 0.05,
+    'saturated': 0.05,
+    'missing well': 0.03,
+    'non-monotonic': 0.03,
+    'weak': 0.05,
+}
+
+
+def synthetic_groups(group_count: int = 12, sample_count: int = 8, seed: int = 0) -> list:
+    """
+    Plates drawn from the asymmetrical sigmoid with noise. The sera of a group are read in one assay, so they share a
+    curve shape up to SHAPE_SPREAD and differ in their midpoints, as the joint fit assumes. Samples come in pairs of
+    technical replicates (same curve, independent noise), so the replicate collapse path has something to collapse.
+    Some samples get the defects of DEFECT_RATES, so the QC and fallback paths are covered as well.
+    """
+    rng = np.random.default_rng(seed)
+    xdata = [math.log10(BASE_DILUTION * COEFFICIENT ** i) for i in range(POINT_COUNT)]
+    x = np.array(xdata[:-1])
+    groups = list()
+    for group_index in range(group_count):
+        samples = list()
+        group_a, group_c = rng.uniform(0.8, 2.5), rng.uniform(0.5, 2.)
+        for pair_index in range(sample_count // 2):
+            lo, hi = rng.uniform(0.04, 0.08), rng.uniform(1.5, 3.3)
+            a, c = group_a * rng.lognormal(0., SHAPE_SPREAD), group_c * rng.lognormal(0., SHAPE_SPREAD)
+            b = rng.uniform(2.5, 4.5)
+            noise = rng.uniform(0.01, 0.04)
+            defect = rng.choice(list(DEFECT_RATES) + [None], p=list(DEFECT_RATES.values()) +
+                                [1 - sum(DEFECT_RATES.values())])
+            if defect == 'weak':
+                hi = lo + rng.uniform(0.05, 0.15)
+            elif defect == 'flat':
+                hi = lo + 0.02
+            for replicate in (1, 2):
+                ydata = asymmetrical_reverse_sigmoid(x, lo, hi, a, b, c) + rng.normal(0., noise, len(x))
+                ydata = list(np.append(ydata, lo + rng.normal(0., 0.01)))
+                if defect == 'saturated':
+                    ydata = [saturation_level + 0.4 if index < POINT_COUNT - 3 else y for index, y in enumerate(ydata)]
+                elif defect == 'missing well':
+                    ydata[rng.integers(POINT_COUNT - 1)] = math.nan
+                elif defect == 'non-monotonic':
+                    ydata[POINT_COUNT - 3] = ydata[0]
+                samples.append({'name': f'serum {pair_index + 1} rep{replicate}', 'xdata': xdata,
+                                'ydata': [float(y) for y in ydata]})
+        groups.append({'name': f'synthetic {group_index + 1}', 'negative_control_indices': NEGATIVE_CONTROL_INDICES,
+                       'samples': samples})
+    return groups
+
+
+def build_groups(corpus: list, joint_fit: bool = False, collapse_replicates: bool = False) -> list:
+    groups = list()
+    for entry in corpus:
+        samples = [Sample(sample['name'], xdata=list(sample['xdata']), ydata=list(sample['ydata']))
+                   for sample in entry['samples']]
+        group = AnalyticalGroup(entry['name'], samples)
+        group.negative_control_indices = list(entry['negative_control_indices'])
+        group.joint_fit = joint_fit
+        group.collapse_replicates = collapse_replicates
+        for sample in samples:
+            sample.group = group
+        groups.append(group)
+    return groups
+
+
+def fit_groups(groups: list, budget: FitBudget):
+    # the 'Build sigmoid' step of the GUI
+    screen_samples([sample for group in groups for sample in group.samples])
+    budget.start_run()
+    for group in groups:
+        group.replicate_samples = None
+        if not group.joint_fit or not group.fit_jointly(budget):
+            for sample in group.get_fit_samples():
+                sample.get_popt_pcov(budget)
+        for sample in group.get_fit_samples():
+            sample.get_R2()
+        group.share_replicate_results()
+        group.detect_outliers()
+
+
+def group_results(groups: list, with_outliers: bool = True) -> dict:
+    # per-sample results in corpus order, NaN where a sample has no usable titer or R²
+    samples = [sample for group in groups for sample in group.samples]
+    return {
+        'titers': [math.nan if sample.endpoint_titer is None or sample.bad_data else float(sample.endpoint_titer)
+                   for sample in samples],
+        'r2': [math.nan if sample.R2 is None else float(sample.R2) for sample in samples],
+        'cutoffs': [float(group.cutoff) for group in groups],
+        'outliers': [sorted(group.outliers) for group in groups] if with_outliers else None,
+    }
+
+
+def calculate_averages(groups: list):
+    for group in groups:
+        if any(sample.endpoint_titer is not None for sample in group.get_fit_samples()):
+            group.calculate_average_titer()
+
+
+def titers_from_fits(groups: list, accuracy: float):
+    # the 'Endpoint titer' step of the GUI on the fits of fit_groups(), nothing is fitted again
+    for group in groups:
+        group.accuracy = accuracy
+        group.cutoff = group.get_cutoff(accuracy)
+        samples = group.get_fit_samples()
+        screen_samples(samples, group.cutoff)
+        for sample in samples:
+            sample.calculate_endpoint_titer(group.cutoff, refit=False)
+        group.share_replicate_results()
+    calculate_averages(groups)
+
+
+def run_reference(corpus: list, accuracy: float) -> dict:
+    groups = build_groups(corpus)
+    fit_groups(groups, FitBudget())
+    titers_from_fits(groups, accuracy)
+    return group_results(groups)
+
+
+def run_sweep(corpus: list, accuracy: float) -> dict:
+    # fit once, titers from the closed-form inversion of the fitted curves
+    groups = build_groups(corpus)
+    budget = FitBudget()
+    fit_groups(groups, budget)
+    for group in groups:
+        group.sweep_accuracies([accuracy], budget)
+        group.apply_sweep(accuracy)
+    return group_results(groups)
+
+
+def run_joint(corpus: list, accuracy: float) -> dict:
+    groups = build_groups(corpus, joint_fit=True)
+    fit_groups(groups, FitBudget())
+    titers_from_fits(groups, accuracy)
+    return group_results(groups)
+
+
+def run_replicates(corpus: list, accuracy: float) -> dict:
+    groups = build_groups(corpus, collapse_replicates=True)
+    fit_groups(groups, FitBudget())
+    titers_from_fits(groups, accuracy)
+    # outliers are detected among the replicate sets, they are not comparable with the per-sample ones
+    return group_results(groups, with_outliers=False)
+
+
+def run_triage(corpus: list, accuracy: float) -> dict:
+    # interpolated estimates, only borderline samples are fitted; R² is not computed
+    groups = build_groups(corpus)
+    estimated, fitted = triage_groups(groups, accuracy, FitBudget())
+    results = group_results(groups, with_outliers=False)
+    results['note'] = f'{estimated} of {estimated + fitted} titers estimated, {fitted} fitted'
+    return results
+
+
+def corpus_arrays(corpus: list) -> tuple:
+    samples = [sample for entry in corpus for sample in entry['samples']]
+    readings, _ = to_matrix([sample['ydata'] for sample in samples])
+    xdata, _ = to_matrix([sample['xdata'] for sample in samples])
+    layout = np.repeat(np.arange(len(corpus)), [len(entry['samples']) for entry in corpus])
+    return readings, xdata, layout
+
+
+def run_array(corpus: list, accuracy: float) -> dict:
+    readings, xdata, layout = corpus_arrays(corpus)
+    negative_controls = {index: entry['negative_control_indices'] for index, entry in enumerate(corpus)}
+    samples, groups = compute_titers(readings, layout, xdata, negative_controls, accuracy)
+    return {
+        'titers': samples['titer'].tolist(),
+        'r2': samples['r2'].tolist(),
+        'cutoffs': groups['cutoff'].tolist(),
+        'outliers': None,
+    }
+
+
+def run_batch(corpus: list, accuracy: float) -> dict:
+    # the per-plate fit and the chunked titer pass of batch.py, every group as one plate
+    aggregates = GroupAggregates()
+    budget = FitBudget()
+    budget.start_run()
+    records = list()
+    for entry in corpus:
+        group_id = aggregates.get_id(entry['name'])
+        readings = orient(to_matrix([sample['ydata'] for sample in entry['samples']])[0])
+        aggregates.add_controls(group_id, readings[:, entry['negative_control_indices']].ravel())
+        records.append(plate_records(readings, np.asarray(entry['samples'][0]['xdata'], dtype=float),
+                                     [sample['name'] for sample in entry['samples']], group_id, budget))
+    records = np.concatenate(records)
+    cutoffs = aggregates.cutoffs(accuracy)
+    chunk_titers(records, cutoffs)
+    return {
+        'titers': records['titer'].tolist(),
+        'r2': records['r2'].tolist(),
+        'cutoffs': cutoffs.tolist(),
+        'outliers': None,
+    }
+
+
+# engine: (function, tolerances)
+#     log_titer   largest allowed |log10 titer - log10 golden titer|
+#     median      largest allowed median of |log10 titer - log10 golden titer|
+#     r2          largest allowed |R² - golden R²|, None if the engine does not compute R²
+#     missing     largest allowed fraction of samples that have a titer in one result and not in the other
+#     outliers    whether the outlier sets have to be the same
+#     sets        whether titers are compared per replicate set: an engine fitting every set once gives all its
+#                 replicates the titer of the set, which is compared with the mean log10 golden titer of the set
+# Every engine reads its titers from the curves with titers.curve_titers(), the reference included, so the engines
+# fitting every sample alone agree to rounding. The tolerances of the others are set just above what they reach on
+# the synthetic corpus: triage interpolates the raw data (up to half a log on the lower tail), the joint fit gives the
+# sera of a group one shape where the reference fits eight points with three parameters per sample, and the
+# replicate sets are fitted to their mean readings.
+ENGINES = {
+    'reference': (run_reference, {'log_titer': 1e-9, 'median': 1e-9, 'r2': 1e-9, 'missing': 0., 'outliers': True,
+                                  'sets': False}),
+    'sweep': (run_sweep, {'log_titer': 1e-9, 'median': 1e-9, 'r2': 1e-9, 'missing': 0., 'outliers': True,
+                          'sets': False}),
+    'array': (run_array, {'log_titer': 1e-9, 'median': 1e-9, 'r2': 1e-9, 'missing': 0., 'outliers': False,
+                          'sets': False}),
+    'batch': (run_batch, {'log_titer': 1e-9, 'median': 1e-9, 'r2': 1e-9, 'missing': 0., 'outliers': False,
+                          'sets': False}),
+    'triage': (run_triage, {'log_titer': 0.5, 'median': 0.05, 'r2': None, 'missing': 0., 'outliers': False,
+                            'sets': False}),
+    'joint': (run_joint, {'log_titer': 0.4, 'median': 0.15, 'r2': 0.06, 'missing': 0., 'outliers': False,
+                          'sets': False}),
+    'replicates': (run_replicates, {'log_titer': 0.15, 'median': 0.02, 'r2': None, 'missing': 0.05,
+                                    'outliers': False, 'sets': True}),
+}
+
+
+def run_engine(name: str, corpus: list, accuracy: float) -> tuple:
+    # engines print fit notes for every sample and overflow warnings of steep curves, keep them out of the report
+    function, _ = ENGINES[name]
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        started = time.perf_counter()
+        results = function(corpus, accuracy)
+        seconds = time.perf_counter() - started
+    return results, seconds
+
+
+def replicate_set_labels(corpus: list) -> np.ndarray:
+    # replicate set of every sample in corpus order, sets do not cross groups
+    labels = list()
+    for entry in corpus:
+        first = len(set(labels))
+        sample_labels = np.empty(len(entry['samples']), dtype=np.int64)
+        for set_index, indices in enumerate(group_replicates([sample['name'] for sample in entry['samples']])):
+            sample_labels[indices] = first + set_index
+        labels += sample_labels.tolist()
+    return np.array(labels, dtype=np.int64)
+
+
+def set_titers(titers: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    # geometric mean titer of the replicate set of every sample, NaN for sets without any titer
+    known = ~np.isnan(titers)
+    counts = np.bincount(labels[known], minlength=labels.max(initial=-1) + 1)
+    sums = np.bincount(labels[known], weights=np.log10(titers[known]), minlength=len(counts))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.power(10., sums / counts)[labels]
+
+
+def compare(results: dict, golden: dict, tolerances: dict, labels: np.ndarray | None = None) -> dict:
+    # labels: the replicate set of every sample, used for engines compared per set
+    titers = np.array(results['titers'], dtype=float)
+    golden_titers = np.array(golden['titers'], dtype=float)
+    if tolerances['sets']:
+        golden_titers = set_titers(golden_titers, labels)
+    both = ~np.isnan(titers) & ~np.isnan(golden_titers)
+    deviations = np.abs(np.log10(titers[both]) - np.log10(golden_titers[both]))
+    outside = np.flatnonzero(both)[deviations > tolerances['log_titer']]
+    # samples that have a titer in one result only count as outside as well
+    outside = np.union1d(outside, np.flatnonzero(np.isnan(titers) != np.isnan(golden_titers)))
+    missing = int(np.sum(np.isnan(titers) != np.isnan(golden_titers)))
+    cutoff_deviation = float(np.max(np.abs(np.array(results['cutoffs']) - np.array(golden['cutoffs'])), initial=0.))
+
+    r2_deviation = None
+    if tolerances['r2'] is not None:
+        r2 = np.array(results['r2'], dtype=float)
+        golden_r2 = np.array(golden['r2'], dtype=float)
+        both_r2 = ~np.isnan(r2) & ~np.isnan(golden_r2)
+        r2_deviation = float(np.max(np.abs(r2[both_r2] - golden_r2[both_r2]), initial=0.))
+
+    outliers_match = None
+    if results['outliers'] is not None:
+        outliers_match = results['outliers'] == golden['outliers']
+
+    failures = list()
+    if len(deviations) > 0 and deviations.max() > tolerances['log_titer']:
+        failures.append('titer')
+    if len(deviations) > 0 and np.median(deviations) > tolerances['median']:
+        failures.append('median titer')
+    if missing > tolerances['missing'] * len(titers):
+        failures.append('missing')
+    if cutoff_deviation > 1e-9:
+        failures.append('cutoff')
+    if r2_deviation is not None and r2_deviation > tolerances['r2']:
+        failures.append('R2')
+    if tolerances['outliers'] and not outliers_match:
+        failures.append('outliers')
+    return {
+        'compared': int(both.sum()),
+        'max_deviation': float(deviations.max(initial=0.)),
+        'median_deviation': float(np.median(deviations)) if len(deviations) > 0 else 0.,
+        'within': float(np.mean(deviations <= tolerances['log_titer'])) if len(deviations) > 0 else 1.,
+        'missing': missing,
+        'r2_deviation': r2_deviation,
+        'outliers_match': outliers_match,
+        'failures': failures,
+        'outside': [(int(index), titers[index], golden_titers[index]) for index in outside],
+    }
+
+
+def record(golden_path: str, corpus: list, accuracy: float) -> dict:
+    point_counts = set(len(sample['ydata']) for entry in corpus for sample in entry['samples'])
+    if len(point_counts) > 1:
+        raise ValueError(f'all samples of the corpus must have the same number of points, got {sorted(point_counts)}')
+    results, seconds = run_engine('reference', corpus, accuracy)
+    _write_json(Path(golden_path), {'version': FORMAT_VERSION, 'accuracy': accuracy, 'groups': corpus,
+                                    'reference': results, 'seconds': seconds})
+    return results
+
+
+def check(golden_path: str, engines: list | None = None) -> list:
+    # returns one report row per engine
+    golden = _read_json(Path(golden_path))
+    if golden.get('version') != FORMAT_VERSION:
+        raise ValueError(f'{golden_path} is not a golden file of version {FORMAT_VERSION}')
+    rows = list()
+    reference_seconds = None
+    labels = replicate_set_labels(golden['groups'])
+    for name in engines or list(ENGINES):
+        results, seconds = run_engine(name, golden['groups'], golden['accuracy'])
+        if name == 'reference':
+            reference_seconds = seconds
+        row = compare(results, golden['reference'], ENGINES[name][1], labels)
+        row['engine'], row['seconds'], row['note'] = name, seconds, results.get('note')
+        rows.append(row)
+    if reference_seconds is None:
+        reference_seconds = golden['seconds']
+    for row in rows:
+        row['speedup'] = reference_seconds / row['seconds'] if row['seconds'] > 0 else math.inf
+    return rows
+
+
+def print_details(rows: list, corpus: list):
+    # samples out of the titer tolerance, to tell a defect of an engine from a defect of the reference
+    names = [(entry['name'], sample['name']) for entry in corpus for sample in entry['samples']]
+    for row in rows:
+        for index, titer, golden_titer in row['outside']:
+            group_name, sample_name = names[index]
+            print(f'{row["engine"]:<12}{group_name:>24} {sample_name:>20} {golden_titer:>14.6g} {titer:>14.6g}')
+
+
+def print_report(rows: list):
+    def optional(value, format_spec: str) -> str:
+        if value is None:
+            return 'n/a'
+        if isinstance(value, bool):
+            return 'yes' if value else 'no'
+        return format(value, format_spec)
+
+    print(f'{"engine":<12}{"seconds":>10}{"speedup":>9}{"titers":>8}{"max dlog":>11}{"median dlog":>13}'
+          f'{"within":>8}{"missing":>9}{"max dR2":>11}{"outliers":>10}  status')
+    for row in rows:
+        status = 'ok' if len(row['failures']) == 0 else 'FAILED: ' + ', '.join(row['failures'])
+        print(f'{row["engine"]:<12}{row["seconds"]:>10.3f}{row["speedup"]:>9.2f}{row["compared"]:>8}'
+              f'{row["max_deviation"]:>11.2e}{row["median_deviation"]:>13.2e}{row["within"]:>8.1%}{row["missing"]:>9}'
+              f'{optional(row["r2_deviation"], ".2e"):>11}{optional(row["outliers_match"], ""):>10}  {status}')
+    for row in rows:
+        if row['note'] is not None:
+            print(f'{row["engine"]}: {row["note"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the fast calculation engines against the reference results')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser('record', help='run the reference path and store the golden results')
+    record_parser.add_argument('golden_file')
+    record_parser.add_argument('--workbooks', nargs='*', default=[])
+    record_parser.add_argument('--base-dilution', type=float, default=BASE_DILUTION)
+    record_parser.add_argument('--coefficient', type=float, default=COEFFICIENT)
+    record_parser.add_argument('--negative-controls', type=int, nargs='+', default=NEGATIVE_CONTROL_INDICES)
+    record_parser.add_argument('--synthetic-groups', type=int, default=12)
+    record_parser.add_argument('--seed', type=int, default=0)
+    record_parser.add_argument('--accuracy', type=float, default=99.0)
+
+    check_parser = subparsers.add_parser('check', help='compare the engines with the golden results')
+    check_parser.add_argument('golden_file')
+    check_parser.add_argument('--engines', nargs='+', choices=list(ENGINES), default=None)
+    check_parser.add_argument('--details', action='store_true', help='list the samples out of tolerance')
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        corpus = synthetic_groups(args.synthetic_groups, seed=args.seed) + \
+            groups_from_workbooks(args.workbooks, args.base_dilution, args.coefficient, args.negative_controls)
+        results = record(args.golden_file, corpus, args.accuracy)
+        print(f'{len(results["titers"])} samples in {len(corpus)} groups recorded to {args.golden_file}')
+        return 0
+
+    rows = check(args.golden_file, args.engines)
+    print_report(rows)
+    if args.details:
+        print_details(rows, _read_json(Path(args.golden_file))['groups'])
+    return 0 if all(len(row['failures']) == 0 for row in rows) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
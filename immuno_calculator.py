@@ -1,26 +1,36 @@
+import argparse
 import pandas as pd
 import openpyxl
 import os
 import sys
 from pathlib import Path
 import math
-from scipy.optimize import curve_fit
 import numpy as np
 from matplotlib import pyplot as plt
 import random
 from datetime import datetime
 import csv
 
-
-# get data from table with multipliers
-cutoff_multiplier_accuracies = [95.0, 97.5, 99.0, 99.5, 99.9]
-sdm = Path('Standard deviation multipliers.xlsx')
-table_obj = openpyxl.load_workbook(sdm)
-sheet = table_obj.active
-rows = []
-for row in sheet.iter_rows(2, sheet.max_row):
-    rows.append([x.value for x in row[1:]])
-multipliers = pd.DataFrame(rows, index=[x for x in range(2, 21)] + [25, 30], columns=cutoff_multiplier_accuracies)
+from joint_fit import fit_joint_sigmoid
+from qc import screen_samples, to_matrix, BELOW_CUTOFF
+from sigmoid import asymmetrical_reverse_sigmoid
+from triage import interpolate_crossings, LINEAR
+from replicates import group_replicates, aggregate, replicate_sigma, replicate_key
+from titers import cutoff_multiplier_accuracies, get_multipliers_table, cutoffs_from_stats, curve_titers, \
+    confidence_level
+from accumulators import RunningStats, TiterSums
+from workbook_cache import workbook_cache
+from fit_budget import FitBudget, BudgetExceeded, fit_with_budget, FITTED, SYMMETRIC, INTERPOLATED, SAMPLE_SECONDS
+from diagnostics import diagnose, lacks_fit
+from report import write_report
+from xlsx_export import write_xlsx
+from summary import results_table, summarize, group_titers, group_summary_rows, print_summary, sweep_table, \
+    triage_flag, SUMMARY_COLUMNS
+
+
+# get data from table with multipliers (the table itself is read by the array core)
+multiplier_counts, multiplier_rows = get_multipliers_table()
+multipliers = pd.DataFrame(multiplier_rows, index=multiplier_counts, columns=cutoff_multiplier_accuracies)
 
 markers = ['^', '3', 'P', 'x', 'v', 'p', '+', 'o', 's', 'd', '>', 'D']
 colors = ['violet', 'purple', 'blue', 'lime', 'aqua', 'gold', 'chartreuse',
@@ -35,8 +45,26 @@ class Sample:
         self.popt = None
         self.pcov = None
         self.endpoint_titer = None
+        # delta-method standard error of the endpoint titer, None if the titer is not read from a fitted curve
+        self.titer_se = None
         self.R2 = None
+        # goodness of fit (a DIAGNOSTICS_DTYPE record) and residuals at the dilution points, see diagnose_samples()
+        self.diagnostics = None
+        self.residuals = None
         self.bad_data = False
+        # reason the sample was rejected by the QC pre-screen, None if it passed
+        self.qc_reason = None
+        # outcome of the last fit (fitted/symmetric/interpolated) and why a fallback was used
+        self.fit_status = None
+        self.fit_note = ''
+        # set by the triage mode: True if the interpolated estimate was not trusted and the full fit was used
+        self.triage_borderline = None
+        # True while the fit is older than the readings (a live preview ran out of time), the sample has no titer and
+        # is left out of the average until it is fitted again
+        self.stale = False
+        # for a sample standing for a set of technical replicates: the replicates and the per-point errors of the mean
+        self.replicates = None
+        self.sigma = None
         self.plate = None
         self.group = None
 
@@ -49,26 +77,62 @@ class Sample:
         return min(self.ydata) + (max(self.ydata) - min(self.ydata))/(1+10**((math.log(a) - x) * b))
 
     def asymmetrical_reverse_sigmoid(self, x, a, b, c):
-        return min(self.ydata) + (max(self.ydata) - min(self.ydata)) / np.power(1 + np.power(10, a*(x - b)), c)
-
-    def get_popt_pcov(self):
+        # evaluated in log space (see sigmoid.py), steep curves overflow 10^(a(x - b)) on their lower plateau
+        return asymmetrical_reverse_sigmoid(x, min(self.ydata), max(self.ydata), a, b, c)
+
+    def get_popt_pcov(self, budget: FitBudget | None = None):
+        if self.qc_reason is not None:
+            # do not waste solver time on samples that failed the pre-screen
+            self.popt, self.pcov = None, None
+            self.fit_status, self.fit_note = None, ''
+            return
         # self.popt, self.pcov = curve_fit(self.reverse_sigmoid, self.xdata, self.ydata, method='dogbox')
-        self.popt, self.pcov = curve_fit(self.asymmetrical_reverse_sigmoid, self.xdata, self.ydata, method='dogbox', max_nfev=10000*len(self.xdata))
+        self.popt, self.pcov, self.fit_status, self.fit_note = fit_with_budget(self.xdata, self.ydata, budget,
+                                                                               self.sigma)
+        self.stale = False
+        if self.fit_status != FITTED:
+            print(f'Sample {self.name} fit fell back to {self.fit_status} estimate: {self.fit_note}')
         print(f'{self.popt=}')
 
-    def calculate_endpoint_titer(self, cutoff: float):
-        self.get_popt_pcov()
-
-        if max(self.ydata) > cutoff:
-            # self.endpoint_titer = 1/10**self.revert_x(cutoff)
-            # self.endpoint_titer = 1/10**self.revert_x_asymmetrical(cutoff)
-            self.endpoint_titer = 10**self.revert_x_asymmetrical(cutoff)
+    def is_fitted(self) -> bool:
+        return self.popt is not None or self.fit_status == INTERPOLATED
+
+    def apply_preview_fit(self, popt, pcov, status: str, note: str):
+        # result of a live preview refit; one that ran out of time leaves the previous fit, which no longer matches
+        # the readings, so the sample is stale until the next full fit
+        if status == INTERPOLATED:
+            self.stale = True
+            self.fit_note = f'stale, fit again: {note}'
+            self.endpoint_titer, self.titer_se = None, None
+            return
+        self.popt, self.pcov, self.fit_status, self.fit_note = popt, pcov, status, note
+        self.stale = False
+
+    def calculate_endpoint_titer(self, cutoff: float, refit: bool = True, budget: FitBudget | None = None):
+        # samples fitted as a part of a joint group fit already have their parameters
+        if refit:
+            self.get_popt_pcov(budget)
+        calculate_titers([self], cutoff)
+
+    def estimate_endpoint_titer(self, cutoff: float, method: str = LINEAR, budget: FitBudget | None = None):
+        # fast triage: interpolate the cutoff crossing from the raw data, fit only if the estimate is borderline
+        if self.qc_reason is not None or max(self.ydata) <= cutoff:
+            self.calculate_endpoint_titer(cutoff, refit=False)
+            return
+        log_titers, borderline = interpolate_crossings(np.array([self.xdata], dtype=float),
+                                                       np.array([self.ydata], dtype=float), cutoff, method)
+        self.triage_borderline = bool(borderline[0])
+        if self.triage_borderline:
+            self.calculate_endpoint_titer(cutoff, budget=budget)
         else:
-            self.bad_data = True
-            print(f'Sample {self.name} has a bad data for this cutoff ({cutoff}) and will not be included'
-                  f' in calculations! Try to lower calculation accuracy.')
+            # the estimate is not read from a curve, it has no error
+            self.endpoint_titer, self.titer_se, self.bad_data = 10**log_titers[0], None, False
 
     def approximate(self, x: float) -> float:
+        if self.fit_status == INTERPOLATED:
+            # non-parametric estimate: piecewise-linear curve through the data points
+            order = np.argsort(self.xdata)
+            return np.interp(x, np.asarray(self.xdata)[order], np.asarray(self.ydata)[order])
         # return self.reverse_sigmoid(x, self.popt[0], self.popt[1])
         return self.asymmetrical_reverse_sigmoid(x, self.popt[0], self.popt[1], self.popt[2])
 
@@ -108,21 +172,17 @@ class Sample:
         return self.endpoint_titer
 
     def get_R2(self):
-        residuals = []
-        for i in range(0, len(self.ydata)):
-            # residuals.append(self.ydata[i] - self.reverse_sigmoid(self.xdata[i], self.popt[0], self.popt[1]))
-            residuals.append(self.ydata[i] - self.asymmetrical_reverse_sigmoid(self.xdata[i], self.popt[0], self.popt[1], self.popt[2]))
-        ss_res = np.sum([x**2 for x in residuals])
-        ss_tot = np.sum([(y-np.mean(self.ydata))**2 for y in self.ydata])
-        self.R2 = 1 - (ss_res/ss_tot)
-
-    def get_quality_vector(self):
+        diagnose_samples([self])
+
+    def get_quality_vector(self) -> float:
         # return math.sqrt(self.approximate(math.log(self.popt[0]))**2 + math.log(self.popt[0])**2 + self.R2**2)
+        # NaN without diagnostics, e.g. for a fit that has no midpoint
+        if self.diagnostics is None or self.R2 is None:
+            return math.nan
         mean_y = (min(self.ydata) + max(self.ydata)) / 2
-        x = self.revert_x_asymmetrical(mean_y)
+        x = self.diagnostics['midpoint']
         return math.sqrt(mean_y**2 + x**2 + self.R2**2)
 
-
     def __repr__(self):
         return f'Sample "{self.name}"\n' + \
                f'xdata: {self.xdata}\n' + \
@@ -134,51 +194,353 @@ class Sample:
 class AnalyticalGroup:
     def __init__(self, name: str, samples: list):
         self.name = name
-        self.samples = samples
+        # samples are kept in an insertion ordered dict and indexed by name, so membership, lookup and removal do not
+        # scan the group
+        self.sample_index = dict.fromkeys(samples)
+        self.sample_list = None
+        self.samples_by_name = dict()
+        for sample in self.sample_index:
+            self.samples_by_name.setdefault(sample.name, list()).append(sample)
         self.cutoff = None
+        # accuracy the cutoff was calculated at, membership changes refresh the cutoff with it
+        self.accuracy = None
         self.average_titer = None
+        # standard error of the average titer and its confidence interval (low, high), see update_average_titer()
+        self.average_titer_se = None
+        self.average_titer_ci = None
         self.outliers = list()
+        # running statistics of the negative control readings of all samples, and the sums of the titers that make up
+        # the average (sample -> (titer, error) it was counted with), both follow membership changes in O(1)
+        self.controls = RunningStats()
+        self.titer_sums = TiterSums()
+        self.titer_contributions = dict()
         self.negative_control_indices = list()
-
-    def add_sample(self, sample):
-        self.samples.append(sample)
-
-    def get_sample_by_name(self, name: str):
+        # fit all samples together with shared slope/asymmetry instead of one by one
+        self.joint_fit = False
+        # titers for every cutoff accuracy at once, see sweep_accuracies()
+        self.sweep = None
+        # fit every set of technical replicates once; sets are either declared (lists of samples) or detected from
+        # the sample names
+        self.collapse_replicates = False
+        self.replicate_sets = None
+        self.replicate_samples = None
+
+    @property
+    def samples(self) -> list:
+        # the list is rebuilt only after the membership has changed
+        if self.sample_list is None:
+            self.sample_list = list(self.sample_index)
+        return self.sample_list
+
+    @property
+    def negative_control_indices(self) -> list:
+        return self.control_indices
+
+    @negative_control_indices.setter
+    def negative_control_indices(self, indices: list):
+        self.control_indices = list(indices)
+        self.controls.clear()
         for sample in self.samples:
-            if sample.name == name:
-                return sample
+            self.controls.add(self.get_control_values(sample))
 
+    def add_negative_control(self, index: int):
+        # only the readings at the new index are added to the statistics
+        if index in self.control_indices:
+            return
+        self.control_indices.append(index)
+        self.controls.add([sample.ydata[index] for sample in self.samples if index < len(sample.ydata)])
 
-    def get_group_cutoff(self, accuracy: float):
-        min_ydata = []
-        for sample in self.samples:
-            for index in self.negative_control_indices:
-                min_ydata.append(sample.ydata[index])
+    def get_control_values(self, sample) -> list:
+        return [sample.ydata[index] for index in self.control_indices if index < len(sample.ydata)]
 
-        if len(min_ydata) > 1:
-            stdev = np.std(min_ydata)
-            mean = np.mean(min_ydata)
+    def has_sample(self, sample) -> bool:
+        return sample in self.sample_index
 
-            t = multipliers[accuracy][len(min_ydata)]
-            self.cutoff = mean + stdev*t
+    def add_sample(self, sample):
+        if sample in self.sample_index:
+            return
+        self.sample_index[sample] = None
+        self.sample_list = None
+        # the sweep is indexed by sample position, it has to be recomputed for the new sample list
+        self.sweep = None
+        self.samples_by_name.setdefault(sample.name, list()).append(sample)
+        self.controls.add(self.get_control_values(sample))
+        current = self.refresh_cutoff()
+        if self.collapse_replicates:
+            self.on_replicates_changed()
+        elif self.accuracy is None or self.cutoff is None:
+            self.mark_titers_stale()
+        elif not current:
+            # the controls of the new sample moved the cutoff
+            self.refresh_titers()
         else:
-            self.cutoff = min_ydata[0]
+            # the titer the sample brings along was calculated against the cutoff of its previous group
+            screen_samples([sample], self.cutoff)
+            if sample.qc_reason is None and not sample.is_fitted():
+                self.mark_titers_stale()
+                return
+            calculate_titers([sample], self.cutoff)
+            if sample.endpoint_titer is not None and not sample.bad_data:
+                self.count_titer(sample)
+            self.update_average_titer()
 
+    def get_sample_by_name(self, name: str):
+        samples = self.samples_by_name.get(name)
+        if samples:
+            return samples[0]
+
+    def rename_sample(self, sample, name: str):
+        self.samples_by_name[sample.name].remove(sample)
+        if len(self.samples_by_name[sample.name]) == 0:
+            del self.samples_by_name[sample.name]
+        sample.name = name
+        self.samples_by_name.setdefault(name, list()).append(sample)
+
+    def get_negative_control_values(self) -> list:
+        min_ydata = []
         for sample in self.samples:
-            sample.calculate_endpoint_titer(self.cutoff)
+            min_ydata += self.get_control_values(sample)
+        return min_ydata
+
+    def get_cutoffs(self, accuracies) -> np.ndarray:
+        # cutoffs at every accuracy from the running control statistics, NaN without negative controls
+        return cutoffs_from_stats(self.controls.count, self.controls.mean, self.controls.deviation(), accuracies)
+
+    def get_cutoff(self, accuracy: float) -> float | None:
+        cutoff = float(self.get_cutoffs(accuracy)[0])
+        return None if np.isnan(cutoff) else cutoff
+
+    def get_fit_samples(self) -> list:
+        # samples the curves are fitted to: one per replicate set when collapsing replicates
+        if self.collapse_replicates:
+            if self.replicate_samples is None:
+                self.build_replicate_samples()
+            return self.replicate_samples
+        return self.samples
+
+    def build_replicate_samples(self):
+        # aggregate the replicates of every set into one sample with the mean readings and their standard errors
+        if self.replicate_sets is not None:
+            positions = {sample: index for index, sample in enumerate(self.samples)}
+            sets = [[positions[sample] for sample in replicate_set if sample in positions]
+                    for replicate_set in self.replicate_sets]
+            declared = set(index for replicate_set in sets for index in replicate_set)
+            sets = [replicate_set for replicate_set in sets if len(replicate_set) > 0] + \
+                   [[index] for index in range(len(self.samples)) if index not in declared]
+        else:
+            sets = group_replicates([sample.name for sample in self.samples])
+
+        ydata, _ = to_matrix([sample.ydata for sample in self.samples])
+        labels = np.empty(len(self.samples), dtype=np.int64)
+        for set_index, replicate_set in enumerate(sets):
+            labels[replicate_set] = set_index
+        means, variances, counts = aggregate(ydata, labels, len(sets))
+        sigma = replicate_sigma(variances, counts)
+
+        self.replicate_samples = list()
+        for set_index, replicate_set in enumerate(sets):
+            first = self.samples[replicate_set[0]]
+            sample = Sample(first.name if len(replicate_set) == 1 else replicate_key(first.name),
+                            xdata=first.xdata, ydata=list(means[set_index]))
+            sample.replicates = [self.samples[index] for index in replicate_set]
+            if len(replicate_set) > 1:
+                sample.sigma = sigma[set_index]
+            sample.plate = first.plate
+            sample.group = self
+            self.replicate_samples.append(sample)
+        screen_samples(self.replicate_samples)
+
+    def share_replicate_results(self):
+        # replicates keep their own readings for QC, but take the fit and the titer of their set; both are assigned on
+        # every run, so a replicate follows its set back out of bad data
+        if not self.collapse_replicates or self.replicate_samples is None:
+            return
+        for replicate_sample in self.replicate_samples:
+            for sample in replicate_sample.replicates:
+                sample.popt, sample.pcov = replicate_sample.popt, replicate_sample.pcov
+                sample.fit_status, sample.fit_note = replicate_sample.fit_status, replicate_sample.fit_note
+                sample.endpoint_titer, sample.titer_se = replicate_sample.endpoint_titer, replicate_sample.titer_se
+                sample.bad_data = replicate_sample.bad_data
+                sample.triage_borderline = replicate_sample.triage_borderline
+        diagnose_samples(self.samples)
+
+    def restore_replicate_results(self):
+        # the reverse of share_replicate_results() for restored sessions: the replicates hold the results of their set,
+        # the set samples are aggregated again and take them back
+        self.replicate_samples = None
+        for replicate_sample in self.get_fit_samples():
+            first = replicate_sample.replicates[0]
+            replicate_sample.popt, replicate_sample.pcov = first.popt, first.pcov
+            replicate_sample.fit_status, replicate_sample.fit_note = first.fit_status, first.fit_note
+            replicate_sample.endpoint_titer, replicate_sample.titer_se = first.endpoint_titer, first.titer_se
+            replicate_sample.bad_data = first.bad_data
+        diagnose_samples(self.replicate_samples)
+
+    def get_group_cutoff(self, accuracy: float, budget: FitBudget | None = None):
+        # negative controls always come from the raw readings of every sample
+        self.accuracy = accuracy
+        self.cutoff = self.get_cutoff(accuracy)
+        if self.cutoff is None:
+            print(f'{self.name}: no negative control readings, endpoint titers cannot be calculated')
+            for sample in self.samples + self.get_fit_samples():
+                sample.endpoint_titer = None
+            return
+
+        # reject flat, saturated, non-monotonic and below-cutoff samples before fitting them
+        samples = self.get_fit_samples()
+        screen_samples(samples, self.cutoff)
+        refit = True
+        if self.joint_fit:
+            refit = not self.fit_jointly(budget)
+        if refit:
+            for sample in samples:
+                sample.get_popt_pcov(budget)
+        calculate_titers(samples, self.cutoff)
+        self.share_replicate_results()
+
+    def fit_jointly(self, budget: FitBudget | None = None) -> bool:
+        # returns False if the joint fit failed and samples have to be fitted one by one
+        samples = [sample for sample in self.get_fit_samples() if sample.qc_reason is None]
+        if len(samples) == 0:
+            return True
+        if budget is not None and budget.run_exhausted():
+            return False
+        try:
+            popt, pcov = fit_joint_sigmoid([sample.xdata for sample in samples], [sample.ydata for sample in samples],
+                                           budget, [sample.sigma for sample in samples])
+        except (BudgetExceeded, RuntimeError, ValueError, np.linalg.LinAlgError) as error:
+            print(f'{self.name}: joint fit failed ({error}), fitting samples one by one')
+            return False
+        print(f'{self.name}: joint fit a={popt[0][0]}, c={popt[0][2]}')
+        for sample, sample_popt, sample_pcov in zip(samples, popt, pcov):
+            sample.popt, sample.pcov = sample_popt, sample_pcov
+            sample.fit_status, sample.fit_note, sample.stale = FITTED, 'joint', False
+        return True
+
+    def sweep_accuracies(self, accuracies: list, budget: FitBudget | None = None):
+        """
+        Calculate cutoffs, endpoint titers, bad data flags and average titers for every accuracy in one pass.
+        Samples are fitted only if they do not have a fit yet, the titers for all accuracies are then obtained with
+        one vectorized inversion of the fitted curves. Results are stored in `self.sweep`, use apply_sweep() to make
+        one of the accuracies current. With collapsed replicates the sweep covers the replicate sets.
+        """
+        # shape checks do not depend on the cutoff, below-cutoff is decided per accuracy below
+        samples = self.get_fit_samples()
+        screen_samples(samples)
+        unfitted = [sample for sample in samples
+                    if sample.qc_reason is None and (sample.stale or not sample.is_fitted())]
+        if len(unfitted) > 0 and (not self.joint_fit or not self.fit_jointly(budget)):
+            for sample in unfitted:
+                sample.get_popt_pcov(budget)
+
+        cutoffs = self.get_cutoffs(accuracies)
+
+        # one pass of the titer stage per accuracy, the curves are gathered once
+        readings, xdata, lo, hi, popt, pcov, interpolated = curve_arrays(samples)
+        passed = np.array([sample.qc_reason in (None, BELOW_CUTOFF) for sample in samples])
+        titers = np.empty((len(samples), len(cutoffs)))
+        errors = np.empty_like(titers)
+        below_cutoff = np.empty(titers.shape, dtype=bool)
+        for index, cutoff in enumerate(cutoffs):
+            titers[:, index], errors[:, index], below_cutoff[:, index] = curve_titers(
+                readings, xdata, np.full(len(samples), cutoff), lo, hi, popt, pcov, interpolated, passed)
+        bad_data = ~passed[:, None] | below_cutoff
+        with np.errstate(invalid='ignore'):
+            good_counts = np.sum(~bad_data, axis=0)
+            average_titers = np.where(good_counts > 0, np.nansum(titers, axis=0) / good_counts, np.nan)
+
+        self.sweep = {
+            'accuracies': list(accuracies),
+            'names': [sample.name for sample in samples],
+            'cutoffs': cutoffs,
+            'titers': titers,
+            'titer_se': errors,
+            'bad_data': bad_data,
+            'below_cutoff': below_cutoff,
+            'average_titers': average_titers,
+        }
+
+    def apply_sweep(self, accuracy: float):
+        # make the swept results for the accuracy current, no fitting involved
+        index = self.sweep['accuracies'].index(accuracy)
+        cutoff = self.sweep['cutoffs'][index]
+        self.accuracy = accuracy
+        self.cutoff = None if np.isnan(cutoff) else float(cutoff)
+        for sample_index, sample in enumerate(self.get_fit_samples()):
+            if sample.qc_reason in (None, BELOW_CUTOFF):
+                sample.qc_reason = BELOW_CUTOFF if self.sweep['below_cutoff'][sample_index, index] else None
+            sample.bad_data = bool(self.sweep['bad_data'][sample_index, index])
+            titer = self.sweep['titers'][sample_index, index]
+            error = self.sweep['titer_se'][sample_index, index]
+            sample.endpoint_titer = None if np.isnan(titer) else float(titer)
+            sample.titer_se = None if np.isnan(error) else float(error)
+        self.share_replicate_results()
+        self.calculate_average_titer()
 
     def calculate_average_titer(self):
-        titers = []
-        for sample in self.samples:
-            endpoint_titer = sample.get_endpoint_titer()
-            if endpoint_titer is not None:
-                titers.append(endpoint_titer)
-        self.average_titer = sum(titers)/len(titers)
+        # rebuild the sums from the titers and errors the samples have, membership changes update them from then on
+        self.titer_sums.clear()
+        self.titer_contributions.clear()
+        for sample in self.get_fit_samples():
+            if sample.get_endpoint_titer() is not None:
+                self.count_titer(sample)
+        self.update_average_titer()
+
+    def count_titer(self, sample):
+        contribution = (sample.endpoint_titer, sample.titer_se)
+        self.titer_sums.add(*contribution)
+        self.titer_contributions[sample] = contribution
+
+    def update_average_titer(self):
+        # average, its standard error and confidence interval from the titer sums, None for a group without titers
+        self.average_titer = self.titer_sums.mean()
+        self.average_titer_se = self.titer_sums.standard_error()
+        self.average_titer_ci = self.titer_sums.confidence_interval()
+
+    def refresh_cutoff(self) -> bool:
+        # the negative controls follow the membership and so does the cutoff; returns whether the titers were
+        # calculated against the cutoff that is current now
+        if self.accuracy is None:
+            return False
+        cutoff = self.get_cutoff(self.accuracy)
+        if cutoff == self.cutoff:
+            return True
+        self.cutoff = cutoff
+        return False
+
+    def refresh_titers(self):
+        # titers of all samples against the moved cutoff, read off the fits they have in one pass of the titer stage;
+        # nothing is refitted, a sample that has no fit yet leaves the average unknown until it is fitted
+        samples = self.get_fit_samples()
+        screen_samples(samples, self.cutoff)
+        if any(sample.qc_reason is None and not sample.is_fitted() for sample in samples):
+            self.mark_titers_stale()
+            return
+        calculate_titers(samples, self.cutoff)
+        self.calculate_average_titer()
+
+    def mark_titers_stale(self):
+        # the titers no longer match the cutoff, the average is unknown until they are calculated again
+        self.titer_sums.clear()
+        self.titer_contributions.clear()
+        self.update_average_titer()
+
+    def on_replicates_changed(self):
+        # replicate sets have to be aggregated and fitted again, the average is unknown until then
+        self.replicate_samples = None
+        self.mark_titers_stale()
 
     def detect_outliers(self):
         group_vectors = {}
-        for sample in self.samples:
-            group_vectors[sample.name] = sample.get_quality_vector()
+        for sample in self.get_fit_samples():
+            if sample.is_fitted():
+                vector = sample.get_quality_vector()
+                # a NaN vector would turn the percentiles of the whole group into NaN
+                if math.isfinite(vector):
+                    group_vectors[sample.name] = vector
+        if len(group_vectors) == 0:
+            self.outliers = list()
+            return
 
         outliers = detect_outlier(group_vectors.values(), 30, 70)
         keys = []
@@ -191,13 +553,12 @@ class AnalyticalGroup:
     def plot_samples_data(self, folder_name=None, with_outliers=False):
         fig, ax = plt.subplots()
 
-        colors_set = random.sample(colors, len(self.samples))
-        markers_set = random.sample(markers, len(self.samples))
+        samples = [sample for sample in self.get_fit_samples() if sample.is_fitted()]
+        colors_set = random.sample(colors, len(samples))
+        markers_set = random.sample(markers, len(samples))
         index = 0
-        samples = self.samples
         if with_outliers:
-            for outlier in self.outliers:
-                samples.remove(self.get_sample_by_name(outlier))
+            samples = [sample for sample in samples if sample.name not in self.outliers]
         for sample in samples:
             point_count = 80
             x_step = (sample.xdata[-1] - sample.xdata[0]) / float(point_count)
@@ -208,6 +569,9 @@ class AnalyticalGroup:
 
             plt.scatter(sample.xdata, sample.ydata, marker=markers_set[index],
                         color=colors_set[index], label=f'{sample.name} R^2={sample.R2:.3f}')
+            if sample.sigma is not None:
+                # replicate means, show their standard errors
+                plt.errorbar(sample.xdata, sample.ydata, yerr=sample.sigma, linestyle='none', color=colors_set[index])
             plt.plot(interpolated_x, approximate_y, linestyle='-', color=colors_set[index])
             index += 1
 
@@ -233,8 +597,24 @@ class AnalyticalGroup:
 
     def remove_sample(self, sample: Sample):
         assert sample.group == self
-        self.samples.remove(sample)
+        del self.sample_index[sample]
+        self.sample_list = None
+        self.sweep = None
+        self.samples_by_name[sample.name].remove(sample)
+        if len(self.samples_by_name[sample.name]) == 0:
+            del self.samples_by_name[sample.name]
         sample.group = None
+        self.controls.remove(self.get_control_values(sample))
+        current = self.refresh_cutoff()
+        if self.collapse_replicates:
+            self.on_replicates_changed()
+        elif self.accuracy is None or self.cutoff is None:
+            self.mark_titers_stale()
+        elif not current:
+            self.refresh_titers()
+        elif sample in self.titer_contributions:
+            self.titer_sums.remove(*self.titer_contributions.pop(sample))
+            self.update_average_titer()
 
     def __repr__(self):
         return f'AnalyticalGroup "{self.name}"\n' + \
@@ -277,6 +657,56 @@ def get_dilutions():
     return dilutions
 
 
+def curve_arrays(samples: list) -> tuple:
+    # (readings, xdata, lo, hi, popt, pcov, interpolated) of the samples for the array code, NaN where there is no fit
+    readings, _ = to_matrix([sample.ydata for sample in samples])
+    xdata, _ = to_matrix([sample.xdata for sample in samples])
+    popt = np.array([sample.popt if sample.popt is not None else [np.nan] * 3 for sample in samples], dtype=float)
+    pcov = np.array([sample.pcov if sample.popt is not None else np.full((3, 3), np.nan) for sample in samples],
+                    dtype=float)
+    interpolated = np.array([sample.popt is None and sample.is_fitted() for sample in samples])
+    lo = np.array([min(sample.ydata) for sample in samples], dtype=float)
+    hi = np.array([max(sample.ydata) for sample in samples], dtype=float)
+    return readings, xdata, lo, hi, popt, pcov, interpolated
+
+
+def calculate_titers(samples: list, cutoffs):
+    # endpoint titers, their errors and bad data flags of the fitted samples from the titer stage of the array core;
+    # samples that failed QC and stale samples get no titer, samples staying below the cutoff are flagged as such
+    if len(samples) == 0:
+        return
+    readings, xdata, lo, hi, popt, pcov, interpolated = curve_arrays(samples)
+    passed = np.array([sample.qc_reason in (None, BELOW_CUTOFF) and not sample.stale for sample in samples])
+    cutoffs = np.broadcast_to(np.asarray(cutoffs, dtype=float), (len(samples),))
+    titers, errors, below_cutoff = curve_titers(readings, xdata, cutoffs, lo, hi, popt, pcov, interpolated, passed)
+    for sample, titer, error, below in zip(samples, titers, errors, below_cutoff):
+        if below:
+            sample.qc_reason = BELOW_CUTOFF
+            print(f'Sample {sample.name} has a bad data for this cutoff and will not be included in calculations!'
+                  f' Try to lower calculation accuracy.')
+        elif sample.qc_reason == BELOW_CUTOFF:
+            sample.qc_reason = None
+        sample.bad_data = sample.qc_reason is not None
+        sample.endpoint_titer = None if np.isnan(titer) else float(titer)
+        sample.titer_se = None if np.isnan(error) else float(error)
+
+
+def diagnose_samples(samples: list):
+    # R² and the other fit diagnostics of all samples at once, cached on the samples
+    if len(samples) == 0:
+        return
+    readings, xdata, lo, hi, popt, _, interpolated = curve_arrays(samples)
+    parameter_counts = np.array([2 if sample.fit_status == SYMMETRIC else 3 for sample in samples])
+    diagnostics, residuals = diagnose(readings, xdata, lo, hi, popt, interpolated, parameter_counts)
+    for index, sample in enumerate(samples):
+        if sample.is_fitted():
+            sample.diagnostics = diagnostics[index]
+            sample.residuals = residuals[index, :len(sample.ydata)]
+            sample.R2 = float(diagnostics['r2'][index])
+        else:
+            sample.diagnostics, sample.residuals, sample.R2 = None, None, None
+
+
 # find outliers in dataset
 def detect_outlier(data: list, q1: int, q2: int):
     # find q1 and q3 values
@@ -294,27 +724,20 @@ def detect_outlier(data: list, q1: int, q2: int):
 
 # build test graph for debugging
 def build_common_plot(groups: list, folder_name=None):
-    data = []
-    for group in groups:
-        for sample in group.samples:
-            if not sample.bad_data:
-                a=[group.name, "%.0f" % sample.get_endpoint_titer(), sample.name]
-                data.append(a)
-    df = pd.DataFrame(np.array(data), columns=['Group', 'Titer', 'Sample'])
-    df['Titer'] = df['Titer'].astype(np.int64)
-    df_sorted = df.sort_values(['Titer', 'Group'])
-    print(df_sorted)
+    # the table and the plot use the same samples: every sample with a titer that is not bad data
+    table = results_table(groups)
+    summary = summarize(table, len(groups))
+    print_summary(groups, table)
     plt.figure(figsize=(8, 6), dpi=80)
     group_offset = 1
     sample_offset = 0.001
     colors_set = random.sample(colors, len(groups))
-    for group_index in range(len(groups)):
+    for group_index, ydata in enumerate(group_titers(table, len(groups))):
         group = groups[group_index]
-        ydata = [sample.get_endpoint_titer() for sample in group.samples]
-        fake_xdata = [group_offset*group_index + sample_index*sample_offset for sample_index in range(len(group.samples))]
+        fake_xdata = group_offset*group_index + np.arange(len(ydata))*sample_offset
         plt.scatter(fake_xdata, ydata, label=f'{group.name}', s=20, color=colors_set[group_index])
         # draw mean value as a separate scatter (with 1 element)
-        mean_y = np.mean(ydata)
+        mean_y = summary['mean'][group_index]
         plt.scatter([group_offset*group_index], [mean_y], label=f'mean: {mean_y:.2f}', marker='_', s=400, color=colors_set[group_index])
 
     # for i in range(len(df['Group'].unique())-1):
@@ -342,8 +765,9 @@ for i in range(1, 13):
 def write_data_to_csv(groups: list, folder_name=None, accuracy: float = cutoff_multiplier_accuracies[0]):
     with open(f'{folder_name}/data.csv', 'w', encoding='UTF8', newline='') as f:
         writer = csv.writer(f)
+        summary = group_summary_rows(groups, results_table(groups))
 
-        for group in groups:
+        for group_index, group in enumerate(groups):
             writer.writerow(['Group'])
             writer.writerow([group.name])
             writer.writerow([' '])
@@ -353,6 +777,12 @@ def write_data_to_csv(groups: list, folder_name=None, accuracy: float = cutoff_m
             writer.writerow(['Endpoint Titer'])
             print(f'{group.average_titer=}')
             writer.writerow([group.average_titer])
+            level = f'{confidence_level * 100:g}%'
+            writer.writerow(['Standard Error', f'{level} CI Low', f'{level} CI High'])
+            writer.writerow([group.average_titer_se] + list(group.average_titer_ci or ['', '']))
+            writer.writerow(SUMMARY_COLUMNS)
+            writer.writerow(['' if value is None or isinstance(value, float) and np.isnan(value) else value
+                             for value in summary[group_index]])
             writer.writerow([' '])
             writer.writerow(['Calculation Accuracy'])
             writer.writerow([f'{accuracy}'])
@@ -361,23 +791,50 @@ def write_data_to_csv(groups: list, folder_name=None, accuracy: float = cutoff_m
                 writer.writerow([group.samples[0].xdata[i]] + [s.ydata[i] for s in group.samples if not s.bad_data])
             writer.writerow(['Endpoint titer'] + [s.endpoint_titer for s in group.samples if s not in group.outliers
                                                 and not s.bad_data])
+            writer.writerow(['Titer SE'] + ['' if s.titer_se is None else s.titer_se for s in group.samples
+                                           if s not in group.outliers and not s.bad_data])
+            # fit diagnostics, in the columns of the readings above
+            for label, name in [('R2', 'r2'), ('Adjusted R2', 'adjusted_r2'), ('RMSE', 'rmse'),
+                                ('Durbin-Watson', 'durbin_watson'), ('Rises', 'rises')]:
+                writer.writerow([label] + ['' if s.diagnostics is None or np.isnan(s.diagnostics[name])
+                                           else s.diagnostics[name] for s in group.samples if not s.bad_data])
+            writer.writerow(['Lack of fit'] + ['yes' if s.diagnostics is not None and lacks_fit(s.diagnostics) else ''
+                                               for s in group.samples if not s.bad_data])
+            writer.writerow(['Triage'] + [triage_flag(s) for s in group.samples if not s.bad_data])
+            if group.sweep is not None:
+                # sample x accuracy matrix, empty cells are bad data for that accuracy
+                columns, rows = sweep_table(group)
+                writer.writerow(['Accuracy sweep'] + columns[1:])
+                for row in rows:
+                    writer.writerow(['' if value is None else value for value in row])
             writer.writerow(['*'*20])
 
 
-def load_plate_data(file_path) -> pd.DataFrame:
+def read_plate_data(file_path) -> list:
     # get active sheet
     wb_obj = openpyxl.load_workbook(file_path)
     sheet = wb_obj.active
 
-    # filter and transform data to dataframe
+    # filter data rows, a single unnamed plate block with one read in terms of the workbook cache
     rows = []
     for row in sheet.iter_rows(1, sheet.max_row):
         if row[0].value in letters:
-            rows.append([x.value for x in row[1:]])
+            rows.append([float(x.value) if isinstance(x.value, (int, float)) else math.nan for x in row[1:13]])
+    return [(None, [rows], [], [None])]
+
+
+def load_plate_data(file_path) -> pd.DataFrame:
+    _, (rows,), _, _ = workbook_cache.parse(file_path, 'grid', read_plate_data)[0]
     return pd.DataFrame(rows, index=letters, columns=[x for x in range(1, 13)])
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Calculate endpoint titers of a plate')
+    parser.add_argument('xlsx_path', help='xlsx file with the plate data')
+    parser.add_argument('--sample-seconds', type=float, default=SAMPLE_SECONDS, help='time limit of a single fit')
+    args = parser.parse_args()
+    budget = FitBudget(sample_seconds=args.sample_seconds)
+
     # create folder for results storing
     current_directory = os.getcwd()
     final_directory_name = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
@@ -386,7 +843,7 @@ def main():
         os.makedirs(final_directory)
 
     # get xlsx file with data and check if it is exist
-    xlsx_path = sys.argv[1]
+    xlsx_path = args.xlsx_path
     if os.path.exists(xlsx_path):
         xlsx_file = Path(xlsx_path)
     else:
@@ -425,11 +882,14 @@ def main():
             if index.startswith(last_column_letter):
                 # this entry was last, flush all accumulated ydata into new sample
                 current_sample = Sample(f'sample {len(samples) + 1}', xdata=dilutions, ydata=current_sample_ydata)
-                current_sample.get_popt_pcov()
-                current_sample.get_R2()
                 samples.append(current_sample)
                 current_sample_ydata = []
 
+        # rejected samples are not passed to the solver, as in the GUI
+        screen_samples(samples)
+        for sample in samples:
+            sample.get_popt_pcov(budget)
+        diagnose_samples(samples)
         group = AnalyticalGroup(f'group {len(sample_groups) + 1}', samples)
         sample_groups.append(group)
         samples_dict[group] = [samples]
@@ -439,11 +899,13 @@ def main():
         group.plot_samples_data(folder_name=final_directory)
         if group.outliers:
             group.plot_samples_data(folder_name=final_directory, with_outliers=True)
-        group.get_group_cutoff(99.0)
+        group.get_group_cutoff(99.0, budget)
         group.calculate_average_titer()
 
     build_common_plot(sample_groups, folder_name=final_directory)
     write_data_to_csv(sample_groups, folder_name=final_directory)
+    write_report(sample_groups, f'{final_directory}/report.pdf', 99.0)
+    write_xlsx(sample_groups, f'{final_directory}/results.xlsx', 99.0)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,118 @@
+import numpy as np
+from scipy.optimize import least_squares
+from scipy.sparse import csr_matrix
+
+from fit_budget import FitBudget, counted_model
+from sigmoid import asymmetrical_reverse_sigmoid, asymmetrical_reverse_sigmoid_gradient
+from triage import interpolate_crossings
+
+
+# bounds of the shared slope (per log10 dilution) and asymmetry: beyond them a steep slope and a vanishing asymmetry
+# trade off against each other along a flat ridge of the model, a step within one dilution interval that no dilution
+# series resolves, and the shared shape collapses onto it
+slope_bounds = (0.1, 10.)
+asymmetry_bounds = (0.1, 10.)
+
+
+def fit_joint_sigmoid(xdata: list, ydata: list, budget: FitBudget | None = None, sigma: list | None = None):
+    """
+    Fit the asymmetrical reverse sigmoid to a set of samples as a single least-squares problem.
+
+    Slope (a) and asymmetry (c) are shared by all samples, every sample keeps its own midpoint (b). Every residual
+    depends on the two shared parameters and on its own midpoint only, so the Jacobian is passed to the solver as a
+    sparse matrix with three non-zero entries per row.
+
+    The shared parameters are bounded by slope_bounds and asymmetry_bounds, the solver starts from a symmetric curve
+    with every midpoint where the data crosses the middle of its range. `sigma` optionally has the per-point errors
+    of every sample (None for unweighted samples), the residuals are weighted with them as in curve_fit.
+
+    The solver gets the per-sample limits of `budget` for all points together, cut down to what is left of the run;
+    every residual and Jacobian evaluation is charged to the run, BudgetExceeded is raised when a limit is hit.
+
+    Returns per-sample `popt` with shape (n, 3) and `pcov` with shape (n, 3, 3), both in the (a, b, c) order used by
+    Sample.get_popt_pcov().
+    """
+    sample_count = len(ydata)
+    lengths = [len(y) for y in ydata]
+    index = np.repeat(np.arange(sample_count), lengths)
+    x = np.concatenate([np.asarray(sample_x, dtype=float)[:length] for sample_x, length in zip(xdata, lengths)])
+    y = np.concatenate([np.asarray(sample_y, dtype=float) for sample_y in ydata])
+
+    # model bounds are taken from the data in the same way the per-sample fit does
+    lo = np.array([np.min(sample_y) for sample_y in ydata])[index]
+    hi = np.array([np.max(sample_y) for sample_y in ydata])[index]
+
+    weights = np.concatenate([np.ones(length) if sample_sigma is None else 1 / np.asarray(sample_sigma, dtype=float)
+                              for sample_sigma, length in zip(sigma or [None] * sample_count, lengths)])
+
+    # parameters vector layout: [a, c, b_0, ..., b_{n-1}]
+    def residuals(p):
+        return (asymmetrical_reverse_sigmoid(x, lo, hi, p[0], p[2:][index], p[1]) - y) * weights
+
+    indices = np.column_stack([np.zeros_like(index), np.ones_like(index), index + 2]).ravel()
+    indptr = np.arange(0, 3 * len(y) + 1, 3)
+
+    def jacobian(p):
+        da, db, dc = asymmetrical_reverse_sigmoid_gradient(x, lo, hi, p[0], p[2:][index], p[1])
+        return csr_matrix((np.column_stack([da, dc, db]).ravel() * np.repeat(weights, 3), indices, indptr),
+                          shape=(len(y), sample_count + 2))
+
+    if budget is None:
+        budget = FitBudget()
+    max_nfev, deadline = budget.sample_limits(len(y))
+    evaluations = [0]
+    p0 = np.concatenate([[1., 1.], _midpoints(xdata, ydata, lengths)])
+    lower = np.concatenate([[slope_bounds[0], asymmetry_bounds[0]], np.full(sample_count, -np.inf)])
+    upper = np.concatenate([[slope_bounds[1], asymmetry_bounds[1]], np.full(sample_count, np.inf)])
+    try:
+        result = least_squares(counted_model(residuals, max_nfev, deadline, evaluations), p0,
+                               jac=counted_model(jacobian, max_nfev, deadline, evaluations), bounds=(lower, upper),
+                               method='trf', tr_solver='lsmr', x_scale='jac', max_nfev=max_nfev)
+    finally:
+        budget.run_nfev_used += evaluations[0]
+
+    a, c, b = result.x[0], result.x[1], result.x[2:]
+    popt = np.column_stack([np.full(sample_count, a), b, np.full(sample_count, c)])
+    pcov = _joint_covariance(result.x, result.fun, x, lo, hi, weights, index, sample_count)
+    return popt, pcov
+
+
+def _midpoints(xdata: list, ydata: list, lengths: list) -> np.ndarray:
+    # where every sample crosses the middle of its range, the midpoint of a symmetric curve
+    width = max(lengths)
+    x = np.full((len(ydata), width), np.nan)
+    y = np.full((len(ydata), width), np.nan)
+    for row, (sample_x, sample_y, length) in enumerate(zip(xdata, ydata, lengths)):
+        x[row, :length], y[row, :length] = sample_x[:length], sample_y
+    middles = (np.nanmin(y, axis=1) + np.nanmax(y, axis=1)) / 2
+    return interpolate_crossings(x, y, middles)[0]
+
+
+def _joint_covariance(p, fun, x, lo, hi, weights, index, sample_count):
+    # J^T J has a 2x2 block for the shared parameters, a 2xn coupling block and a diagonal block for the midpoints,
+    # so it is inverted through the Schur complement of the diagonal block instead of as a dense matrix
+    da, db, dc = (gradient * weights for gradient in
+                  asymmetrical_reverse_sigmoid_gradient(x, lo, hi, p[0], p[2:][index], p[1]))
+    shared = np.column_stack([da, dc])
+    a_block = shared.T @ shared
+    b_block = np.vstack([np.bincount(index, weights=da * db, minlength=sample_count),
+                         np.bincount(index, weights=dc * db, minlength=sample_count)])
+    d_block = np.bincount(index, weights=db * db, minlength=sample_count)
+
+    degrees_of_freedom = len(fun) - len(p)
+    s_sq = np.sum(fun ** 2) / degrees_of_freedom if degrees_of_freedom > 0 else np.inf
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b_scaled = b_block / d_block
+        schur_inv = np.linalg.pinv(a_block - b_scaled @ b_block.T)
+        shared_b = -schur_inv @ b_scaled
+        var_b = 1 / d_block + np.einsum('in,ij,jn->n', b_scaled, schur_inv, b_scaled)
+
+    pcov = np.empty((sample_count, 3, 3))
+    pcov[:, 0, 0] = schur_inv[0, 0]
+    pcov[:, 2, 2] = schur_inv[1, 1]
+    pcov[:, 0, 2] = pcov[:, 2, 0] = schur_inv[0, 1]
+    pcov[:, 1, 1] = var_b
+    pcov[:, 0, 1] = pcov[:, 1, 0] = shared_b[0]
+    pcov[:, 2, 1] = pcov[:, 1, 2] = shared_b[1]
+    return pcov * s_sq
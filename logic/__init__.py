@@ -1,10 +1,18 @@
-import openpyxl
 from PySide6.QtWidgets import QFileDialog
-from numpy import float64
 
 from immuno_calculator import AnalyticalGroup, build_common_plot, cutoff_multiplier_accuracies, write_data_to_csv, \
-    letters, load_plate_data
+    letters, load_plate_data, diagnose_samples
 from logic.plate import Plate
+from logic.session import save_session, load_session
+from logic.live_refit import PlateRefitter
+from logic.plate_loader import PlateLoader
+from qc import screen_samples
+from plate_reader import load_plate_blocks
+from fit_budget import FitBudget
+from triage import triage_groups
+from logic.report_writer import ReportWriter
+from report import prepare_report
+from xlsx_export import write_xlsx
 
 
 class Logic:
@@ -13,6 +21,29 @@ class Logic:
         self.plates = list()
         self.groups = list()
         self.cutoff_multiplier_accuracy = cutoff_multiplier_accuracies[0]
+        self.joint_fit = False
+        # calculate titers for all cutoff accuracies at once
+        self.accuracy_sweep = False
+        # estimate titers by interpolating the raw data, fit only borderline samples
+        self.triage = False
+        # fit every set of technical replicates once
+        self.collapse_replicates = False
+        # refit a plate in the background while its dilutions are edited
+        self.live_preview = False
+        # the refit budget and the 20 ms debounce of the plate widget keep a preview within 100 ms of the last edit
+        self.live_preview_seconds = 0.08
+        self.plate_refitter = None
+        # reports are rendered on the thread pool, see save_results()
+        self.report_writer = None
+        # workbooks are parsed on worker processes, see load_plate_files()
+        self.plate_loader = None
+        self.load_errors = list()
+        # per-sample and per-run limits for the sigmoid fits
+        self.fit_budget = FitBudget()
+        # indexes kept up to date by the ui, so grouping and marking touch only the affected samples
+        self.sample_widgets = dict()
+        self.sample_positions = dict()
+        self.selection = dict()
 
     # deprecated - use load_plates() instead
     def load_plate(self, file_path: str):
@@ -43,128 +74,223 @@ class Logic:
         self.ui.add_plate(plate)
 
     def load_plates(self, file_path: str):
-        def row_is_empty(row) -> bool:
-            # 0 cells or all cells are empty
-            if len(row) == 0:
-                return True
-            for cell in row:
-                if cell.value is not None:
-                    return False
-            return True
-        def row_contains_plate_name(row) -> bool:
-            # 2 or more cells, cell #1 contains text, all the rest are empty
-            if len(row) < 2:
-                return False
-            if row[1].value is None:
-                return False
-            other_values = [row[i].value for i in range(len(row)) if i != 1]
-            for other_value in other_values:
-                if other_value is not None:
-                    return False
-            return True
-        def get_plate_name(row) -> str:
-            return row[1].value
-        def row_contains_data(row) -> bool:
-            # cell #0 contains a letter
-            if len(row) == 0:
-                return False
-            return row[0].value in letters
-        def get_row_data(row) -> list:
-            # collect values starting from cell #1 until first empty cell
-            values = list()
-            for i in range(1, len(row)):
-                if row[i].value is not None:
-                    values.append(float64(row[i].value))
-                else:
-                    break
-            return values
-        def row_contains_sample_names(row) -> bool:
-            # cell #0 is empty, all the rest are not (at least two)
-            if row[0].value is not None:
-                return False
-            other_values = [row[i].value for i in range(1, len(row))]
-            non_empty_value_count = 0
-            for value in other_values:
-                if value is not None:
-                    non_empty_value_count += 1
-            return non_empty_value_count >= 2
-        def get_sample_names(row) -> list:
-            # collect values starting from cell #1 until first empty cell
-            names = list()
-            for i in range(1, len(row)):
-                if row[i].value is not None:
-                    names.append(row[i].value)
-                else:
-                    break
-            return names
-
-        wb_obj = openpyxl.load_workbook(file_path)
-        sheet = wb_obj.active
-
-        new_plates = list()
-        current_plate_name = None
-        current_plate_rows = None
-        current_plate_sample_names = None
-
-        for row in sheet.iter_rows():
-            if row_is_empty(row):
-                continue
-            if row_contains_plate_name(row):
-                if current_plate_name is None:
-                    current_plate_name = get_plate_name(row)
-                continue
-            if row_contains_data(row):
-                if current_plate_rows is None:
-                    current_plate_rows = list()
-                current_plate_rows.append(get_row_data(row))
-                continue
-            if row_contains_sample_names(row) and current_plate_rows is not None:
-                current_plate_sample_names = get_sample_names(row)
-
-                new_plate = Plate(file_path, current_plate_name, current_plate_rows, current_plate_sample_names)
-                new_plates.append(new_plate)
-                current_plate_name = None
-                current_plate_rows = None
-                current_plate_sample_names = None
-
-        for plate in new_plates:
+        # parsed plate blocks are cached, so a workbook opened before is not parsed by openpyxl again
+        self.add_plate_blocks(file_path, load_plate_blocks(file_path))
+
+    def add_plate_blocks(self, file_path: str, blocks: list):
+        for name, rows, sample_names in blocks:
+            plate = Plate(file_path, name, rows, sample_names)
             self.plates.append(plate)
             self.ui.add_plate(plate)
 
+    def load_plate_files(self, file_paths: list):
+        # parse the workbooks concurrently, plates are added in the order of the files as they become available
+        if self.plate_loader is None:
+            self.plate_loader = PlateLoader()
+            self.plate_loader.file_loaded.connect(self.on_plate_file_loaded)
+            self.plate_loader.file_failed.connect(self.on_plate_file_failed)
+            self.plate_loader.progress.connect(self.ui.show_load_progress)
+            self.plate_loader.finished.connect(self.on_plate_files_loaded)
+        if not self.plate_loader.is_loading():
+            self.load_errors = list()
+        self.plate_loader.load(file_paths)
+
+    def on_plate_file_loaded(self, index: int, file_path: str, blocks: list):
+        self.add_plate_blocks(file_path, blocks)
+
+    def on_plate_file_failed(self, index: int, file_path: str, message: str):
+        print(f'Could not load {file_path}: {message}')
+        self.load_errors.append((file_path, message))
+
+    def on_plate_files_loaded(self):
+        if len(self.load_errors) > 0:
+            self.ui.show_load_errors(self.load_errors)
+
     def create_group(self, name: str, samples: list):
         group = AnalyticalGroup(name, samples)
+        group.joint_fit = self.joint_fit
+        group.collapse_replicates = self.collapse_replicates
         self.groups.append(group)
 
         # inform samples about group they now belong to
         for sample in samples:
+            if sample.group is not None and sample.group is not group:
+                sample.group.remove_sample(sample)
             sample.group = group
 
         self.ui.on_group_added(group)
 
+    def register_sample_widgets(self, widgets: list):
+        # remember the widget of every sample and its position across all plates
+        for widget in widgets:
+            if widget.data is not None:
+                self.sample_widgets[widget.data] = widget
+                self.sample_positions[widget.data] = len(self.sample_positions)
+
+    def clear_sample_widgets(self):
+        self.sample_widgets.clear()
+        self.sample_positions.clear()
+        self.selection.clear()
+
+    def set_selected(self, sample, selected: bool):
+        if selected:
+            self.selection[sample] = None
+        else:
+            self.selection.pop(sample, None)
+
+    def take_selection(self) -> list:
+        # selected samples in plate order, the selection is cleared
+        samples = sorted(self.selection, key=self.sample_positions.__getitem__)
+        self.selection.clear()
+        return samples
+
+    def rename_sample(self, sample, name: str):
+        if sample.group is not None:
+            sample.group.rename_sample(sample, name)
+        else:
+            sample.name = name
+
+    def mark_negative_control(self, group: AnalyticalGroup, index: int):
+        group.add_negative_control(index)
+        self.ui.update_negative_controls(group)
+
     def build_sigmoid(self):
         assert len(self.groups) != 0, "attempt to build sigmoid while not having any sample groups"
 
+        # vectorized pre-screen over all loaded plates, rejected samples are not passed to the solver
+        screen_samples([sample for plate in self.plates for sample in plate.samples])
+
+        self.fit_budget.start_run()
         for group in self.groups:
-            for sample in group.samples:
-                sample.get_popt_pcov()
-                sample.get_R2()
+            # replicate sets are aggregated again in case the group membership changed
+            group.replicate_samples = None
+            if not group.joint_fit or not group.fit_jointly(self.fit_budget):
+                for sample in group.get_fit_samples():
+                    sample.get_popt_pcov(self.fit_budget)
+            diagnose_samples(group.get_fit_samples())
+            group.share_replicate_results()
             group.detect_outliers()
             group.plot_samples_data()
 
     def calculate_endpoint_titer(self):
-        for group in self.groups:
-            group.get_group_cutoff(self.cutoff_multiplier_accuracy)
-            group.calculate_average_titer()
+        self.fit_budget.start_run()
+        if self.triage:
+            for group in self.groups:
+                group.sweep = None
+            triage_groups(self.groups, self.cutoff_multiplier_accuracy, self.fit_budget)
+        else:
+            for group in self.groups:
+                # titers are read from the fitted curves again, so they all get their errors
+                for sample in group.get_fit_samples():
+                    sample.triage_borderline = None
+                if self.accuracy_sweep:
+                    group.sweep_accuracies(cutoff_multiplier_accuracies, self.fit_budget)
+                    group.apply_sweep(self.cutoff_multiplier_accuracy)
+                else:
+                    group.sweep = None
+                    group.get_group_cutoff(self.cutoff_multiplier_accuracy, self.fit_budget)
+                    group.calculate_average_titer()
 
+        self.ui.update_titers()
         build_common_plot(self.groups)
 
+        if self.accuracy_sweep and not self.triage:
+            self.ui.show_sweep_results(self.groups)
+
         # enable 'Save results' button
         self.ui.top_panel.right.save_results.setEnabled(True)
 
+    def refit_plate(self, plate: Plate):
+        # only samples that have been fitted already are refitted, the rest waits for 'Build sigmoid'
+        samples = [sample for sample in plate.samples
+                   if sample.group is not None and sample.qc_reason is None and sample.is_fitted()]
+        if len(samples) == 0:
+            return
+
+        if self.plate_refitter is None:
+            self.plate_refitter = PlateRefitter()
+            self.plate_refitter.refitted.connect(self.on_plate_refitted)
+        self.plate_refitter.refit(plate, samples, self.live_preview_seconds)
+
+    def on_plate_refitted(self, plate: Plate, samples: list, results: list):
+        # samples the preview ran out of time for are stale: no titer and out of the average until 'Build sigmoid'
+        groups = list()
+        for sample, result in zip(samples, results):
+            sample.apply_preview_fit(*result)
+        diagnose_samples(samples)
+
+        for sample in samples:
+            if sample.group is not None and sample.group.cutoff is not None:
+                sample.calculate_endpoint_titer(sample.group.cutoff, refit=False)
+                if sample.group not in groups:
+                    groups.append(sample.group)
+
+        for group in groups:
+            group.calculate_average_titer()
+
+        self.ui.update_titers([plate])
+
     def set_cutoff_multiplier_accuracy(self, accuracy: float):
         self.cutoff_multiplier_accuracy = accuracy
 
+        # swept results already have every accuracy, switching between them does not need any fitting
+        if self.accuracy_sweep and all(group.sweep is not None for group in self.groups):
+            for group in self.groups:
+                group.apply_sweep(accuracy)
+            self.ui.update_titers()
+
+    def set_sample_seconds(self, seconds: float):
+        # time limit of a single fit for the following runs
+        self.fit_budget.sample_seconds = seconds
+
+    def set_accuracy_sweep(self, enabled: bool):
+        self.accuracy_sweep = enabled
+
+    def set_joint_fit(self, enabled: bool):
+        self.joint_fit = enabled
+        for group in self.groups:
+            group.joint_fit = enabled
+
+    def set_collapse_replicates(self, enabled: bool):
+        self.collapse_replicates = enabled
+        for group in self.groups:
+            # groups already in that mode keep their replicate samples, e.g. the ones restored from a session
+            if group.collapse_replicates != enabled:
+                group.collapse_replicates = enabled
+                group.replicate_samples = None
+
+    def declare_replicates(self, samples: list):
+        # explicitly mark samples of one group as technical replicates of each other
+        groups = set(sample.group for sample in samples)
+        if len(samples) < 2 or len(groups) != 1 or None in groups:
+            print('Replicates have to be at least two samples of the same group')
+            return
+        group = groups.pop()
+        replicate_sets = [[sample for sample in replicate_set if sample not in samples]
+                          for replicate_set in group.replicate_sets or []]
+        group.replicate_sets = [replicate_set for replicate_set in replicate_sets if len(replicate_set) > 0] + [samples]
+        group.replicate_samples = None
+
+    def save_session(self, file_path: str):
+        save_session(self, file_path)
+
+    def load_session(self, file_path: str):
+        load_session(self, file_path)
+
     def save_results(self):
         folder_name = QFileDialog.getExistingDirectory(self.ui, caption='Select folder for results')
         if folder_name != '':
             write_data_to_csv(self.groups, folder_name, self.cutoff_multiplier_accuracy)
+            write_xlsx(self.groups, f'{folder_name}/results.xlsx', self.cutoff_multiplier_accuracy)
+            # the report data is taken from the groups here, the figures are rendered off the GUI thread
+            if self.report_writer is None:
+                self.report_writer = ReportWriter()
+                self.report_writer.finished.connect(self.on_report_written)
+            self.report_writer.write(prepare_report(self.groups, f'{folder_name}/report.pdf',
+                                                    self.cutoff_multiplier_accuracy))
+
+    def on_report_written(self, file_path: str, error):
+        if error is None:
+            print(f'Report written to {file_path}')
+        else:
+            print(f'Could not write {file_path}: {error}')
@@ -0,0 +1,62 @@
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+
+from fit_budget import FitBudget, fit_with_budget
+
+
+class PlateRefitSignals(QObject):
+    # plate, generation, samples, list of (popt, pcov, status, note) in the order of the samples
+    finished = Signal(object, int, list, list)
+
+
+class PlateRefit(QRunnable):
+    """
+    Refit a snapshot of the plate samples on a worker thread. The worker only sees copies of xdata/ydata and the
+    previous parameters, the sample objects are only carried along and updated on the GUI thread once the `finished`
+    signal arrives.
+    """
+
+    def __init__(self, plate, generation: int, samples: list, snapshots: list, seconds: float):
+        super().__init__()
+
+        self.plate = plate
+        self.generation = generation
+        self.samples = samples
+        self.snapshots = snapshots
+        self.seconds = seconds
+        self.signals = PlateRefitSignals()
+
+    def run(self):
+        # the run budget keeps the preview latency bounded, every fit starts from the previous parameters
+        budget = FitBudget(run_seconds=self.seconds)
+        results = [fit_with_budget(xdata, ydata, budget, p0=p0) for xdata, ydata, p0 in self.snapshots]
+        self.signals.finished.emit(self.plate, self.generation, self.samples, results)
+
+
+class PlateRefitter(QObject):
+    """
+    Start plate refits on the global thread pool and hand over the results of the latest refit of every plate. The
+    worker signals are connected to a slot of this object, so they are delivered on the GUI thread it lives on.
+    """
+
+    # plate, samples, list of (popt, pcov, status, note)
+    refitted = Signal(object, list, list)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self.generations = dict()
+
+    def refit(self, plate, samples: list, seconds: float):
+        # results of an older refit still in flight are dropped once they arrive
+        generation = self.generations.get(plate, 0) + 1
+        self.generations[plate] = generation
+
+        snapshots = [(list(sample.xdata), list(sample.ydata), None if sample.popt is None else list(sample.popt))
+                     for sample in samples]
+        worker = PlateRefit(plate, generation, samples, snapshots, seconds)
+        worker.signals.finished.connect(self.on_finished)
+        QThreadPool.globalInstance().start(worker)
+
+    def on_finished(self, plate, generation: int, samples: list, results: list):
+        if generation == self.generations.get(plate):
+            self.refitted.emit(plate, samples, results)
@@ -5,6 +5,8 @@ from immuno_calculator import Sample as SampleData
 
 class Plate:
     def __init__(self, file_path: str, name: str, rows: list, sample_names: list):
+        self.file_path = file_path
+        self.plate_name = name
         self.name = f'{file_path}:{name}'
         self.samples = list()
         self.dilution_coefficient = 1.
@@ -15,7 +17,8 @@ class Plate:
         for sample_index in range(len(sample_names)):
             sample_ydata = list()
             for row in rows:
-                sample_ydata.append(row[sample_index])
+                # short rows mean missing wells at the end of the row
+                sample_ydata.append(row[sample_index] if sample_index < len(row) else math.nan)
 
             sample = SampleData(sample_names[sample_index], xdata=self.log_dilutions, ydata=sample_ydata)
             sample.plate = self
@@ -31,3 +34,8 @@ class Plate:
         for i in range(1, len(self.dilutions)):
             self.dilutions[i] = self.dilutions[i - 1] * self.dilution_coefficient
             self.log_dilutions[i] = math.log10(self.dilutions[i])
+
+    def set_dilution(self, index: int, value: float):
+        # update in place: the log dilutions list is shared with every sample of the plate
+        self.dilutions[index] = value
+        self.log_dilutions[index] = math.log10(value)
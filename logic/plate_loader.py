@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from PySide6.QtCore import QObject, Signal
+
+from plate_reader import load_plate_blocks
+
+
+class PlateLoader(QObject):
+    """
+    Parse workbooks on a pool of worker processes (openpyxl parsing is pure Python and holds the GIL). Results are
+    handed over in the order of the requested files: `file_loaded` is emitted for a file as soon as it and every file
+    before it have finished, so plate tabs always come out in the same order. A file that fails to parse is reported
+    with `file_failed` and does not affect the others.
+    """
+
+    # file index, file path, list of (plate name, rows, sample names)
+    file_loaded = Signal(int, str, list)
+    # file index, file path, error message
+    file_failed = Signal(int, str, str)
+    # finished file count, file count
+    progress = Signal(int, int)
+    finished = Signal()
+
+    # emitted from the executor threads, delivered on the GUI thread through the queued connection
+    result_ready = Signal(int, object, object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self.executor = None
+        self.worker_count = 0
+        self.file_paths = list()
+        self.results = dict()
+        self.next_index = 0
+        self.result_ready.connect(self.on_result_ready)
+
+    def get_executor(self, file_count: int) -> ProcessPoolExecutor:
+        # the pool is kept for the following loads, spawning the workers is the expensive part
+        worker_count = min(file_count, os.cpu_count() or 1)
+        if self.executor is None or self.worker_count < worker_count:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+            # spawned workers only import the reader, forking a process with a running GUI is not safe
+            self.executor = ProcessPoolExecutor(worker_count, mp_context=multiprocessing.get_context('spawn'))
+            self.worker_count = worker_count
+        return self.executor
+
+    def is_loading(self) -> bool:
+        return self.next_index < len(self.file_paths)
+
+    def load(self, file_paths: list):
+        if len(file_paths) == 0:
+            return
+        if self.is_loading():
+            # files requested while loading are queued after the ones being loaded
+            first = len(self.file_paths)
+            self.file_paths += file_paths
+        else:
+            first = 0
+            self.file_paths = list(file_paths)
+            self.results = dict()
+            self.next_index = 0
+        executor = self.get_executor(len(self.file_paths) - self.next_index)
+        for index in range(first, len(self.file_paths)):
+            future = executor.submit(load_plate_blocks, self.file_paths[index])
+            future.add_done_callback(partial(self.on_future_done, index))
+        self.progress.emit(self.next_index, len(self.file_paths))
+
+    def on_future_done(self, index: int, future):
+        # runs on an executor thread, only forward the outcome
+        if future.cancelled():
+            return
+        error = future.exception()
+        self.result_ready.emit(index, None if error is not None else future.result(), error)
+
+    def on_result_ready(self, index: int, blocks, error):
+        if isinstance(error, BrokenProcessPool):
+            # a worker died, the next load starts a new pool
+            self.executor = None
+        self.results[index] = (blocks, error)
+        while self.next_index in self.results:
+            blocks, error = self.results.pop(self.next_index)
+            file_path = self.file_paths[self.next_index]
+            if error is None:
+                self.file_loaded.emit(self.next_index, file_path, blocks)
+            else:
+                self.file_failed.emit(self.next_index, file_path, f'{type(error).__name__}: {error}')
+            self.next_index += 1
+        self.progress.emit(self.next_index + len(self.results), len(self.file_paths))
+        if not self.is_loading():
+            self.finished.emit()
+
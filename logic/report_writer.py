@@ -0,0 +1,47 @@
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+
+from report import finish_report
+
+
+class ReportSignals(QObject):
+    # file path, error message or None
+    finished = Signal(str, object)
+
+
+class ReportJob(QRunnable):
+    """
+    Render and write a prepared report (see report.prepare_report()) on a worker thread. The job only sees the plain
+    data of the report, the figures are drawn by the spawn process pool of report.render_figures() from there.
+    """
+
+    def __init__(self, report: tuple):
+        super().__init__()
+
+        self.report = report
+        self.signals = ReportSignals()
+
+    def run(self):
+        try:
+            finish_report(self.report)
+        except Exception as error:
+            self.signals.finished.emit(self.report[0], f'{type(error).__name__}: {error}')
+            return
+        self.signals.finished.emit(self.report[0], None)
+
+
+class ReportWriter(QObject):
+    """
+    Write reports on the global thread pool, so the GUI stays responsive while the figures are rendered. The job
+    signals are connected to a slot of this object and so delivered on the GUI thread it lives on.
+    """
+
+    # file path, error message or None
+    finished = Signal(str, object)
+
+    def write(self, report: tuple):
+        job = ReportJob(report)
+        job.signals.finished.connect(self.on_finished)
+        QThreadPool.globalInstance().start(job)
+
+    def on_finished(self, file_path: str, error):
+        self.finished.emit(file_path, error)
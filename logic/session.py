@@ -0,0 +1,227 @@
+import json
+import os
+
+import numpy as np
+
+from immuno_calculator import AnalyticalGroup, diagnose_samples
+from logic.plate import Plate
+
+
+# Session file layout:
+# - 8 bytes magic
+# - 8 bytes little-endian header length
+# - JSON header: plates, groups, per-sample strings, UI state and the table of array blocks
+# - array blocks, every block starts at a 64-byte aligned offset and is read back with np.memmap
+
+MAGIC = b'ETSESSN1'
+ALIGNMENT = 64
+
+
+def _aligned(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _optional_string(value):
+    return None if value is None else str(value)
+
+
+def save_session(logic, file_path: str):
+    samples = [sample for plate in logic.plates for sample in plate.samples]
+    sample_indices = {id(sample): index for index, sample in enumerate(samples)}
+    point_count = max([len(sample.ydata) for sample in samples] + [len(plate.dilutions) for plate in logic.plates] +
+                      [1])
+
+    readings = np.full((len(samples), point_count), np.nan)
+    popt = np.full((len(samples), 3), np.nan)
+    pcov = np.full((len(samples), 3, 3), np.nan)
+    for index, sample in enumerate(samples):
+        readings[index, :len(sample.ydata)] = sample.ydata
+        if sample.popt is not None:
+            popt[index] = sample.popt
+            pcov[index] = sample.pcov
+    dilutions = np.full((len(logic.plates), point_count), np.nan)
+    for index, plate in enumerate(logic.plates):
+        dilutions[index, :len(plate.dilutions)] = plate.dilutions
+
+    blocks = {
+        'readings': readings,
+        'lengths': np.array([len(sample.ydata) for sample in samples], dtype=np.int64),
+        'dilutions': dilutions,
+        'popt': popt,
+        'pcov': pcov,
+        'r2': np.array([np.nan if sample.R2 is None else sample.R2 for sample in samples]),
+        'titer': np.array([np.nan if sample.endpoint_titer is None else sample.endpoint_titer for sample in samples]),
+        'bad_data': np.array([sample.bad_data for sample in samples], dtype=bool),
+        'titer_se': np.array([np.nan if sample.titer_se is None else sample.titer_se for sample in samples]),
+    }
+
+    ui = logic.ui
+    header = {
+        'plates': [{
+            'file_path': plate.file_path,
+            'name': plate.plate_name,
+            'sample_count': len(plate.samples),
+            'dilution_count': len(plate.dilutions),
+            # stored as they are: the defaults are not the log10 of the default dilutions
+            'log_dilutions': list(plate.log_dilutions),
+            'dilution_coefficient': plate.dilution_coefficient,
+            'cutoff_multiplier': plate.cutoff_multiplier,
+        } for plate in logic.plates],
+        'samples': {
+            'names': [str(sample.name) for sample in samples],
+            'qc_reason': [_optional_string(sample.qc_reason) for sample in samples],
+            'fit_status': [_optional_string(sample.fit_status) for sample in samples],
+            'fit_note': [sample.fit_note for sample in samples],
+            'stale': [sample.stale for sample in samples],
+        },
+        'groups': [{
+            'name': group.name,
+            'samples': [sample_indices[id(sample)] for sample in group.samples],
+            'negative_control_indices': list(group.negative_control_indices),
+            'cutoff': group.cutoff,
+            'accuracy': group.accuracy,
+            'average_titer': group.average_titer,
+            'average_titer_se': group.average_titer_se,
+            'average_titer_ci': None if group.average_titer_ci is None else list(group.average_titer_ci),
+            'outliers': list(group.outliers),
+            'joint_fit': group.joint_fit,
+            'collapse_replicates': group.collapse_replicates,
+            'replicate_sets': None if group.replicate_sets is None else
+            [[sample_indices[id(sample)] for sample in replicate_set if id(sample) in sample_indices]
+             for replicate_set in group.replicate_sets],
+            'stylesheet': None if ui is None else ui.group_stylesheets.get(group),
+        } for group in logic.groups],
+        'ui': {
+            'cutoff_multiplier_accuracy': logic.cutoff_multiplier_accuracy,
+            'joint_fit': logic.joint_fit,
+            'collapse_replicates': logic.collapse_replicates,
+            'next_group_index': None if ui is None else ui.next_group_index,
+        },
+        'blocks': dict(),
+    }
+
+    # the header holds the block offsets, so it is sized with placeholder offsets first and the data start is
+    # rounded up generously to leave room for the real ones
+    for name, block in blocks.items():
+        header['blocks'][name] = {'dtype': block.dtype.str, 'shape': list(block.shape), 'offset': 0}
+    header_size = len(json.dumps(header).encode('utf-8')) + 32 * len(blocks)
+    offset = _aligned(len(MAGIC) + 8 + header_size)
+    for name, block in blocks.items():
+        header['blocks'][name]['offset'] = offset
+        offset = _aligned(offset + block.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    assert len(MAGIC) + 8 + len(header_bytes) <= header['blocks']['readings']['offset']
+
+    # write next to the target and swap, so a failed save never destroys the previous session
+    temp_path = f'{file_path}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for name, block in blocks.items():
+            f.seek(header['blocks'][name]['offset'])
+            f.write(np.ascontiguousarray(block).tobytes())
+        f.truncate(offset)
+    os.replace(temp_path, file_path)
+
+
+def read_session(file_path: str) -> tuple:
+    # returns the header and the array blocks mapped from the file
+    with open(file_path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{file_path} is not a session file')
+        header_length = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_length).decode('utf-8'))
+
+    blocks = dict()
+    for name, block in header['blocks'].items():
+        shape = tuple(block['shape'])
+        if np.prod(shape) == 0:
+            blocks[name] = np.empty(shape, dtype=np.dtype(block['dtype']))
+        else:
+            blocks[name] = np.memmap(file_path, dtype=np.dtype(block['dtype']), mode='r', offset=block['offset'],
+                                     shape=shape)
+    return header, blocks
+
+
+def load_session(logic, file_path: str):
+    header, blocks = read_session(file_path)
+
+    # copy each mapped block out in one go, so the session file is not kept open by the restored objects
+    readings = np.array(blocks['readings'])
+    lengths = np.array(blocks['lengths'])
+    dilutions = np.array(blocks['dilutions'])
+    popt = np.array(blocks['popt'])
+    pcov = np.array(blocks['pcov'])
+    r2 = np.array(blocks['r2'])
+    titer = np.array(blocks['titer'])
+    bad_data = np.array(blocks['bad_data'])
+    titer_se = np.array(blocks['titer_se'])
+    sample_header = header['samples']
+
+    if logic.ui is not None:
+        logic.ui.clear_plates()
+    logic.plates = list()
+    logic.groups = list()
+
+    samples = list()
+    for plate_index, plate_header in enumerate(header['plates']):
+        first = len(samples)
+        last = first + plate_header['sample_count']
+        rows = readings[first:last].T
+        plate = Plate(plate_header['file_path'], plate_header['name'], rows, sample_header['names'][first:last])
+        dilution_count = plate_header['dilution_count']
+        # update in place: the log dilutions list is shared with every sample of the plate
+        plate.dilutions[:] = dilutions[plate_index, :dilution_count].tolist()
+        plate.log_dilutions[:] = plate_header['log_dilutions']
+        plate.dilution_coefficient = plate_header['dilution_coefficient']
+        plate.cutoff_multiplier = plate_header['cutoff_multiplier']
+
+        for index, sample in zip(range(first, last), plate.samples):
+            sample.ydata = readings[index, :lengths[index]].tolist()
+            if not np.all(np.isnan(popt[index])):
+                sample.popt = popt[index]
+                sample.pcov = pcov[index]
+            sample.R2 = None if np.isnan(r2[index]) else float(r2[index])
+            sample.endpoint_titer = None if np.isnan(titer[index]) else float(titer[index])
+            sample.titer_se = None if np.isnan(titer_se[index]) else float(titer_se[index])
+            sample.bad_data = bool(bad_data[index])
+            sample.qc_reason = sample_header['qc_reason'][index]
+            sample.fit_status = sample_header['fit_status'][index]
+            sample.fit_note = sample_header['fit_note'][index]
+            sample.stale = sample_header['stale'][index]
+            samples.append(sample)
+
+        logic.plates.append(plate)
+        if logic.ui is not None:
+            logic.ui.add_plate(plate)
+    # fit diagnostics are not stored, they are derived from the restored fits
+    diagnose_samples(samples)
+
+    for group_header in header['groups']:
+        group = AnalyticalGroup(group_header['name'], [samples[index] for index in group_header['samples']])
+        group.negative_control_indices = group_header['negative_control_indices']
+        group.cutoff = group_header['cutoff']
+        group.accuracy = group_header['accuracy']
+        group.outliers = group_header['outliers']
+        group.joint_fit = group_header['joint_fit']
+        for sample in group.samples:
+            sample.group = group
+        group.collapse_replicates = group_header['collapse_replicates']
+        if group_header['replicate_sets'] is not None:
+            group.replicate_sets = [[samples[index] for index in replicate_set]
+                                    for replicate_set in group_header['replicate_sets']]
+        if group.collapse_replicates:
+            group.restore_replicate_results()
+        # the titer sums are rebuilt from the restored titers, the average follows from them
+        group.calculate_average_titer()
+        logic.groups.append(group)
+        if logic.ui is not None:
+            logic.ui.on_group_added(group, group_header['stylesheet'])
+
+    ui_header = header['ui']
+    logic.cutoff_multiplier_accuracy = ui_header['cutoff_multiplier_accuracy']
+    logic.set_joint_fit(ui_header['joint_fit'])
+    logic.collapse_replicates = ui_header['collapse_replicates']
+    if logic.ui is not None:
+        logic.ui.on_session_loaded(ui_header)
@@ -0,0 +1,128 @@
+import math
+
+import numpy as np
+from matplotlib import colormaps
+from matplotlib.colors import hsv_to_rgb
+
+from qc import saturation_level, to_matrix
+
+
+# Session overview: every plate is drawn as a tile of RGB pixels, with one cell per well, followed by three strips
+# with one cell per sample (fit quality, flags, group). The colours are looked up for all wells of a plate at once,
+# and tiles are copied into one image that the ui shows as a single QImage.
+#
+#     readings   (points x samples) OD values, dark to bright up to the saturation level
+#     R²         red below R2_FLOOR to green at 1
+#     flags      QC failure, bad data or outlier
+#     group      hue of the group, blank for ungrouped samples
+
+CELL = 8
+STRIP = 4
+GAP = 12
+R2_FLOOR = 0.9
+
+BLANK = np.array([235, 235, 235], dtype=np.uint8)
+MISSING = np.array([150, 150, 150], dtype=np.uint8)
+BACKGROUND = np.array([255, 255, 255], dtype=np.uint8)
+
+# flag codes and their colours, a sample gets the highest code that applies
+OK = 0
+QC_FAILED = 1
+BAD_DATA = 2
+OUTLIER = 3
+FLAG_COLORS = np.array([[255, 255, 255], [150, 150, 150], [215, 40, 40], [255, 150, 0]], dtype=np.uint8)
+
+READINGS_LUT = (colormaps['viridis'](np.linspace(0., 1., 256))[:, :3] * 255).astype(np.uint8)
+R2_LUT = (colormaps['RdYlGn'](np.linspace(0., 1., 256))[:, :3] * 255).astype(np.uint8)
+
+
+def lookup(values: np.ndarray, low: float, high: float, lut: np.ndarray, missing: np.ndarray) -> np.ndarray:
+    # map values within [low, high] to the colours of the table, NaN gets the missing colour
+    known = ~np.isnan(values)
+    indices = np.zeros(values.shape, dtype=np.int64)
+    indices[known] = np.clip((values[known] - low) / (high - low) * (len(lut) - 1), 0, len(lut) - 1)
+    colors = lut[indices]
+    colors[~known] = missing
+    return colors
+
+
+def plate_arrays(samples: list, group_hues: dict) -> dict:
+    """
+    Everything a tile is drawn from, read from the samples of one plate. `group_hues` maps a group to its hue in
+    degrees. The arrays also serve as the cache key of the tile: equal arrays give an equal tile.
+    """
+    readings, _ = to_matrix([sample.ydata for sample in samples])
+    flags = np.full(len(samples), OK, dtype=np.int64)
+    for index, sample in enumerate(samples):
+        if sample.group is not None and sample.name in sample.group.outliers:
+            flags[index] = OUTLIER
+        elif sample.bad_data:
+            flags[index] = BAD_DATA
+        elif sample.qc_reason is not None:
+            flags[index] = QC_FAILED
+    return {
+        'readings': readings.T,
+        'r2': np.array([np.nan if sample.R2 is None else sample.R2 for sample in samples], dtype=np.float64),
+        'flags': flags,
+        'hues': np.array([group_hues.get(sample.group, np.nan) for sample in samples], dtype=np.float64),
+    }
+
+
+def same_arrays(first: dict, second: dict) -> bool:
+    return first.keys() == second.keys() and \
+        all(np.array_equal(first[key], second[key], equal_nan=True) for key in first)
+
+
+def tile_size(point_count: int, sample_count: int) -> tuple:
+    # (height, width) in pixels
+    return point_count * CELL + 3 * STRIP + 3, sample_count * CELL
+
+
+def render_tile(arrays: dict) -> np.ndarray:
+    # (height, width, 3) RGB tile of one plate
+    point_count, sample_count = arrays['readings'].shape
+    height, width = tile_size(point_count, sample_count)
+    tile = np.empty((height, width, 3), dtype=np.uint8)
+    tile[:] = BACKGROUND
+
+    wells = lookup(arrays['readings'], 0., saturation_level, READINGS_LUT, MISSING)
+    tile[:point_count * CELL] = np.repeat(np.repeat(wells, CELL, axis=0), CELL, axis=1)
+
+    hues = arrays['hues']
+    grouped = ~np.isnan(hues)
+    group_colors = np.empty((sample_count, 3), dtype=np.uint8)
+    group_colors[:] = BLANK
+    if np.any(grouped):
+        hsv = np.stack([hues[grouped] % 360 / 360, np.full(grouped.sum(), 0.6), np.full(grouped.sum(), 0.9)], axis=1)
+        group_colors[grouped] = (hsv_to_rgb(hsv) * 255).astype(np.uint8)
+
+    strips = [lookup(arrays['r2'], R2_FLOOR, 1., R2_LUT, BLANK), FLAG_COLORS[arrays['flags']], group_colors]
+    top = point_count * CELL + 1
+    for strip in strips:
+        tile[top:top + STRIP] = np.repeat(strip, CELL, axis=0)[None]
+        top += STRIP + 1
+    return tile
+
+
+def compose(tiles: list, width: int) -> tuple:
+    """
+    Lay the tiles out in rows that fit into `width` pixels. Returns the (height, width, 4) RGBA image and the
+    (x, y, width, height) rectangle of every tile.
+    """
+    if len(tiles) == 0:
+        return np.zeros((1, 1, 4), dtype=np.uint8), list()
+    tile_height = max(tile.shape[0] for tile in tiles)
+    tile_width = max(tile.shape[1] for tile in tiles)
+    columns = max(1, min(len(tiles), (width - GAP) // (tile_width + GAP)))
+    rows = math.ceil(len(tiles) / columns)
+
+    image = np.empty((GAP + rows * (tile_height + GAP), GAP + columns * (tile_width + GAP), 4), dtype=np.uint8)
+    image[..., :3] = BACKGROUND
+    image[..., 3] = 255
+    rectangles = list()
+    for index, tile in enumerate(tiles):
+        x = GAP + index % columns * (tile_width + GAP)
+        y = GAP + index // columns * (tile_height + GAP)
+        image[y:y + tile.shape[0], x:x + tile.shape[1], :3] = tile
+        rectangles.append((x, y, tile.shape[1], tile.shape[0]))
+    return image, rectangles
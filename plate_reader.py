@@ -0,0 +1,132 @@
+import re
+
+import openpyxl
+from numpy import float64
+
+from corrections import correct_blocks
+from immuno_calculator import letters
+from workbook_cache import workbook_cache
+
+
+# wavelength label of a read, e.g. '450', 'OD570' or '620 nm'
+wavelength_label = re.compile(r'^\s*(?:OD\s*)?(\d{3})\s*(?:nm)?\s*$', re.IGNORECASE)
+
+
+def read_plate_blocks(file_path: str) -> list:
+    """
+    Parse all plate blocks from the active sheet of the workbook. Every block starts with an optional plate name row,
+    continues with one or more reads of data rows (A-H) and ends with the sample names row. A read may be preceded by
+    a wavelength label row; a new read also starts when a row letter comes again.
+    Returns a list of (plate name, reads, sample names, wavelengths) tuples, every read being a list of rows and every
+    wavelength a string or None for unlabelled reads.
+    """
+    def row_is_empty(row) -> bool:
+        # 0 cells or all cells are empty
+        if len(row) == 0:
+            return True
+        for cell in row:
+            if cell.value is not None:
+                return False
+        return True
+    def row_contains_plate_name(row) -> bool:
+        # 2 or more cells, cell #1 contains text, all the rest are empty
+        if len(row) < 2:
+            return False
+        if row[1].value is None:
+            return False
+        other_values = [row[i].value for i in range(len(row)) if i != 1]
+        for other_value in other_values:
+            if other_value is not None:
+                return False
+        return True
+    def get_plate_name(row) -> str:
+        return row[1].value
+    def row_contains_wavelength(row) -> bool:
+        # cell #0 or cell #1 contains a wavelength label, all the rest are empty; cell #1 is where the plate name goes,
+        # a bare number there is a plate name (e.g. plate 101) and a label needs the OD prefix or the nm suffix
+        values = [cell.value for cell in row]
+        labels = [index for index, value in enumerate(values) if value is not None]
+        if len(labels) != 1 or labels[0] > 1:
+            return False
+        match = wavelength_label.match(str(values[labels[0]]))
+        return match is not None and (labels[0] == 0 or match.group(0).strip() != match.group(1))
+    def get_wavelength(row) -> str:
+        value = next(cell.value for cell in row if cell.value is not None)
+        return wavelength_label.match(str(value)).group(1)
+    def row_contains_data(row) -> bool:
+        # cell #0 contains a letter
+        if len(row) == 0:
+            return False
+        return row[0].value in letters
+    def get_row_data(row) -> list:
+        # collect values starting from cell #1 until the last numeric cell, missing wells become NaN
+        values = [row[i].value if isinstance(row[i].value, (int, float)) else None for i in range(1, len(row))]
+        while len(values) > 0 and values[-1] is None:
+            values.pop()
+        return [float64('nan') if value is None else float64(value) for value in values]
+    def row_contains_sample_names(row) -> bool:
+        # cell #0 is empty, all the rest are not (at least two)
+        if row[0].value is not None:
+            return False
+        other_values = [row[i].value for i in range(1, len(row))]
+        non_empty_value_count = 0
+        for value in other_values:
+            if value is not None:
+                non_empty_value_count += 1
+        return non_empty_value_count >= 2
+    def get_sample_names(row) -> list:
+        # collect values starting from cell #1 until first empty cell
+        names = list()
+        for i in range(1, len(row)):
+            if row[i].value is not None:
+                names.append(row[i].value)
+            else:
+                break
+        return names
+
+    wb_obj = openpyxl.load_workbook(file_path)
+    sheet = wb_obj.active
+
+    blocks = list()
+    current_plate_name = None
+    current_reads = None
+    current_wavelengths = None
+    current_letters = None
+    next_wavelength = None
+
+    for row in sheet.iter_rows():
+        if row_is_empty(row):
+            continue
+        if row_contains_wavelength(row):
+            next_wavelength = get_wavelength(row)
+            continue
+        if row_contains_plate_name(row):
+            if current_plate_name is None:
+                current_plate_name = get_plate_name(row)
+            continue
+        if row_contains_data(row):
+            if current_reads is None or next_wavelength is not None or row[0].value in current_letters:
+                # first read of the block, a labelled read or a read starting over at the first rows
+                if current_reads is None:
+                    current_reads, current_wavelengths = list(), list()
+                current_reads.append(list())
+                current_wavelengths.append(next_wavelength)
+                current_letters = set()
+                next_wavelength = None
+            current_reads[-1].append(get_row_data(row))
+            current_letters.add(row[0].value)
+            continue
+        if row_contains_sample_names(row) and current_reads is not None:
+            blocks.append((current_plate_name, current_reads, get_sample_names(row), current_wavelengths))
+            current_plate_name = None
+            current_reads = None
+            next_wavelength = None
+
+    return blocks
+
+
+def load_plate_blocks(file_path: str, blank_correction: bool | None = None) -> list:
+    # cached version of read_plate_blocks(), corrected for the reference read and blanks of every plate, see
+    # corrections.correct_blocks() for `blank_correction`
+    # returns a list of (plate name, rows, sample names) tuples
+    return correct_blocks(workbook_cache.parse(file_path, 'blocks', read_plate_blocks), blank_correction)
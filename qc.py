@@ -0,0 +1,74 @@
+import warnings
+
+import numpy as np
+
+
+# readings at or above this level are treated as out of the reader range
+saturation_level = 3.5
+# minimal number of unsaturated points needed to fit the 3-parameter sigmoid
+min_fit_points = 3
+# curves with a smaller span (max - min) than this are considered flat
+flat_span = 0.1
+# a curve is non-monotonic if it rises (after being oriented as descending) by more than this fraction of its span
+monotonic_tolerance = 0.2
+
+MISSING_WELLS = 'missing wells'
+SATURATED = 'saturated'
+FLAT = 'flat'
+NON_MONOTONIC = 'non-monotonic'
+BELOW_CUTOFF = 'below cutoff'
+
+
+def to_matrix(ydata: list) -> tuple:
+    """
+    Stack ydata lists of (possibly) different lengths into a NaN-padded matrix.
+    Returns the matrix and the mask of cells that belong to the samples.
+    """
+    lengths = np.array([len(y) for y in ydata])
+    point_count = lengths.max() if len(lengths) else 0
+    valid = np.arange(point_count) < lengths[:, None]
+    matrix = np.full((len(ydata), point_count), np.nan)
+    matrix[valid] = np.concatenate([np.asarray(y, dtype=float) for y in ydata]) if len(ydata) else []
+    return matrix, valid
+
+
+def screen(ydata: np.ndarray, valid: np.ndarray, cutoffs=None) -> np.ndarray:
+    """
+    Flag samples that are not worth fitting. `ydata` is a (samples, points) matrix of descending curves, `cutoffs` is
+    either None, a scalar or a per-sample array. Returns an object array with the first failed check for every sample,
+    None for samples that passed.
+    """
+    missing = np.any(np.isnan(ydata) & valid, axis=1)
+
+    # all-NaN rows are flagged as missing wells anyway, silence numpy complaining about them
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        unsaturated = np.sum(ydata < saturation_level, axis=1)
+        saturated = unsaturated < min_fit_points
+        top = np.nanmax(ydata, axis=1)
+        span = top - np.nanmin(ydata, axis=1)
+        flat = span < flat_span
+        rises = np.nansum(np.clip(np.diff(ydata, axis=1), 0., None), axis=1)
+        non_monotonic = rises > monotonic_tolerance * span
+        below_cutoff = np.zeros(len(ydata), dtype=bool) if cutoffs is None else top <= cutoffs
+
+    # the order of the checks defines which reason gets recorded when several of them fail
+    reasons = np.full(len(ydata), None, dtype=object)
+    for mask, reason in reversed([(missing, MISSING_WELLS), (saturated, SATURATED), (flat, FLAT),
+                                  (non_monotonic, NON_MONOTONIC), (below_cutoff, BELOW_CUTOFF)]):
+        reasons[mask] = reason
+    return reasons
+
+
+def screen_samples(samples: list, cutoff=None):
+    # run the checks over all samples at once and record the outcome on every sample, cutoff is either None, one
+    # value for all samples or an array with a value per sample
+    if len(samples) == 0:
+        return
+    ydata, valid = to_matrix([sample.ydata for sample in samples])
+    reasons = screen(ydata, valid, cutoff)
+    for sample, reason in zip(samples, reasons):
+        sample.qc_reason = reason
+        sample.bad_data = reason is not None
+        if reason is not None:
+            print(f'Sample {sample.name} is rejected by QC: {reason}')
@@ -0,0 +1,59 @@
+import re
+import warnings
+
+import numpy as np
+
+
+# trailing replicate markers: "serum 5 rep2", "serum 5_r2", "serum 5 (2)"
+replicate_suffix = re.compile(r'(\s*[_\-\s]\s*(rep|replicate|r)\s*\d+|\s*\(\d+\))$', re.IGNORECASE)
+
+
+def replicate_key(name) -> str:
+    # samples sharing the key are technical replicates of each other
+    return replicate_suffix.sub('', str(name)).strip()
+
+
+def group_replicates(names: list) -> list:
+    # indices of the samples grouped by replicate key, in the order of the first member of each set
+    sets = dict()
+    for index, name in enumerate(names):
+        sets.setdefault(replicate_key(name), list()).append(index)
+    return list(sets.values())
+
+
+def aggregate(ydata: np.ndarray, labels: np.ndarray, set_count: int) -> tuple:
+    """
+    Mean, variance (ddof=1) and count of the readings of every replicate set for every dilution point at once.
+    `ydata` is a (samples, points) matrix with NaN for missing wells, `labels` maps every sample to its set.
+    """
+    present = ~np.isnan(ydata)
+    values = np.where(present, ydata, 0.)
+    counts = np.zeros((set_count, ydata.shape[1]))
+    sums = np.zeros((set_count, ydata.shape[1]))
+    np.add.at(counts, labels, present)
+    np.add.at(sums, labels, values)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        means = sums / counts
+        squares = np.zeros_like(sums)
+        np.add.at(squares, labels, np.where(present, (ydata - means[labels]) ** 2, 0.))
+        variances = squares / (counts - 1)
+    return means, variances, counts
+
+
+def replicate_sigma(variances: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    # standard error of every mean; points without spread information get the median error of their set (or of all
+    # sets), so the weights stay finite and positive.
+    # The variance of a point is never taken below the pooled variance of its set: from two or three replicates it
+    # is often close to zero by chance, and a point weighted that heavily makes the fit ill-conditioned (slow to
+    # converge and prone to runaway parameters) without making it any more accurate
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        pooled = np.nanmean(variances, axis=1, keepdims=True)
+        sigma = np.sqrt(np.fmax(variances, pooled) / counts)
+        sigma[~np.isfinite(sigma) | (sigma <= 0)] = np.nan
+        set_median = np.nanmedian(sigma, axis=1, keepdims=True)
+    finite = ~np.isnan(sigma)
+    overall = np.median(sigma[finite]) if finite.any() else 1.
+    set_median = np.where(np.isnan(set_median), overall, set_median)
+    return np.where(finite, sigma, set_median)
@@ -0,0 +1,299 @@
+import base64
+import hashlib
+import html
+import io
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+
+from summary import results_table, group_titers, group_summary_rows, sweep_table, triage_flag, \
+    SUMMARY_COLUMNS
+
+
+# Run report: the figure of every group, the summary titer plot and the result tables in one multi-page PDF or one
+# self-contained HTML file. Figures are drawn to PNG by a process pool from plain data, so no Sample or group objects
+# cross the process boundary. Identical images (e.g. a group without outliers plotted with and without them) are
+# rendered and stored once.
+
+PDF = 'pdf'
+HTML = 'html'
+
+DPI = 100
+CURVE_POINT_COUNT = 80
+
+markers = ['^', '3', 'P', 'x', 'v', 'p', '+', 'o', 's', 'd', '>', 'D']
+colors = ['violet', 'purple', 'blue', 'lime', 'aqua', 'gold', 'chartreuse',
+          'orangered', 'firebrick', 'dodgerblue', 'indigo', 'darkorange']
+
+SAMPLE_COLUMNS = ['Sample', 'Endpoint titer', 'Titer SE', 'R^2', 'Adj. R^2', 'RMSE', 'DW', 'Fit', 'QC', 'Outlier',
+                  'Triage']
+GROUP_COLUMNS = ['Group', 'Cutoff', 'Average titer', 'Standard error', 'CI low', 'CI high'] + SUMMARY_COLUMNS
+
+
+def _format(value) -> str:
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    if isinstance(value, float):
+        return f'{value:.4g}' if abs(value) < 1000 else f'{value:.0f}'
+    return str(value)
+
+
+def group_figure_data(group, without_outliers: bool = False) -> dict:
+    # everything needed to draw the group figure, curves are evaluated here since they need the fitted samples
+    samples = [sample for sample in group.get_fit_samples() if sample.is_fitted()]
+    if without_outliers:
+        samples = [sample for sample in samples if sample.name not in group.outliers]
+    curves = list()
+    for sample in samples:
+        curve_x = np.linspace(sample.xdata[0], sample.xdata[-1], CURVE_POINT_COUNT + 1)
+        curves.append({
+            'name': str(sample.name),
+            'xdata': list(sample.xdata),
+            'ydata': list(sample.ydata),
+            'curve_x': curve_x,
+            'curve_y': np.array([sample.approximate(x) for x in curve_x], dtype=float),
+            'r2': sample.R2,
+            'sigma': None if sample.sigma is None else np.asarray(sample.sigma, dtype=float),
+        })
+    title = f'{group.name} without outliers' if without_outliers else str(group.name)
+    return {'kind': 'group', 'title': title, 'samples': curves}
+
+
+def summary_figure_data(groups: list, table: np.ndarray) -> dict:
+    return {'kind': 'summary',
+            'names': [str(group.name) for group in groups],
+            'titers': group_titers(table, len(groups))}
+
+
+def render_figure(data: dict, image_format: str = HTML):
+    """
+    Runs in the worker processes: draw one figure with the Agg canvas (no pyplot state). Returns the PNG for HTML
+    reports and the (height, width, 3) RGB pixels for PDF reports, which are placed on the PDF pages as they are.
+    """
+    figure = Figure(figsize=(8, 6) if data['kind'] == 'summary' else (6.4, 4.8), dpi=DPI)
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+
+    if data['kind'] == 'group':
+        for index, sample in enumerate(data['samples']):
+            color = colors[index % len(colors)]
+            r2 = '' if sample['r2'] is None else f' R^2={sample["r2"]:.3f}'
+            ax.scatter(sample['xdata'], sample['ydata'], marker=markers[index % len(markers)], color=color,
+                       label=f'{sample["name"]}{r2}')
+            if sample['sigma'] is not None:
+                ax.errorbar(sample['xdata'], sample['ydata'], yerr=sample['sigma'], linestyle='none', color=color)
+            ax.plot(sample['curve_x'], sample['curve_y'], linestyle='-', color=color)
+        ax.spines['left'].set_color('darkblue')
+        ax.spines['bottom'].set_color('darkblue')
+        ax.spines['right'].set_visible(False)
+        ax.spines['top'].set_visible(False)
+        ax.set_title(data['title'])
+        ax.set_xlabel('Log10[Dilution]')
+        ax.set_ylabel('OD450 nm')
+        if len(data['samples']) > 0:
+            legend = ax.legend(fontsize='small')
+            legend.get_frame().set_facecolor('none')
+            legend.get_frame().set_linewidth(0.0)
+    else:
+        group_offset = 1
+        sample_offset = 0.001
+        for group_index, titers in enumerate(data['titers']):
+            color = colors[group_index % len(colors)]
+            fake_xdata = [group_offset * group_index + sample_index * sample_offset
+                          for sample_index in range(len(titers))]
+            ax.scatter(fake_xdata, titers, s=20, color=color)
+            if len(titers) > 0:
+                ax.scatter([group_offset * group_index], [np.mean(titers)], marker='_', s=400, color=color)
+        ax.set_title('Average Endpoint Titer', fontsize=18)
+        if any(len(titers) > 0 for titers in data['titers']):
+            ax.set_yscale('log')
+        # label every group while it stays readable
+        step = max(1, len(data['names']) // 40)
+        ax.set_xticks(range(0, len(data['names']), step), data['names'][::step], rotation=90, fontsize='small')
+        figure.tight_layout()
+
+    if image_format == PDF:
+        figure.canvas.draw()
+        return np.array(figure.canvas.buffer_rgba())[:, :, :3]
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def render_figures(figures: list, image_format: str, worker_count: int | None = None) -> list:
+    if worker_count is None:
+        worker_count = os.cpu_count() or 1
+    if worker_count <= 1 or len(figures) < 2:
+        return [render_figure(data, image_format) for data in figures]
+    # spawned workers only import this module, forking a process with a running GUI is not safe
+    with ProcessPoolExecutor(worker_count, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(partial(render_figure, image_format=image_format), figures,
+                                 chunksize=max(1, len(figures) // (worker_count * 4))))
+
+
+def sample_table(group) -> list:
+    rows = list()
+    for sample in group.samples:
+        diagnostics = [None] * 3 if sample.diagnostics is None else \
+            [sample.diagnostics[name] for name in ('adjusted_r2', 'rmse', 'durbin_watson')]
+        rows.append([sample.name, sample.endpoint_titer if not sample.bad_data else None, sample.titer_se, sample.R2] +
+                    diagnostics + [sample.fit_status, sample.qc_reason, 'yes' if sample.name in group.outliers else '',
+                                   triage_flag(sample)])
+    return rows
+
+
+def group_table(groups: list, table: np.ndarray) -> list:
+    rows = list()
+    for group, summary in zip(groups, group_summary_rows(groups, table)):
+        low, high = group.average_titer_ci or (None, None)
+        rows.append([group.name, group.cutoff, group.average_titer, group.average_titer_se, low, high] + summary)
+    return rows
+
+
+def build_pages(groups: list) -> tuple:
+    """
+    Lay the report out: returns (figures, pages), figures being the data of every figure to render and pages a list of
+    (title, figure index or None, columns, rows).
+    """
+    table = results_table(groups)
+    figures = [summary_figure_data(groups, table)]
+    pages = [('Summary', 0, GROUP_COLUMNS, group_table(groups, table))]
+    for group in groups:
+        figures.append(group_figure_data(group))
+        pages.append((str(group.name), len(figures) - 1, SAMPLE_COLUMNS, sample_table(group)))
+        if len(group.outliers) > 0:
+            figures.append(group_figure_data(group, without_outliers=True))
+            pages.append((f'{group.name} without outliers', len(figures) - 1, None, None))
+        if group.sweep is not None:
+            pages.append((f'{group.name} accuracy sweep', None, *sweep_table(group)))
+    return figures, pages
+
+
+def _text_table(columns: list, rows: list) -> list:
+    # fixed-width lines for the PDF pages
+    cells = [[_format(value) for value in row] for row in rows]
+    widths = [max([len(column)] + [len(row[index]) for row in cells]) for index, column in enumerate(columns)]
+    lines = ['  '.join(column.ljust(width) for column, width in zip(columns, widths))]
+    lines += ['  '.join(value.ljust(width) for value, width in zip(row, widths)) for row in cells]
+    return lines
+
+
+def write_pdf(file_path: str, pages: list, images: list, accuracy: float | None = None):
+    # A4 pages in points, drawn as matplotlib figures; a table that does not fit below its figure continues on the
+    # following pages
+    page_width, page_height, margin = 595, 842, 30
+    font_size, leading = 7, 8.5
+    line_length = int((page_width - 2 * margin) / (0.6 * font_size))
+
+    with PdfPages(file_path, metadata={'Title': 'Endpoint titer report'}) as pdf:
+        for page_index, (title, image_index, columns, rows) in enumerate(pages):
+            header_line, table_lines = None, list()
+            if columns is not None:
+                header_line, *table_lines = [line[:line_length] for line in _text_table(columns, rows)]
+            if page_index == 0 and accuracy is not None:
+                title = f'{title} (accuracy {accuracy})'
+
+            first = True
+            while first or len(table_lines) > 0:
+                figure = Figure(figsize=(page_width / 72, page_height / 72))
+                top = page_height - margin
+                figure.text(margin / page_width, (top - 14) / page_height, title if first else f'{title} (continued)',
+                            fontsize=14, family='sans-serif')
+                top -= 28
+                if first and image_index is not None:
+                    image = images[image_index]
+                    height, width = image.shape[:2]
+                    scale = min((page_width - 2 * margin) / width, 460 / height)
+                    top -= height * scale
+                    ax = figure.add_axes((margin / page_width, top / page_height, width * scale / page_width,
+                                          height * scale / page_height))
+                    ax.imshow(image, interpolation='none')
+                    ax.set_axis_off()
+                    top -= 14
+                if header_line is not None:
+                    row_count = max(1, int((top - margin) / leading) - 1)
+                    chunk, table_lines = table_lines[:row_count], table_lines[row_count:]
+                    figure.text(margin / page_width, top / page_height, '\n'.join([header_line] + chunk),
+                                fontsize=font_size, family='monospace', va='top', linespacing=leading / font_size)
+                pdf.savefig(figure)
+                first = False
+
+
+def write_html(file_path: str, pages: list, images: list, accuracy: float | None = None):
+    # every image is embedded once as a CSS class and referenced from as many pages as need it
+    styles = [f'.image-{index} {{background-image: url(data:image/png;base64,'
+              f'{base64.b64encode(image).decode("ascii")});}}' for index, image in enumerate(images)]
+
+    body = list()
+    for title, image_index, columns, rows in pages:
+        body.append(f'<section><h2>{html.escape(title)}</h2>')
+        if image_index is not None:
+            # the PNG size is in the IHDR chunk right after the signature
+            image = images[image_index]
+            width, height = int.from_bytes(image[16:20], 'big'), int.from_bytes(image[20:24], 'big')
+            body.append(f'<div class="figure image-{image_index}" style="width:{width}px;height:{height}px"></div>')
+        if columns is not None:
+            body.append('<table><tr>' + ''.join(f'<th>{html.escape(column)}</th>' for column in columns) + '</tr>')
+            for row in rows:
+                body.append('<tr>' + ''.join(f'<td>{html.escape(_format(value))}</td>' for value in row) + '</tr>')
+            body.append('</table>')
+        body.append('</section>')
+
+    subtitle = '' if accuracy is None else f'<p>Calculation accuracy: {accuracy}</p>'
+    with open(file_path, 'w', encoding='UTF8') as f:
+        f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Endpoint titer report</title><style>\n'
+                'body {font-family: sans-serif; margin: 2em;}\n'
+                'table {border-collapse: collapse; font-size: small;}\n'
+                'td, th {border: 1px solid #ccc; padding: 2px 6px; text-align: right;}\n'
+                '.figure {background-size: contain; background-repeat: no-repeat;}\n'
+                + '\n'.join(styles) +
+                f'\n</style></head><body><h1>Endpoint titer report</h1>{subtitle}\n')
+        f.write('\n'.join(body))
+        f.write('\n</body></html>\n')
+
+
+def prepare_report(groups: list, file_path: str, accuracy: float | None = None) -> tuple:
+    """
+    Take everything the report of the groups needs from them: returns (file path, format, pages, figures, accuracy)
+    of plain data, so finish_report() can run on another thread while the groups change. The groups need to have their
+    titers calculated.
+    """
+    report_format = HTML if file_path.lower().endswith(('.html', '.htm')) else PDF
+    figures, pages = build_pages(groups)
+
+    # identical figures are rendered and stored once, pages refer to the unique ones
+    unique = dict()
+    indices = list()
+    for data in figures:
+        indices.append(unique.setdefault(hashlib.sha1(pickle.dumps(data)).digest(), len(unique)))
+    unique_figures = [None] * len(unique)
+    for data, index in zip(figures, indices):
+        unique_figures[index] = data
+    pages = [(title, None if image_index is None else indices[image_index], columns, rows)
+             for title, image_index, columns, rows in pages]
+    return file_path, report_format, pages, unique_figures, accuracy
+
+
+def finish_report(report: tuple, worker_count: int | None = None):
+    # render the figures of a prepared report and write the file
+    file_path, report_format, pages, figures, accuracy = report
+    images = render_figures(figures, report_format, worker_count)
+    if report_format == HTML:
+        write_html(file_path, pages, images, accuracy)
+    else:
+        write_pdf(file_path, pages, images, accuracy)
+
+
+def write_report(groups: list, file_path: str, accuracy: float | None = None, worker_count: int | None = None):
+    """
+    Render the report of the groups to `file_path`, a PDF or an HTML file depending on the extension. The groups need
+    to have their titers calculated.
+    """
+    finish_report(prepare_report(groups, file_path, accuracy), worker_count)
@@ -0,0 +1,69 @@
+import numpy as np
+
+
+LN10 = np.log(10.)
+
+
+# log10(1 + 10^t) without overflow: steep curves have t far beyond the float range on their lower plateau
+def log1p_power(t):
+    return np.logaddexp(0., t * LN10) / LN10
+
+
+# vectorized counterpart of Sample.asymmetrical_reverse_sigmoid: all arguments are broadcast against each other,
+# lo and hi are the per-sample min(ydata) and max(ydata). (1 + 10^(a(x - b)))^c is evaluated in log space
+def asymmetrical_reverse_sigmoid(x, lo, hi, a, b, c):
+    with np.errstate(over='ignore', invalid='ignore'):
+        return lo + (hi - lo) * np.power(10., -c * log1p_power(a * (x - b)))
+
+
+# partial derivatives of asymmetrical_reverse_sigmoid with respect to a, b and c
+def asymmetrical_reverse_sigmoid_gradient(x, lo, hi, a, b, c):
+    with np.errstate(over='ignore', invalid='ignore'):
+        t = a * (x - b)
+        log_g = log1p_power(t)
+        # g^-c and u/g with u = 10^t, g = 1 + u, both in log space
+        scaled = np.power(10., -c * log_g)
+        share = np.power(10., t - log_g)
+        common = -(hi - lo) * c * scaled * share * LN10
+        da = common * (x - b)
+        db = -common * a
+        dc = -(hi - lo) * scaled * log_g * LN10
+    # points far on the plateau can still give inf/nan while their true derivative is zero
+    return np.nan_to_num(da), np.nan_to_num(db), np.nan_to_num(dc)
+
+
+# log10(w - 1) for w = ((hi - lo) / (y - lo))^(1/c), from log10(w) so that w itself never overflows
+def log_w_minus_one(y, lo, hi, c):
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        log_w = np.log10((hi - lo) / (y - lo)) / c
+        return log_w + np.log10(-np.expm1(-log_w * LN10))
+
+
+# closed-form inverse of asymmetrical_reverse_sigmoid: x at which the curve equals y, all arguments are broadcast.
+# Returns NaN where y is outside of the (lo, hi) range of the curve
+def revert_asymmetrical_reverse_sigmoid(y, lo, hi, a, b, c):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return b + log_w_minus_one(y, lo, hi, c) / a
+
+
+# vectorized counterpart of Sample.revert_x_asymmetrical: the crossing is looked for within [x_min, x_max] only, the
+# curve is descending so levels above the curve at x_min give x_min and levels below it at x_max give x_max
+def revert_x(y, lo, hi, a, b, c, x_min, x_max):
+    x = revert_asymmetrical_reverse_sigmoid(y, lo, hi, a, b, c)
+    above = y >= asymmetrical_reverse_sigmoid(x_min, lo, hi, a, b, c)
+    x = np.where(above, x_min, x)
+    x = np.where(np.isnan(x) & ~above, x_max, x)
+    return np.clip(x, x_min, x_max)
+
+
+# partial derivatives of revert_asymmetrical_reverse_sigmoid (the crossing x) with respect to a, b and c, with lo, hi
+# and the level y held fixed
+def revert_gradient(y, lo, hi, a, b, c):
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        ratio = (hi - lo) / (y - lo)
+        x = b + log_w_minus_one(y, lo, hi, c) / a
+        da = -(x - b) / a
+        db = np.ones_like(x)
+        # w / (w - 1) = 1 / (1 - 1/w)
+        dc = -np.log(ratio) / (a * c * c * -np.expm1(-np.log(ratio) / c) * LN10)
+    return da, db, dc
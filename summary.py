@@ -0,0 +1,144 @@
+import numpy as np
+
+from titers import cutoff_multiplier_accuracies
+
+
+# Numeric summary of the calculated titers. The results are kept as one columnar table (a structured array with a row
+# per sample that has a titer), the per-group statistics are computed from it in one grouped pass. The same table
+# feeds the summary plot, the console output and the exports, the columns below are the same in all of them.
+
+ESTIMATED = 'estimated'
+FITTED = 'fitted'
+
+RESULT_DTYPE = np.dtype([
+    ('group', np.int64),
+    ('sample', object),
+    ('titer', np.float64),
+    ('titer_se', np.float64),
+    ('outlier', np.bool_),
+    ('triage', 'U9'),
+])
+
+SUMMARY_DTYPE = np.dtype([
+    ('group', np.int64),
+    ('count', np.int64),
+    ('mean', np.float64),
+    ('geometric_mean', np.float64),
+    ('median', np.float64),
+    ('sd', np.float64),
+    ('cv', np.float64),
+    ('estimated', np.int64),
+    ('fitted', np.int64),
+])
+
+# the average titers of an accuracy sweep (AnalyticalGroup.sweep_accuracies()), empty for groups without one
+SWEEP_COLUMNS = [f'Average titer {accuracy:g}%' for accuracy in cutoff_multiplier_accuracies]
+SUMMARY_COLUMNS = ['Count', 'Mean', 'Geometric mean', 'Median', 'SD', 'CV', 'Estimated', 'Fitted'] + SWEEP_COLUMNS
+
+
+def triage_flag(sample) -> str:
+    # whether triage estimated the titer of the sample or fitted it, empty for samples that were not triaged
+    if sample.triage_borderline is None:
+        return ''
+    return FITTED if sample.triage_borderline else ESTIMATED
+
+
+def results_table(groups: list) -> np.ndarray:
+    # one row per sample with a usable titer, sorted by group and titer
+    rows = [(group_index, sample.name, sample.endpoint_titer,
+             np.nan if sample.titer_se is None else sample.titer_se, sample.name in group.outliers,
+             triage_flag(sample))
+            for group_index, group in enumerate(groups) for sample in group.samples
+            if not sample.bad_data and sample.endpoint_titer is not None]
+    table = np.array(rows, dtype=RESULT_DTYPE)
+    return table[np.lexsort((table['titer'], table['group']))]
+
+
+def summarize(table: np.ndarray, group_count: int) -> np.ndarray:
+    """
+    Per-group count, arithmetic and geometric mean, median, sample standard deviation and coefficient of variation
+    of the titers in a table sorted by group and titer (see results_table()), with the number of them triage
+    estimated and fitted. Groups without titers get NaN.
+    """
+    summary = np.zeros(group_count, dtype=SUMMARY_DTYPE)
+    summary['group'] = np.arange(group_count)
+    groups, titers = table['group'], table['titer']
+    counts = np.bincount(groups, minlength=group_count)
+    summary['count'] = counts
+    summary['estimated'] = np.bincount(groups[table['triage'] == ESTIMATED], minlength=group_count)
+    summary['fitted'] = np.bincount(groups[table['triage'] == FITTED], minlength=group_count)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.bincount(groups, weights=titers, minlength=group_count) / counts
+        summary['mean'] = means
+        summary['geometric_mean'] = np.exp(np.bincount(groups, weights=np.log(titers), minlength=group_count) / counts)
+        squares = np.bincount(groups, weights=(titers - means[groups]) ** 2, minlength=group_count)
+        summary['sd'] = np.where(counts > 1, np.sqrt(squares / (counts - 1)), np.nan)
+        summary['cv'] = summary['sd'] / means
+
+    # the table is sorted, so the median of every group sits in the middle of its segment
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    present = counts > 0
+    lower = starts[present] + (counts[present] - 1) // 2
+    upper = starts[present] + counts[present] // 2
+    summary['median'] = np.nan
+    summary['median'][present] = (titers[lower] + titers[upper]) / 2
+    return summary
+
+
+def titers_summary_row(titers, sweep: dict | None = None) -> list:
+    # summary values of a single group from its titers alone, in the order of SUMMARY_COLUMNS
+    table = np.zeros(len(titers), dtype=RESULT_DTYPE)
+    table['titer'] = np.sort(titers)
+    return summary_rows(summarize(table, 1), [sweep])[0]
+
+
+def group_titers(table: np.ndarray, group_count: int) -> list:
+    # titers of every group as views into the sorted table
+    bounds = np.searchsorted(table['group'], np.arange(group_count + 1))
+    return [table['titer'][bounds[index]:bounds[index + 1]] for index in range(group_count)]
+
+
+def sweep_averages(sweep: dict | None) -> list:
+    # average titers of a sweep in the order of SWEEP_COLUMNS, None for accuracies that were not swept
+    if sweep is None:
+        return [None] * len(SWEEP_COLUMNS)
+    averages = dict(zip(sweep['accuracies'], sweep['average_titers']))
+    return [None if accuracy not in averages or np.isnan(averages[accuracy]) else float(averages[accuracy])
+            for accuracy in cutoff_multiplier_accuracies]
+
+
+def summary_rows(summary: np.ndarray, sweeps: list | None = None) -> list:
+    # summary values in the order of SUMMARY_COLUMNS, `sweeps` are the sweeps of the groups (or None)
+    if sweeps is None:
+        sweeps = [None] * len(summary)
+    return [[int(row['count']), row['mean'], row['geometric_mean'], row['median'], row['sd'], row['cv'],
+             int(row['estimated']), int(row['fitted'])] + sweep_averages(sweep) for row, sweep in zip(summary, sweeps)]
+
+
+def group_summary_rows(groups: list, table: np.ndarray) -> list:
+    # summary values of the groups in the order of SUMMARY_COLUMNS
+    return summary_rows(summarize(table, len(groups)), [group.sweep for group in groups])
+
+
+def sweep_table(group) -> tuple:
+    """
+    The accuracy sweep of a group as (columns, rows): a cutoff row, one row per swept sample and the average titer
+    row, with a column per accuracy. Titers that are bad data for an accuracy are None.
+    """
+    sweep = group.sweep
+    columns = ['Sample'] + [f'{accuracy}' for accuracy in sweep['accuracies']]
+    rows = [['Cutoff'] + [None if np.isnan(cutoff) else float(cutoff) for cutoff in sweep['cutoffs']]]
+    for name, titers, bad_data in zip(sweep['names'], sweep['titers'], sweep['bad_data']):
+        rows.append([name] + [None if bad else float(titer) for titer, bad in zip(titers, bad_data)])
+    rows.append(['Average titer'] + [None if np.isnan(titer) else float(titer) for titer in sweep['average_titers']])
+    return columns, rows
+
+
+def print_summary(groups: list, table: np.ndarray):
+    for row in table[np.lexsort((table['group'], table['titer']))]:
+        print(f'{groups[row["group"]].name:>20} {row["titer"]:>12.0f} {row["sample"]}')
+    print(f'{"Group":>20} ' + ' '.join(f'{column:>14}' for column in SUMMARY_COLUMNS))
+    for group, row in zip(groups, group_summary_rows(groups, table)):
+        print(f'{group.name:>20} ' + ' '.join(f'{"":>14}' if value is None else f'{value:>14}'
+                                               if isinstance(value, int) else f'{value:>14.4g}' for value in row))
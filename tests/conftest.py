@@ -0,0 +1,44 @@
+import math
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from immuno_calculator import Sample, AnalyticalGroup  # noqa: E402
+from sigmoid import asymmetrical_reverse_sigmoid  # noqa: E402
+
+
+# 3-fold dilutions from 1:100, the last point is a blank used as the negative control
+XDATA = [math.log10(100. * 3. ** i) for i in range(8)]
+NEGATIVE_CONTROL_INDICES = [7]
+
+
+def make_samples(count: int = 6, seed: int = 0, a: float = 1.5, c: float = 1., noise: float = 0.02,
+                 replicates: int = 1) -> list:
+    # curves of one shape with different midpoints, every curve read `replicates` times with independent noise
+    rng = np.random.default_rng(seed)
+    x = np.array(XDATA[:-1])
+    samples = list()
+    for index in range(count):
+        lo, hi, b = rng.uniform(0.04, 0.08), rng.uniform(1.8, 3.), rng.uniform(2.8, 4.)
+        for replicate in range(replicates):
+            ydata = asymmetrical_reverse_sigmoid(x, lo, hi, a, b, c) + rng.normal(0., noise, len(x))
+            name = f'serum {index + 1}' if replicates == 1 else f'serum {index + 1} rep{replicate + 1}'
+            samples.append(Sample(name, xdata=list(XDATA), ydata=list(ydata) + [lo + rng.normal(0., 0.01)]))
+    return samples
+
+
+def make_group(samples: list, name: str = 'group') -> AnalyticalGroup:
+    group = AnalyticalGroup(name, samples)
+    group.negative_control_indices = NEGATIVE_CONTROL_INDICES
+    for sample in samples:
+        sample.group = group
+    return group
+
+
+@pytest.fixture
+def group() -> AnalyticalGroup:
+    return make_group(make_samples())
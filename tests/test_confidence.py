@@ -0,0 +1,39 @@
+import math
+
+import numpy as np
+
+from accumulators import TiterSums
+from titers import average_confidence
+
+
+def test_confidence_interval_of_spread_titers_is_positive():
+    sums = TiterSums()
+    for titer, error in [(100., 10.), (1e5, 1e4), (300., None)]:
+        sums.add(titer, error)
+    low, high = sums.confidence_interval()
+    geometric_mean = (100. * 1e5 * 300.) ** (1 / 3)
+    assert 0 < low < geometric_mean < high
+    # the normal interval on the titers themselves would start below zero here
+    assert sums.mean() - 1.96 * sums.standard_error() < 0
+
+
+def test_running_and_array_intervals_agree():
+    titers = np.array([800., 1200., 5000., 2500.])
+    errors = np.array([80., np.nan, 400., 300.])
+    sums = TiterSums()
+    for titer, error in zip(titers, errors):
+        sums.add(titer, None if math.isnan(error) else error)
+    standard_errors, lows, highs = average_confidence([titers.mean()], titers, errors, np.zeros(len(titers)))
+    assert np.isclose(sums.standard_error(), standard_errors[0])
+    assert np.allclose(sums.confidence_interval(), (lows[0], highs[0]))
+
+    sums.remove(5000., 400.)
+    standard_errors, lows, highs = average_confidence([0.], titers[[0, 1, 3]], errors[[0, 1, 3]], np.zeros(3))
+    assert np.allclose(sums.confidence_interval(), (lows[0], highs[0]))
+
+
+def test_group_interval_is_positive(group):
+    group.get_group_cutoff(99.0)
+    group.calculate_average_titer()
+    low, high = group.average_titer_ci
+    assert 0 < low < high
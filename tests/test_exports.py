@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from openpyxl import load_workbook
+
+from conftest import make_group, make_samples
+from report import build_pages
+from summary import sweep_table, titers_summary_row, ESTIMATED, FITTED, SUMMARY_COLUMNS, SWEEP_COLUMNS
+from titers import cutoff_multiplier_accuracies
+from triage import triage_groups
+from xlsx_export import write_xlsx
+
+
+def swept_group():
+    group = make_group(make_samples())
+    group.sweep_accuracies([95.0, 99.0])
+    group.apply_sweep(99.0)
+    return group
+
+
+def test_sweep_table_has_a_row_per_swept_sample():
+    group = swept_group()
+    columns, rows = sweep_table(group)
+    assert columns == ['Sample', '95.0', '99.0']
+    assert [row[0] for row in rows] == ['Cutoff'] + group.sweep['names'] + ['Average titer']
+
+
+def test_workbook_has_a_sweep_sheet(tmp_path):
+    group = swept_group()
+    file_path = tmp_path / 'results.xlsx'
+    write_xlsx([group], str(file_path), 99.0)
+    workbook = load_workbook(file_path)
+    assert workbook.sheetnames == ['Summary', 'group', 'group sweep']
+    rows = list(workbook['group sweep'].values)
+    assert list(rows[0]) == ['Sample', '95.0', '99.0']
+    assert rows[-1][0] == 'Average titer'
+
+
+def test_report_has_a_sweep_page():
+    group = swept_group()
+    _, pages = build_pages([group])
+    titles = [title for title, _, _, _ in pages]
+    assert 'group accuracy sweep' in titles
+    group.sweep = None
+    _, pages = build_pages([group])
+    assert all('sweep' not in title for title, _, _, _ in pages)
+
+
+def test_summary_sheet_has_the_triage_counts_and_the_sweep_averages(tmp_path):
+    group = make_group(make_samples())
+    estimated, fitted = triage_groups([group], 99.0)
+    group.sweep_accuracies(cutoff_multiplier_accuracies)
+    file_path = tmp_path / 'results.xlsx'
+    write_xlsx([group], str(file_path), 99.0)
+    workbook = load_workbook(file_path)
+    header, row = list(workbook['Summary'].values)
+    values = dict(zip(header, row))
+    assert (values['Estimated'], values['Fitted']) == (estimated, fitted)
+    assert [values[column] for column in SWEEP_COLUMNS] == pytest.approx(list(group.sweep['average_titers']))
+    sample_header, *sample_rows = list(workbook['group'].values)
+    flags = [dict(zip(sample_header, sample_row))['Triage'] for sample_row in sample_rows]
+    assert sorted(flag for flag in flags if flag) == sorted([ESTIMATED] * estimated + [FITTED] * fitted)
+
+
+def test_summary_row_without_a_sweep_has_empty_sweep_columns():
+    row = titers_summary_row(np.array([100., 200.]))
+    assert len(row) == len(SUMMARY_COLUMNS)
+    assert row[-len(SWEEP_COLUMNS):] == [None] * len(SWEEP_COLUMNS)
+    sweep = {'accuracies': cutoff_multiplier_accuracies, 'average_titers': np.arange(len(SWEEP_COLUMNS)) + 1.}
+    assert titers_summary_row(np.array([100.]), sweep)[-len(SWEEP_COLUMNS):] == list(sweep['average_titers'])
@@ -0,0 +1,19 @@
+import numpy as np
+
+from conftest import make_samples
+from fit_budget import FitBudget, fit_with_budget, FITTED, SYMMETRIC, INTERPOLATED, SAMPLE_SECONDS
+
+
+def test_default_budget_has_a_time_limit():
+    budget = FitBudget()
+    assert budget.sample_seconds == SAMPLE_SECONDS
+    _, deadline = budget.sample_limits(8)
+    assert deadline is not None
+
+
+def test_fit_over_the_time_limit_falls_back():
+    sample = make_samples(count=1)[0]
+    xdata, ydata = np.array(sample.xdata[:-1]), np.array(sample.ydata[:-1])
+    assert fit_with_budget(xdata, ydata, FitBudget())[2] == FITTED
+    # the fallback fit is not bound by the sample time limit
+    assert fit_with_budget(xdata, ydata, FitBudget(sample_seconds=0.))[2] in (SYMMETRIC, INTERPOLATED)
@@ -0,0 +1,30 @@
+import math
+
+import immuno_calculator
+import golden
+
+
+def test_reference_fits_every_sample_once(monkeypatch):
+    calls = [0]
+    fit_with_budget = immuno_calculator.fit_with_budget
+
+    def counted(*args, **kwargs):
+        calls[0] += 1
+        return fit_with_budget(*args, **kwargs)
+
+    monkeypatch.setattr(immuno_calculator, 'fit_with_budget', counted)
+    corpus = golden.synthetic_groups(group_count=2)
+    results = golden.run_reference(corpus, 99.0)
+    assert 0 < calls[0] <= sum(len(entry['samples']) for entry in corpus)
+    assert sum(not math.isnan(titer) for titer in results['titers']) > 0
+
+
+def test_compare_flags_titers_out_of_tolerance():
+    corpus = golden.synthetic_groups(group_count=2)
+    reference = golden.run_reference(corpus, 99.0)
+    tolerances = golden.ENGINES['joint'][1]
+    labels = golden.replicate_set_labels(corpus)
+    assert golden.compare(reference, reference, tolerances, labels)['failures'] == []
+
+    shifted = dict(reference, titers=[titer * 10 ** (tolerances['log_titer'] + 0.1) for titer in reference['titers']])
+    assert golden.compare(shifted, reference, tolerances, labels)['failures'] == ['titer', 'median titer']
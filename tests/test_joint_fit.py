@@ -0,0 +1,44 @@
+import numpy as np
+
+from conftest import make_group, make_samples
+from joint_fit import fit_joint_sigmoid, slope_bounds, asymmetry_bounds
+
+
+def test_joint_fit_shares_slope_and_asymmetry(group):
+    group.joint_fit = True
+    assert group.fit_jointly()
+
+    popt = np.array([sample.popt for sample in group.samples])
+    assert np.all(popt[:, 0] == popt[0, 0]) and np.all(popt[:, 2] == popt[0, 2])
+    assert len(set(popt[:, 1])) == len(group.samples)
+    assert all(sample.fit_note == 'joint' for sample in group.samples)
+    # the samples were drawn with a = 1.5, c = 1
+    assert abs(popt[0, 0] - 1.5) < 0.3 and abs(popt[0, 2] - 1.) < 0.3
+
+
+def test_joint_titers_keep_the_shared_shape(group):
+    group.joint_fit = True
+    group.get_group_cutoff(99.0)
+    shapes = set((sample.popt[0], sample.popt[2]) for sample in group.samples)
+    assert len(shapes) == 1
+    assert all(sample.endpoint_titer is not None for sample in group.samples)
+
+
+def test_step_like_group_stays_within_the_bounds():
+    samples = make_samples(a=40., c=0.3, noise=0.01)
+    popt, pcov = fit_joint_sigmoid([sample.xdata for sample in samples], [sample.ydata for sample in samples])
+    assert slope_bounds[0] <= popt[0, 0] <= slope_bounds[1]
+    assert asymmetry_bounds[0] <= popt[0, 2] <= asymmetry_bounds[1]
+    assert np.all(np.isfinite(popt))
+
+
+def test_replicate_errors_weight_the_joint_fit():
+    group = make_group(make_samples(replicates=3))
+    group.joint_fit = True
+    group.collapse_replicates = True
+    samples = group.get_fit_samples()
+    assert all(sample.sigma is not None for sample in samples)
+    weighted, _ = fit_joint_sigmoid([s.xdata for s in samples], [s.ydata for s in samples],
+                                    sigma=[s.sigma for s in samples])
+    unweighted, _ = fit_joint_sigmoid([s.xdata for s in samples], [s.ydata for s in samples])
+    assert not np.allclose(weighted, unweighted)
@@ -0,0 +1,31 @@
+from fit_budget import INTERPOLATED, FITTED
+
+
+def test_timed_out_preview_makes_the_sample_stale(group):
+    group.get_group_cutoff(99.0)
+    group.calculate_average_titer()
+    sample = group.samples[0]
+    sample.ydata[2] *= 0.5
+
+    sample.apply_preview_fit(None, None, INTERPOLATED, 'run budget exhausted')
+    sample.calculate_endpoint_titer(group.cutoff, refit=False)
+    group.calculate_average_titer()
+    assert sample.stale and sample.popt is not None
+    assert sample.endpoint_titer is None and sample.titer_se is None
+    assert group.titer_sums.count == len(group.samples) - 1
+    assert sample not in group.titer_contributions
+
+    # the next full fit brings it back
+    group.get_group_cutoff(99.0)
+    group.calculate_average_titer()
+    assert not sample.stale and sample.endpoint_titer is not None
+    assert group.titer_sums.count == len(group.samples)
+
+
+def test_finished_preview_replaces_the_fit(group):
+    group.get_group_cutoff(99.0)
+    sample = group.samples[0]
+    popt = sample.popt * 1.01
+    sample.apply_preview_fit(popt, sample.pcov, FITTED, '')
+    sample.calculate_endpoint_titer(group.cutoff, refit=False)
+    assert not sample.stale and sample.popt is popt and sample.endpoint_titer is not None
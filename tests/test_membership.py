@@ -0,0 +1,33 @@
+import numpy as np
+
+import immuno_calculator
+from conftest import make_group, make_samples
+
+
+def test_moved_cutoff_recalculates_titers_without_refitting(monkeypatch):
+    group = make_group(make_samples(count=6, seed=1))
+    group.get_group_cutoff(99.0)
+    group.calculate_average_titer()
+    other = make_group(make_samples(count=2, seed=2), 'other')
+    other.get_group_cutoff(99.0)
+    sample = other.samples[0]
+    # a high blank moves the cutoff of the group the sample joins
+    sample.ydata[-1] = 0.3
+
+    def no_fit(*args, **kwargs):
+        raise AssertionError('refitted')
+
+    monkeypatch.setattr(immuno_calculator, 'fit_with_budget', no_fit)
+    cutoff = group.cutoff
+    other.remove_sample(sample)
+    sample.group = group
+    group.add_sample(sample)
+    assert group.cutoff != cutoff
+    assert group.average_titer is not None
+    assert group.titer_sums.count == len(group.samples)
+
+    expected = [sample.endpoint_titer for sample in group.samples]
+    immuno_calculator.calculate_titers(group.samples, group.cutoff)
+    assert np.allclose(expected, [sample.endpoint_titer for sample in group.samples])
+    assert np.isclose(group.average_titer, np.mean(expected))
+
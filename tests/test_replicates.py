@@ -0,0 +1,27 @@
+from conftest import make_group, make_samples
+from triage import triage_groups
+
+
+def collapsed_group():
+    group = make_group(make_samples(count=4, replicates=2))
+    group.collapse_replicates = True
+    return group
+
+
+def test_sweep_with_collapsed_replicates_has_an_average():
+    group = collapsed_group()
+    group.sweep_accuracies([95.0, 99.0])
+    assert group.sweep['names'] == [sample.name for sample in group.get_fit_samples()]
+    group.apply_sweep(99.0)
+    assert group.average_titer is not None
+    assert group.titer_sums.count == len(group.get_fit_samples())
+    for replicate_sample in group.get_fit_samples():
+        assert all(sample.endpoint_titer == replicate_sample.endpoint_titer for sample in replicate_sample.replicates)
+
+
+def test_triage_with_collapsed_replicates_has_an_average():
+    group = collapsed_group()
+    estimated, fitted = triage_groups([group], 99.0)
+    assert estimated + fitted == len(group.get_fit_samples())
+    assert group.average_titer is not None
+    assert all(sample.endpoint_titer is not None for sample in group.samples)
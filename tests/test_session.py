@@ -0,0 +1,58 @@
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip('PySide6')
+
+from conftest import make_samples, NEGATIVE_CONTROL_INDICES  # noqa: E402
+from immuno_calculator import AnalyticalGroup  # noqa: E402
+from logic import Logic  # noqa: E402
+from logic.plate import Plate  # noqa: E402
+from logic.session import MAGIC, load_session, save_session  # noqa: E402
+
+
+def plate_logic() -> Logic:
+    logic = Logic()
+    samples = make_samples(count=4)
+    rows = np.array([sample.ydata for sample in samples]).T.tolist()
+    plate = Plate('plate.xlsx', 'plate 1', rows, [sample.name for sample in samples])
+    plate.recalculate_dilutions(3., 100.)
+    logic.plates = [plate]
+    group = AnalyticalGroup('group', list(plate.samples))
+    for sample in group.samples:
+        sample.group = group
+    logic.groups = [group]
+    group.negative_control_indices = NEGATIVE_CONTROL_INDICES
+    group.get_group_cutoff(99.0)
+    group.calculate_average_titer()
+    return logic
+
+
+def test_session_round_trip(tmp_path):
+    logic = plate_logic()
+    file_path = tmp_path / 'session.etsession'
+    save_session(logic, str(file_path))
+
+    restored = Logic()
+    load_session(restored, str(file_path))
+    assert restored.plates[0].log_dilutions == logic.plates[0].log_dilutions
+    (group,), (restored_group,) = logic.groups, restored.groups
+    assert restored_group.accuracy == group.accuracy
+    assert restored_group.average_titer == pytest.approx(group.average_titer)
+    assert [sample.titer_se for sample in restored_group.samples] == \
+        pytest.approx([sample.titer_se for sample in group.samples], nan_ok=True)
+
+
+def test_session_without_a_key_does_not_load(tmp_path):
+    file_path = tmp_path / 'session.etsession'
+    save_session(plate_logic(), str(file_path))
+    data = file_path.read_bytes()
+    header_length = int.from_bytes(data[len(MAGIC):len(MAGIC) + 8], 'little')
+    header = json.loads(data[len(MAGIC) + 8:len(MAGIC) + 8 + header_length])
+    del header['ui']['collapse_replicates']
+    # same length, so the block offsets stay valid
+    header_bytes = json.dumps(header).encode('utf-8').ljust(header_length)
+    file_path.write_bytes(data[:len(MAGIC) + 8] + header_bytes + data[len(MAGIC) + 8 + header_length:])
+    with pytest.raises(KeyError):
+        load_session(Logic(), str(file_path))
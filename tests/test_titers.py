@@ -0,0 +1,26 @@
+import numpy as np
+
+from conftest import NEGATIVE_CONTROL_INDICES, XDATA
+from qc import to_matrix
+from titers import compute_titers
+
+
+def test_group_titers_come_from_the_array_core(group):
+    group.get_group_cutoff(99.0)
+    group.calculate_average_titer()
+
+    readings, _ = to_matrix([sample.ydata for sample in group.samples])
+    samples, groups = compute_titers(readings, np.zeros(len(readings)), XDATA, NEGATIVE_CONTROL_INDICES, 99.0)
+    assert groups['cutoff'][0] == group.cutoff
+    assert np.allclose([sample.endpoint_titer for sample in group.samples], samples['titer'], rtol=1e-12)
+    assert np.allclose([sample.titer_se for sample in group.samples], samples['titer_se'], rtol=1e-9)
+    assert np.isclose(group.average_titer, groups['average_titer'][0], rtol=1e-12)
+
+
+def test_sample_titer_matches_the_group(group):
+    group.get_group_cutoff(99.0)
+    sample = group.samples[0]
+    titer, error = sample.endpoint_titer, sample.titer_se
+    sample.endpoint_titer = sample.titer_se = None
+    sample.calculate_endpoint_titer(group.cutoff, refit=False)
+    assert (sample.endpoint_titer, sample.titer_se) == (titer, error)
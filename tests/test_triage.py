@@ -0,0 +1,29 @@
+import numpy as np
+
+from conftest import make_group, make_samples
+from triage import interpolate_crossings, triage_groups
+
+
+X = np.array([[2., 2.5, 3., 3.5, 4., 4.5, 5.]])
+
+
+def test_only_ambiguous_crossings_are_borderline():
+    ydata = np.array([
+        [2., 1.9, 1.6, 1., .4, .15, .1],   # crosses in the middle
+        [2., .6, .3, .2, .15, .12, .1],    # crosses in the first interval
+        [2., 1.9, 1.8, 1.7, 1.6, 1.5, .1],  # crosses in the last interval
+        [2., 1.9, .5, 1.2, .4, .15, .1],   # crosses three times
+    ])
+    log_titers, borderline = interpolate_crossings(np.repeat(X, len(ydata), axis=0), ydata, np.full(len(ydata), .8))
+    assert borderline.tolist() == [False, True, True, True]
+    assert np.isclose(log_titers[0], 3.5 + .5 * .2 / .6)
+
+
+def test_triage_fits_fewer_samples_than_it_estimates():
+    groups = [make_group(make_samples(count=8, seed=seed), f'group {seed}') for seed in range(3)]
+    sample_count = sum(len(group.samples) for group in groups)
+    estimated, fitted = triage_groups(groups, 99.0)
+    assert estimated + fitted == sample_count
+    assert fitted < sample_count / 2
+    assert sum(sample.popt is not None for group in groups for sample in group.samples) == fitted
+    assert all(group.average_titer is not None for group in groups)
@@ -0,0 +1,292 @@
+import warnings
+from pathlib import Path
+
+import numpy as np
+import openpyxl
+from scipy.stats import norm, t
+
+from fit_budget import FitBudget, fit_with_budget, INTERPOLATED
+from qc import screen, BELOW_CUTOFF
+from diagnostics import diagnose
+from sigmoid import LN10, revert_x, revert_asymmetrical_reverse_sigmoid, revert_gradient
+
+
+# Stateless array API for endpoint titers. No Qt, no pandas and no Sample/AnalyticalGroup objects are involved, so it
+# can be embedded into pipelines directly. curve_titers() is the titer stage of compute_titers(); AnalyticalGroup (and
+# so the GUI and the command line) and the batch runs fit their curves their own way and then read the titers from them
+# with it as well, so every path inverts the curves, flags bad data and propagates the titer errors with the same code.
+
+cutoff_multiplier_accuracies = [95.0, 97.5, 99.0, 99.5, 99.9]
+multipliers_path = Path(__file__).parent / 'Standard deviation multipliers.xlsx'
+# two-sided confidence level of the intervals around the average titers
+confidence_level = 0.95
+
+SAMPLE_DTYPE = np.dtype([
+    ('group', np.int64),
+    ('a', np.float64), ('b', np.float64), ('c', np.float64),
+    ('r2', np.float64),
+    ('cutoff', np.float64),
+    ('titer', np.float64),
+    ('titer_se', np.float64),
+    ('bad_data', np.bool_),
+    ('fit_status', 'U12'),
+    ('qc_reason', 'U16'),
+])
+
+GROUP_DTYPE = np.dtype([
+    ('group', np.int64),
+    ('cutoff', np.float64),
+    ('count', np.int64),
+    ('average_titer', np.float64),
+    ('titer_se', np.float64),
+    ('ci_low', np.float64),
+    ('ci_high', np.float64),
+])
+
+_multipliers = None
+
+
+def get_multipliers_table() -> tuple:
+    """
+    Returns (control counts, multipliers) from the standard deviation multipliers workbook, multipliers having one
+    column per accuracy in cutoff_multiplier_accuracies. The workbook is read once.
+    """
+    global _multipliers
+    if _multipliers is None:
+        sheet = openpyxl.load_workbook(multipliers_path, read_only=True).active
+        rows = [[cell.value for cell in row] for row in sheet.iter_rows(2, sheet.max_row)]
+        rows = [row for row in rows if row[0] is not None]
+        _multipliers = (np.array([row[0] for row in rows], dtype=np.int64),
+                        np.array([row[1:1 + len(cutoff_multiplier_accuracies)] for row in rows], dtype=np.float64))
+    return _multipliers
+
+
+def get_multipliers(count: int, accuracies) -> np.ndarray:
+    # the table is not tabulated for every control count, use the closest smaller count (the larger, safer multiplier)
+    counts, table = get_multipliers_table()
+    row = np.searchsorted(counts, count, side='right') - 1
+    if row < 0:
+        raise ValueError(f'no standard deviation multiplier for {count} negative controls')
+    columns = [cutoff_multiplier_accuracies.index(accuracy) for accuracy in np.atleast_1d(accuracies)]
+    return table[row, columns]
+
+
+def group_cutoffs(values, accuracies) -> np.ndarray:
+    # cutoffs for the negative control values at every accuracy, missing wells are skipped, NaN if there are no values
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return cutoffs_from_stats(0, np.nan, np.nan, accuracies)
+    return cutoffs_from_stats(len(values), np.mean(values), np.std(values), accuracies)
+
+
+def cutoffs_from_stats(count: int, mean: float, deviation: float, accuracies) -> np.ndarray:
+    # the same as group_cutoffs() from the count, mean and (population) standard deviation of the control values
+    accuracies = np.atleast_1d(accuracies)
+    if count == 0:
+        return np.full(len(accuracies), np.nan)
+    if count == 1:
+        return np.full(len(accuracies), mean)
+    return mean + deviation * get_multipliers(count, accuracies)
+
+
+def orient(readings: np.ndarray) -> np.ndarray:
+    # curves are fitted as descending, ascending rows are reversed (same as Sample does)
+    readings = np.array(readings, dtype=np.float64)
+    ascending = readings[:, 0] < readings[:, -1]
+    readings[ascending] = readings[ascending, ::-1]
+    return readings
+
+
+def curve_r2(readings, xdata, lo, hi, popt, interpolated) -> np.ndarray:
+    # R^2 of all curves at once, NaN for rows without a fit; the interpolated estimate passes through every point
+    return diagnose(readings, xdata, lo, hi, popt, interpolated)[0]['r2']
+
+
+def curve_log_titers(readings, xdata, cutoffs, lo, hi, popt, interpolated) -> np.ndarray:
+    # log10 titers of all curves at once, clamped to the dilution range of every row; rows of different lengths are
+    # NaN-padded
+    x_min, x_max = np.nanmin(xdata, axis=1), np.nanmax(xdata, axis=1)
+    log_titers = revert_x(cutoffs, lo, hi, popt[:, 0], popt[:, 1], popt[:, 2], x_min, x_max)
+    for index in np.flatnonzero(interpolated):
+        # the interpolated curve is piecewise linear, invert it the same way (x is read for descending y)
+        known = ~np.isnan(readings[index]) & ~np.isnan(xdata[index])
+        row, x = readings[index][known], xdata[index][known]
+        order = np.argsort(row)
+        log_titers[index] = np.clip(np.interp(cutoffs[index], row[order], x[order]), x_min[index], x_max[index])
+    return log_titers
+
+
+def curve_titers(readings, xdata, cutoffs, lo, hi, popt, pcov, interpolated, passed) -> tuple:
+    """
+    Endpoint titers of fitted curves and their standard errors. readings and xdata are (samples, points) arrays (rows
+    of different lengths NaN-padded), popt (samples, 3) and pcov (samples, 3, 3) arrays, NaN for samples without a
+    parametric fit; cutoffs, lo, hi, the interpolated flags and the QC `passed` flags have one value per sample.
+
+    Returns (titers, standard errors, below cutoff): samples that passed QC but stay below their cutoff are flagged,
+    titers are NaN for them, for the samples that did not pass QC and for samples without a fit.
+    """
+    popt = np.asarray(popt, dtype=np.float64)
+    below_cutoff = np.asarray(passed) & ~(hi > cutoffs)
+    bad_data = ~np.asarray(passed) | below_cutoff
+    log_titers = curve_log_titers(readings, xdata, cutoffs, lo, hi, popt, interpolated)
+    titers = np.where(bad_data, np.nan, np.power(10., log_titers))
+    x_min, x_max = np.nanmin(xdata, axis=1), np.nanmax(xdata, axis=1)
+    return titers, titer_standard_errors(titers, cutoffs, lo, hi, popt, pcov, x_min, x_max), below_cutoff
+
+
+def titer_standard_errors(titers, cutoffs, lo, hi, popt, pcov, x_min, x_max) -> np.ndarray:
+    """
+    Delta-method standard errors of endpoint titers, propagated from the parameter covariances through the inverse of
+    the asymmetrical sigmoid: SE = titer * ln(10) * sqrt(g pcov g), g being the gradient of the crossing with respect to
+    (a, b, c). popt is (samples, 3), pcov is (samples, 3, 3), the other arguments are (samples,) arrays.
+
+    NaN where there is no titer or no finite covariance, and where the crossing is outside of the dilution range (the
+    titer is clamped to the range then and has no error of its own).
+    """
+    popt = np.asarray(popt, dtype=np.float64)
+    a, b, c = popt[:, 0], popt[:, 1], popt[:, 2]
+    gradient = np.stack(revert_gradient(cutoffs, lo, hi, a, b, c), axis=1)
+    variances = np.einsum('ni,nij,nj->n', gradient, np.asarray(pcov, dtype=np.float64), gradient)
+    x = revert_asymmetrical_reverse_sigmoid(cutoffs, lo, hi, a, b, c)
+    with np.errstate(invalid='ignore'):
+        known = (x >= x_min) & (x <= x_max) & (variances >= 0) & np.isfinite(variances)
+        return np.where(known, titers * LN10 * np.sqrt(np.where(known, variances, 0.)), np.nan)
+
+
+def average_standard_errors(counts, sums, squares, error_counts, error_squares) -> np.ndarray:
+    """
+    Standard errors of average titers from sums over the averaged titers: their count, sum and sum of squares, and the
+    count and sum of squares of their known standard errors. The variance of an average is the spread of its titers
+    between samples plus the propagated errors of the titers, s^2 / n + sum(SE^2) / n^2, with s^2 the sample variance
+    and n the count of all averaged titers. NaN without titers and for a single titer without an error.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    sums = np.asarray(sums, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = np.where(counts > 1, np.fmax(squares - sums * sums / counts, 0.) / (counts - 1), 0.)
+        variances = between / counts + error_squares / (counts * counts)
+        unknown = (counts == 0) | ((counts == 1) & (np.asarray(error_counts) == 0))
+        return np.where(unknown, np.nan, np.sqrt(variances))
+
+
+def average_confidence(averages, titers, errors, positions, level: float = confidence_level) -> tuple:
+    """
+    Standard errors and confidence intervals of the average titers, see average_standard_errors() and
+    confidence_interval(). titers are the averaged titers, errors their standard errors (NaN if unknown) and positions
+    the index of the average each of them belongs to. Returns (standard errors, lower bounds, upper bounds).
+    """
+    averages = np.asarray(averages, dtype=np.float64)
+    titers = np.asarray(titers, dtype=np.float64)
+    errors = np.asarray(errors, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.int64)
+    known = ~np.isnan(errors)
+    log_titers, log_errors = log_titers_and_errors(titers, errors)
+    counts = np.bincount(positions, minlength=len(averages))
+    error_counts = np.bincount(positions[known], minlength=len(averages))
+    standard_errors = average_standard_errors(
+        counts,
+        np.bincount(positions, weights=titers, minlength=len(averages)),
+        np.bincount(positions, weights=titers ** 2, minlength=len(averages)),
+        error_counts,
+        np.bincount(positions[known], weights=errors[known] ** 2, minlength=len(averages)))
+    return (standard_errors,) + confidence_interval(
+        counts,
+        np.bincount(positions, weights=log_titers, minlength=len(averages)),
+        np.bincount(positions, weights=log_titers ** 2, minlength=len(averages)),
+        error_counts,
+        np.bincount(positions[known], weights=log_errors[known] ** 2, minlength=len(averages)), level)
+
+
+def log_titers_and_errors(titers, errors) -> tuple:
+    # log10 titers and their standard errors, SE / (titer ln 10) by the delta method
+    titers = np.asarray(titers, dtype=np.float64)
+    return np.log10(titers), np.asarray(errors, dtype=np.float64) / (titers * LN10)
+
+
+def confidence_interval(counts, log_sums, log_squares, error_counts, log_error_squares,
+                        level: float = confidence_level) -> tuple:
+    """
+    (lower bounds, upper bounds) of confidence intervals of average titers, built on the log10 titers: their mean
+    plus or minus t times its standard error (average_standard_errors() of the log10 titers and their errors), taken
+    back to titers. The bounds are positive and lie around the geometric mean. The arguments are the count, sum and
+    sum of squares of the log10 titers and the count and sum of squares of their known errors.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    standard_errors = average_standard_errors(counts, log_sums, log_squares, error_counts, log_error_squares)
+    # a single titer with an error has no spread to estimate, its error is taken as known
+    quantiles = np.where(counts > 1, t.ppf(0.5 + level / 2, np.fmax(counts - 1, 1)), norm.ppf(0.5 + level / 2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.asarray(log_sums, dtype=np.float64) / counts
+    return np.power(10., means - quantiles * standard_errors), np.power(10., means + quantiles * standard_errors)
+
+
+def compute_titers(readings, layout, log_dilutions, negative_controls, accuracy: float,
+                   budget: FitBudget | None = None) -> tuple:
+    """
+    Calculate endpoint titers for a set of samples.
+
+    readings: (samples, points) array of OD values, NaN for missing wells
+    layout: (samples,) array of integer group ids
+    log_dilutions: (points,) array shared by all samples or (samples, points) array
+    negative_controls: point indices of the negative controls, either one sequence for all groups or a dict mapping
+        group id to its indices
+    accuracy: one of cutoff_multiplier_accuracies
+
+    Returns (samples, groups) structured arrays with SAMPLE_DTYPE and GROUP_DTYPE.
+    """
+    readings = orient(readings)
+    layout = np.asarray(layout, dtype=np.int64)
+    sample_count, point_count = readings.shape
+    xdata = np.broadcast_to(np.asarray(log_dilutions, dtype=np.float64), readings.shape)
+
+    samples = np.zeros(sample_count, dtype=SAMPLE_DTYPE)
+    samples['group'] = layout
+    samples['qc_reason'] = [reason or '' for reason in screen(readings, np.ones(readings.shape, dtype=bool))]
+    samples['a'] = samples['b'] = samples['c'] = samples['r2'] = samples['titer'] = samples['titer_se'] = np.nan
+    pcov = np.full((sample_count, 3, 3), np.nan)
+
+    if budget is None:
+        budget = FitBudget()
+    budget.start_run()
+    for index in np.flatnonzero(samples['qc_reason'] == ''):
+        popt, sample_pcov, status, _ = fit_with_budget(xdata[index], readings[index], budget)
+        samples['fit_status'][index] = status
+        if popt is not None:
+            samples['a'][index], samples['b'][index], samples['c'][index] = popt
+            pcov[index] = sample_pcov
+
+    # rows with missing wells only are flagged by QC already
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lo = np.nanmin(readings, axis=1)
+        hi = np.nanmax(readings, axis=1)
+    interpolated = samples['fit_status'] == INTERPOLATED
+
+    popt = np.stack([samples['a'], samples['b'], samples['c']], axis=1)
+    samples['r2'] = curve_r2(readings, xdata, lo, hi, popt, interpolated)
+
+    group_ids = np.unique(layout)
+    groups = np.zeros(len(group_ids), dtype=GROUP_DTYPE)
+    groups['group'] = group_ids
+    for group_index, group_id in enumerate(group_ids):
+        indices = negative_controls[group_id] if isinstance(negative_controls, dict) else negative_controls
+        groups['cutoff'][group_index] = group_cutoffs(readings[layout == group_id][:, list(indices)].ravel(),
+                                                      accuracy)[0]
+    samples['cutoff'] = groups['cutoff'][np.searchsorted(group_ids, layout)]
+
+    titers, errors, below_cutoff = curve_titers(readings, xdata, samples['cutoff'], lo, hi, popt, pcov, interpolated,
+                                                samples['qc_reason'] == '')
+    samples['qc_reason'][below_cutoff] = BELOW_CUTOFF
+    samples['bad_data'] = samples['qc_reason'] != ''
+    samples['titer'], samples['titer_se'] = titers, errors
+
+    good = ~samples['bad_data']
+    group_positions = np.searchsorted(group_ids, layout)
+    groups['count'] = np.bincount(group_positions[good], minlength=len(group_ids))
+    sums = np.bincount(group_positions[good], weights=samples['titer'][good], minlength=len(group_ids))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        groups['average_titer'] = np.where(groups['count'] > 0, sums / groups['count'], np.nan)
+    groups['titer_se'], groups['ci_low'], groups['ci_high'] = average_confidence(
+        groups['average_titer'], samples['titer'][good], samples['titer_se'][good], group_positions[good])
+    return samples, groups
@@ -0,0 +1,138 @@
+import numpy as np
+
+from qc import to_matrix, screen_samples
+
+
+# a linear/PCHIP disagreement larger than this (in log10 dilution) sends the sample to the full fit
+method_tolerance = 0.05
+
+LINEAR = 'linear'
+PCHIP = 'pchip'
+
+
+def pchip_slopes(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    # Fritsch-Carlson derivatives for every row (the same ones scipy's PchipInterpolator uses)
+    h = np.diff(x, axis=1)
+    m = np.diff(y, axis=1) / h
+    d = np.zeros_like(y)
+
+    w1 = 2 * h[:, 1:] + h[:, :-1]
+    w2 = h[:, 1:] + 2 * h[:, :-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        interior = (w1 + w2) / (w1 / m[:, :-1] + w2 / m[:, 1:])
+    same_sign = m[:, :-1] * m[:, 1:] > 0
+    d[:, 1:-1] = np.where(same_sign, interior, 0.)
+
+    def end_slope(h0, h1, m0, m1):
+        slope = ((2 * h0 + h1) * m0 - h0 * m1) / (h0 + h1)
+        slope = np.where(np.sign(slope) != np.sign(m0), 0., slope)
+        return np.where((np.sign(m0) != np.sign(m1)) & (np.abs(slope) > 3 * np.abs(m0)), 3 * m0, slope)
+
+    d[:, 0] = end_slope(h[:, 0], h[:, 1], m[:, 0], m[:, 1])
+    d[:, -1] = end_slope(h[:, -1], h[:, -2], m[:, -1], m[:, -2])
+    return d
+
+
+def interpolate_crossings(xdata: np.ndarray, ydata: np.ndarray, cutoffs: np.ndarray, method: str = LINEAR) -> tuple:
+    """
+    Find where every descending curve crosses its cutoff, interpolating the raw data in log-dilution space.
+    `xdata` and `ydata` are (samples, points) arrays, `cutoffs` has one value per sample.
+    Returns the log10 titers and a mask of borderline samples that should get a full fit instead: crossings in the
+    first or the last dilution interval (or outside of the range), where the plateaus make a straight line a poor
+    estimate, and curves crossing the cutoff more than once. The crossing is clamped to the dilution range.
+    """
+    cutoffs = np.broadcast_to(np.asarray(cutoffs, dtype=np.float64), (len(ydata),))
+    rows = np.arange(len(ydata))
+
+    below = ydata < cutoffs[:, None]
+    has_crossing = below.any(axis=1)
+    right = np.argmax(below, axis=1)
+    left = np.maximum(right - 1, 0)
+
+    x0, x1 = xdata[rows, left], xdata[rows, right]
+    y0, y1 = ydata[rows, left], ydata[rows, right]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(y1 != y0, (cutoffs - y0) / (y1 - y0), 0.)
+    log_titers = x0 + t * (x1 - x0)
+
+    if method == PCHIP:
+        # solve the Hermite cubic on the crossing interval by vectorized bisection, it is monotone there
+        d = pchip_slopes(xdata, ydata)
+        h = x1 - x0
+        d0, d1 = d[rows, left] * h, d[rows, right] * h
+        low, high = np.zeros(len(ydata)), np.ones(len(ydata))
+        for _ in range(30):
+            s = (low + high) / 2
+            value = ((2 * s ** 3 - 3 * s ** 2 + 1) * y0 + (s ** 3 - 2 * s ** 2 + s) * d0
+                     + (-2 * s ** 3 + 3 * s ** 2) * y1 + (s ** 3 - s ** 2) * d1)
+            above = value >= cutoffs
+            low = np.where(above, s, low)
+            high = np.where(above, high, s)
+        pchip_titers = x0 + (low + high) / 2 * h
+        disagreement = np.abs(pchip_titers - log_titers) > method_tolerance
+        log_titers = pchip_titers
+    else:
+        disagreement = np.zeros(len(ydata), dtype=bool)
+
+    # clamp to the dilution range: no crossing at all means the curve stays above the cutoff
+    x_min, x_max = np.nanmin(xdata, axis=1), np.nanmax(xdata, axis=1)
+    log_titers = np.where(right == 0, x_min, log_titers)
+    log_titers = np.where(has_crossing, log_titers, x_max)
+
+    # curves crossing the cutoff more than once are not monotone around it
+    crossing_count = np.sum(np.diff(below.astype(np.int8), axis=1) != 0, axis=1)
+    last = np.sum(~np.isnan(ydata), axis=1) - 1
+    borderline = ~has_crossing | (right <= 1) | (right >= last) | (crossing_count > 1) | disagreement
+    return np.clip(log_titers, x_min, x_max), borderline
+
+
+def triage_groups(groups: list, accuracy: float, budget=None, method: str = LINEAR) -> tuple:
+    """
+    Estimate endpoint titers of all groups without fitting: cutoffs from the negative controls, then one vectorized
+    interpolation pass over every sample of every group (every replicate set of groups collapsing their replicates).
+    Only borderline samples get the full sigmoid fit. Returns the hit rate of the estimates: (estimated, fitted)
+    counts of the samples that passed QC.
+    """
+    samples = list()
+    cutoffs = list()
+    for group in groups:
+        group.accuracy = accuracy
+        group.cutoff = group.get_cutoff(accuracy)
+        if group.cutoff is None:
+            # no negative controls, no titers
+            for sample in group.samples + group.get_fit_samples():
+                sample.endpoint_titer = None
+            continue
+        fit_samples = group.get_fit_samples()
+        samples += fit_samples
+        cutoffs += [group.cutoff] * len(fit_samples)
+
+    cutoffs = np.array(cutoffs)
+    screen_samples(samples, cutoffs)
+    candidates = [index for index, sample in enumerate(samples) if sample.qc_reason is None]
+    if len(candidates) > 0:
+        xdata, _ = to_matrix([samples[index].xdata for index in candidates])
+        ydata, _ = to_matrix([samples[index].ydata for index in candidates])
+        log_titers, borderline = interpolate_crossings(xdata, ydata, cutoffs[candidates], method)
+    else:
+        log_titers, borderline = [], []
+
+    for index, log_titer, is_borderline in zip(candidates, log_titers, borderline):
+        sample = samples[index]
+        sample.triage_borderline = bool(is_borderline)
+        if is_borderline:
+            sample.calculate_endpoint_titer(cutoffs[index], budget=budget)
+        else:
+            # the estimate is not read from a curve, it has no error
+            sample.endpoint_titer, sample.titer_se, sample.bad_data = 10 ** log_titer, None, False
+    for index, sample in enumerate(samples):
+        if sample.qc_reason is not None:
+            sample.endpoint_titer, sample.titer_se, sample.bad_data = None, None, True
+
+    for group in groups:
+        group.share_replicate_results()
+        group.calculate_average_titer()
+
+    fitted = int(np.sum(borderline))
+    print(f'Triage: {len(candidates) - fitted} of {len(candidates)} titers estimated, {fitted} fitted')
+    return len(candidates) - fitted, fitted
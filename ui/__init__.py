@@ -1,12 +1,14 @@
 import random
 
 from PySide6.QtCore import Qt
-from PySide6.QtWidgets import QWidget, QVBoxLayout, QTabWidget, QInputDialog, QLineEdit
+from PySide6.QtWidgets import QWidget, QVBoxLayout, QTabWidget, QInputDialog, QLineEdit, QMessageBox
 
 from logic import Logic
 from logic.plate import Plate as PlateData
 from ui.plate import Plate
 from ui.top_panel import TopPanel
+from ui.sweep_results import SweepResults
+from ui.overview import Overview
 from immuno_calculator import AnalyticalGroup as GroupData
 
 class Ui(QWidget):
@@ -23,48 +25,89 @@ class Ui(QWidget):
         self.top_panel = TopPanel(self, logic)
         self.layout.addWidget(self.top_panel)
 
-        # add plate tabs
+        self.group_stylesheets = dict()
+
+        # add plate tabs, the first one shows all plates at once
         self.plate_tabs = QTabWidget(self)
         self.plates = list()
+        self.overview = Overview(self.plate_tabs, self)
+        self.plate_tabs.addTab(self.overview, 'Overview')
+        self.plate_tabs.currentChanged.connect(self.refresh_overview)
         self.layout.addWidget(self.plate_tabs)
 
         self.setLayout(self.layout)
 
         # add a fake plate for a start
         self.add_plate(None)
+        self.plate_tabs.setCurrentWidget(self.plates[0])
         self.next_group_index = 1
 
-        self.group_stylesheets = dict()
+        # plate files can be dropped onto the window
+        self.setAcceptDrops(True)
+
+    def clear_plates(self):
+        for plate in self.plates:
+            self.plate_tabs.removeTab(self.plate_tabs.indexOf(plate))
+        self.plates.clear()
+        self.group_stylesheets.clear()
+        self.logic.clear_sample_widgets()
+        self.add_plate(None)
 
     def add_plate(self, plate_data: PlateData):
         # remove fake plate if any
         if len(self.plates) == 1 and self.plates[0].data is None:
-            self.plate_tabs.removeTab(0)
+            self.plate_tabs.removeTab(self.plate_tabs.indexOf(self.plates[0]))
             self.plates.clear()
 
         plate = Plate(self, self.logic, plate_data)
         self.plates.append(plate)
         self.plate_tabs.addTab(plate, plate.name)
+        self.logic.register_sample_widgets(plate.samples)
+        self.refresh_overview()
+
+    def refresh_overview(self):
+        # the overview is drawn only while it is shown, unchanged plates keep their cached tiles
+        if self.plate_tabs.currentWidget() is self.overview:
+            self.overview.refresh()
+
+    def take_selected_widgets(self) -> list:
+        # deselect the currently selected samples and return their widgets
+        widgets = [self.logic.sample_widgets[sample] for sample in self.logic.take_selection()]
+        for widget in widgets:
+            widget.selected = False
+            widget.update_selected_style()
+        return widgets
+
+    def dropped_plate_files(self, event) -> list:
+        return [url.toLocalFile() for url in event.mimeData().urls()
+                if url.isLocalFile() and url.toLocalFile().lower().endswith('.xlsx')]
+
+    def dragEnterEvent(self, event):
+        if len(self.dropped_plate_files(event)) > 0:
+            event.acceptProposedAction()
+
+    def dropEvent(self, event):
+        file_paths = self.dropped_plate_files(event)
+        if len(file_paths) > 0:
+            event.acceptProposedAction()
+            self.logic.load_plate_files(file_paths)
+
+    def show_load_progress(self, finished: int, total: int):
+        progress = self.top_panel.left.load_progress
+        progress.setMaximum(total)
+        progress.setValue(finished)
+        progress.setVisible(finished < total)
+
+    def show_load_errors(self, errors: list):
+        message = '\n'.join(f'{file_path}: {error}' for file_path, error in errors)
+        QMessageBox.warning(self, 'Some files could not be loaded', message)
 
     def group_samples(self):
         dialog = QInputDialog(self)
         group_name, is_set = dialog.getText(self, 'Create sample group', 'Group name: ',
                                             echo=QLineEdit.EchoMode.Normal, text=f'Group {self.next_group_index}')
         if is_set:
-            selected_samples = list()
-
-            # collect currently selected samples across all plates
-            for plate in self.plates:
-                for sample in plate.samples:
-                    if sample.selected:
-                        # set group for sample
-                        sample.update_group_name(group_name)
-
-                        selected_samples.append(sample.data)
-
-                        # deselect
-                        sample.selected = False
-                        sample.update_selected_style()
+            selected_samples = [widget.data for widget in self.take_selected_widgets()]
 
             # inform logic to group samples
             self.logic.create_group(group_name, selected_samples)
@@ -73,32 +116,62 @@ class Ui(QWidget):
             self.next_group_index += 1
 
     def remove_from_corresponding_groups(self):
-        # go across all selected samples across all plates and remove them from corresponding groups
-        for plate in self.plates:
-            for sample in plate.samples:
-                if sample.selected:
-                    sample.remove_from_group()
-
-                    # deselect
-                    sample.selected = False
-                    sample.update_selected_style()
-
-    def on_group_added(self, group: GroupData):
-        # create a new random stylesheet and populate it across samples
-        self.group_stylesheets[group] = f'background-color:hsv({random.randint(0, 255)}, 20%, 100%);'
-        for plate in self.plates:
-            for sample in plate.samples:
-                if sample.data.group == group:
-                    sample.group_stylesheet = self.group_stylesheets[group]
-                    sample.setStyleSheet(sample.group_stylesheet)
+        # remove all selected samples from corresponding groups
+        for widget in self.take_selected_widgets():
+            widget.remove_from_group()
+
+    def mark_replicates(self):
+        selected_samples = [widget.data for widget in self.take_selected_widgets()]
+        self.logic.declare_replicates(selected_samples)
+
+    def on_group_added(self, group: GroupData, stylesheet: str | None = None):
+        # create a new random stylesheet (unless restoring a saved one) and populate it across samples
+        if stylesheet is None:
+            stylesheet = f'background-color:hsv({random.randint(0, 255)}, 20%, 100%);'
+        self.group_stylesheets[group] = stylesheet
+        for sample in group.samples:
+            widget = self.logic.sample_widgets.get(sample)
+            if widget is not None:
+                widget.group_stylesheet = stylesheet
+                widget.update_selected_style()
+                widget.update_group_name(group.name)
+                widget.update_negative_controls()
+        self.refresh_overview()
 
         # allow building sigmoid
         self.top_panel.right.build_sigmoid.setEnabled(True)
 
-    def update_negative_controls(self):
-        for plate in self.plates:
-            for sample in plate.samples:
-                sample.update_negative_controls()
+    def update_negative_controls(self, group: GroupData | None = None):
+        # restyle the samples of the given group only (every sample if None)
+        samples = self.logic.sample_widgets if group is None else group.samples
+        for sample in samples:
+            widget = self.logic.sample_widgets.get(sample)
+            if widget is not None:
+                widget.update_negative_controls()
 
         # allow endpoint titer
         self.top_panel.right.endpoint_titer.setEnabled(True)
+
+    def on_session_loaded(self, state: dict):
+        if state['next_group_index'] is not None:
+            self.next_group_index = state['next_group_index']
+        self.top_panel.right.set_state(state['cutoff_multiplier_accuracy'], state['joint_fit'],
+                                       state['collapse_replicates'])
+        self.update_negative_controls()
+        self.update_titers()
+        if len(self.logic.groups) == 0:
+            self.top_panel.right.endpoint_titer.setEnabled(False)
+        # results can be saved right away if the session had titers calculated
+        if any(group.average_titer is not None for group in self.logic.groups):
+            self.top_panel.right.save_results.setEnabled(True)
+
+    def show_sweep_results(self, groups: list):
+        self.sweep_results = SweepResults(self, groups)
+        self.sweep_results.show()
+
+    def update_titers(self, plates: list | None = None):
+        # update titer labels of the given plates (all plates if None)
+        for plate in self.plates:
+            if plate.data is not None and (plates is None or plate.data in plates):
+                plate.update_titers()
+        self.refresh_overview()
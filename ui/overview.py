@@ -0,0 +1,96 @@
+import re
+
+from PySide6.QtCore import Qt
+from PySide6.QtGui import QImage, QPixmap
+from PySide6.QtWidgets import QScrollArea, QLabel, QToolTip
+
+from overview import plate_arrays, same_arrays, render_tile, compose
+
+
+group_hue = re.compile(r'hsv\((\d+)')
+
+
+class OverviewImage(QLabel):
+    def __init__(self, parent):
+        super().__init__(parent)
+
+        self.overview = parent
+        self.setAlignment(Qt.AlignTop | Qt.AlignLeft)
+        self.setMouseTracking(True)
+
+    def mousePressEvent(self, event):
+        plate = self.overview.plate_at(event.position().toPoint())
+        if plate is not None:
+            self.overview.ui.plate_tabs.setCurrentWidget(plate)
+
+    def mouseMoveEvent(self, event):
+        position = event.position().toPoint()
+        plate = self.overview.plate_at(position)
+        if plate is None:
+            QToolTip.hideText()
+        else:
+            QToolTip.showText(event.globalPosition().toPoint(), plate.name, self)
+
+
+class Overview(QScrollArea):
+    """
+    All loaded plates as one heatmap image: readings, R², flags and groups of every well, see overview.py. Tiles are
+    cached per plate and rendered again only for plates whose data changed. Click a tile to open its plate.
+    """
+
+    def __init__(self, parent, ui):
+        super().__init__(parent)
+
+        self.ui = ui
+        # plate widget -> (arrays, tile)
+        self.tiles = dict()
+        self.rectangles = list()
+        self.shown_plates = list()
+
+        self.image = OverviewImage(self)
+        self.setWidget(self.image)
+        self.setWidgetResizable(True)
+
+    def group_hues(self) -> dict:
+        hues = dict()
+        for group, stylesheet in self.ui.group_stylesheets.items():
+            match = group_hue.search(stylesheet)
+            if match is not None:
+                hues[group] = float(match.group(1))
+        return hues
+
+    def refresh(self):
+        plates = [plate for plate in self.ui.plates if plate.data is not None]
+        hues = self.group_hues()
+        tiles = dict()
+        for plate in plates:
+            arrays = plate_arrays(plate.data.samples, hues)
+            cached = self.tiles.get(plate)
+            if cached is not None and same_arrays(cached[0], arrays):
+                tiles[plate] = cached
+            else:
+                tiles[plate] = (arrays, render_tile(arrays))
+        # tiles of closed plates are dropped
+        self.tiles = tiles
+        self.shown_plates = plates
+        self.layout_tiles()
+
+    def layout_tiles(self):
+        image, self.rectangles = compose([self.tiles[plate][1] for plate in self.shown_plates],
+                                         self.viewport().width())
+        height, width = image.shape[:2]
+        # QImage does not own the array, copy it before the array goes away
+        qimage = QImage(image.data, width, height, image.strides[0], QImage.Format_RGBA8888).copy()
+        self.image.setPixmap(QPixmap.fromImage(qimage))
+
+    def plate_at(self, position):
+        for plate, (x, y, width, height) in zip(self.shown_plates, self.rectangles):
+            if x <= position.x() < x + width and y <= position.y() < y + height:
+                return plate
+        return None
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        # only the layout changes, the tiles are reused
+        if len(self.shown_plates) > 0:
+            self.layout_tiles()
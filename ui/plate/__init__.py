@@ -1,3 +1,4 @@
+from PySide6.QtCore import QTimer
 from PySide6.QtWidgets import QWidget, QHBoxLayout, QInputDialog, QLineEdit
 
 from logic import Logic
@@ -46,5 +47,23 @@ class Plate(QWidget):
         if self.data is None:
             self.setEnabled(False)
 
+        # live preview refits the plate once the dilution edits calm down; the interval only merges the edits of one
+        # burst (typing, a spin box held down), stale refits are dropped by the refitter anyway
+        self.live_preview_timer = QTimer(self)
+        self.live_preview_timer.setSingleShot(True)
+        self.live_preview_timer.setInterval(20)
+        self.live_preview_timer.timeout.connect(self.live_preview_timeout)
+
     def update_dilutions(self, skip_index: int | None = None):
         self.dilutions.update_values(skip_index)
+
+        if self.logic.live_preview:
+            # restart the debounce interval on every edit
+            self.live_preview_timer.start()
+
+    def live_preview_timeout(self):
+        self.logic.refit_plate(self.data)
+
+    def update_titers(self):
+        for sample in self.samples:
+            sample.update_titer()
@@ -57,7 +57,7 @@ class Dilutions(QWidget):
                 self.data.recalculate_dilutions(base_dilution=value)
             else:
                 # some specific dilution was changed, update only that value
-                self.data.dilutions[index] = value
+                self.data.set_dilution(index, value)
             self.parent().update_dilutions(skip_index=index)
         except:
             # simply ignore invalid input
@@ -5,12 +5,14 @@ from PySide6.QtGui import QAction
 from PySide6.QtWidgets import QWidget, QVBoxLayout, QLabel, QLineEdit, QInputDialog, QMenu
 
 from immuno_calculator import Sample as SampleData
+from diagnostics import lacks_fit
 
 
 class SampleColumn(QWidget):
     def __init__(self, parent, data: SampleData = None, dummy_name: str = ''):
         super().__init__(parent)
 
+        self.logic = parent.logic
         self.data = data
         self.selected = False
         self.selected_value_index = None
@@ -34,6 +36,9 @@ class SampleColumn(QWidget):
         self.name_context_menu__remove_from_group = QAction('Remove from groups')
         self.name_context_menu__remove_from_group.triggered.connect(parent.parent().remove_from_corresponding_groups)
         self.name_context_menu.addAction(self.name_context_menu__remove_from_group)
+        self.name_context_menu__mark_replicates = QAction('Mark as replicates')
+        self.name_context_menu__mark_replicates.triggered.connect(parent.parent().mark_replicates)
+        self.name_context_menu.addAction(self.name_context_menu__mark_replicates)
         self.name = QLabel(self, text=sample_name)
         self.layout.addWidget(self.name)
 
@@ -57,6 +62,10 @@ class SampleColumn(QWidget):
                 self.values.append(value)
                 self.layout.addWidget(self.values[-1])
 
+        # add endpoint titer
+        self.titer = QLabel(self, text='')
+        self.layout.addWidget(self.titer)
+
         self.setLayout(self.layout)
 
         self.group_stylesheet = ''
@@ -65,8 +74,9 @@ class SampleColumn(QWidget):
         widget = self.childAt(event.pos())
 
         # shift + left click on sample name to select/deselect sample
-        if widget == self.name and event.modifiers() & Qt.KeyboardModifier.ShiftModifier:
+        if widget == self.name and event.modifiers() & Qt.KeyboardModifier.ShiftModifier and self.data is not None:
             self.selected = not self.selected
+            self.logic.set_selected(self.data, self.selected)
             self.update_selected_style()
 
     def mouseDoubleClickEvent(self, event):
@@ -82,24 +92,23 @@ class SampleColumn(QWidget):
         new_name, changed = dialog.getText(self, 'Set sample name', 'New name: ',
                                            echo=QLineEdit.EchoMode.Normal, text=old_name)
         if changed:
-            self.data.name = new_name
+            self.logic.rename_sample(self.data, new_name)
             self.name.setText(new_name)
 
     def remove_from_group(self):
         # inform the sample group that this sample no longer belongs to it
-        self.data.group.remove_sample(self.data)
+        if self.data.group is not None:
+            self.data.group.remove_sample(self.data)
         # update stylesheet
         self.group_stylesheet = ''
         self.update_selected_style()
         # update group title
         self.group_name.setText('')
+        self.update_negative_controls()
 
     def mark_negative_control(self):
         if self.data.group is not None:
-            negative_control_index = self.selected_value_index
-            if negative_control_index not in self.data.group.negative_control_indices:
-                self.data.group.negative_control_indices.append(negative_control_index)
-            self.parent().parent().parent().parent().update_negative_controls()
+            self.logic.mark_negative_control(self.data.group, self.selected_value_index)
 
     def contextMenuEvent(self, event):
         widget = self.childAt(event.pos())
@@ -109,6 +118,7 @@ class SampleColumn(QWidget):
 
             # disable `Remove from groups` menu entry if sample does not belong to any group
             self.name_context_menu__remove_from_group.setEnabled(self.data.group is not None and self.selected)
+            self.name_context_menu__mark_replicates.setEnabled(self.data.group is not None and self.selected)
 
             self.name_context_menu.popup(event.globalPos())
         else:
@@ -138,3 +148,31 @@ class SampleColumn(QWidget):
         else:
             for value in self.values:
                 value.setStyleSheet('')
+
+    def update_titer(self):
+        if self.data is not None and self.data.stale:
+            self.titer.setText('stale')
+            self.titer.setToolTip(self.data.fit_note)
+            self.update_diagnostics()
+            return
+        self.titer.setToolTip('')
+        if self.data is None or self.data.endpoint_titer is None:
+            self.titer.setText('')
+        elif self.data.titer_se is None:
+            self.titer.setText(f'{self.data.endpoint_titer:.0f}')
+        else:
+            self.titer.setText(f'{self.data.endpoint_titer:.0f} ± {self.data.titer_se:.0f}')
+        self.update_diagnostics()
+
+    def update_diagnostics(self):
+        # fit diagnostics are shown as a tooltip of the sample name
+        diagnostics = None if self.data is None else self.data.diagnostics
+        if diagnostics is None:
+            self.name.setToolTip('')
+            return
+        lines = [f'R² {diagnostics["r2"]:.4f}', f'adjusted R² {diagnostics["adjusted_r2"]:.4f}',
+                 f'RMSE {diagnostics["rmse"]:.4f}', f'Durbin-Watson {diagnostics["durbin_watson"]:.2f}',
+                 f'rises {diagnostics["rises"]:.0%} of the span']
+        if lacks_fit(diagnostics):
+            lines.append('residuals run in long stretches: the curve may not follow the data')
+        self.name.setToolTip('\n'.join(lines))
@@ -0,0 +1,40 @@
+import numpy as np
+from PySide6.QtWidgets import QDialog, QVBoxLayout, QTableWidget, QTableWidgetItem
+
+
+class SweepResults(QDialog):
+    """
+    Sample x accuracy matrix of endpoint titers, followed by the cutoff and average titer rows of every group.
+    Empty cells are samples with bad data for that accuracy.
+    """
+
+    def __init__(self, parent, groups: list):
+        super().__init__(parent)
+
+        self.setWindowTitle('Endpoint titers by calculation accuracy')
+
+        self.layout = QVBoxLayout()
+
+        accuracies = groups[0].sweep['accuracies']
+        # (label, values, per-value bad data flags, value format)
+        rows = list()
+        for group in groups:
+            no_flags = [False] * len(accuracies)
+            rows.append((f'{group.name}: cutoff', group.sweep['cutoffs'], no_flags, '.3f'))
+            for sample_index, name in enumerate(group.sweep['names']):
+                rows.append((f'{group.name}: {name}', group.sweep['titers'][sample_index],
+                             group.sweep['bad_data'][sample_index], '.0f'))
+            rows.append((f'{group.name}: average titer', group.sweep['average_titers'], no_flags, '.0f'))
+
+        self.table = QTableWidget(len(rows), len(accuracies), self)
+        self.table.setHorizontalHeaderLabels([f'{accuracy}' for accuracy in accuracies])
+        self.table.setVerticalHeaderLabels([row[0] for row in rows])
+        for row_index, (_, values, bad_data, value_format) in enumerate(rows):
+            for column_index, value in enumerate(values):
+                text = '' if bad_data[column_index] or np.isnan(value) else f'{value:{value_format}}'
+                self.table.setItem(row_index, column_index, QTableWidgetItem(text))
+        self.table.resizeColumnsToContents()
+        self.layout.addWidget(self.table)
+
+        self.setLayout(self.layout)
+        self.resize(600, 400)
@@ -1,5 +1,6 @@
 from PySide6.QtCore import Qt, Slot
-from PySide6.QtWidgets import QWidget, QHBoxLayout, QPushButton, QFileDialog, QLabel, QComboBox
+from PySide6.QtWidgets import QWidget, QHBoxLayout, QPushButton, QFileDialog, QLabel, QComboBox, QCheckBox, \
+    QProgressBar, QDoubleSpinBox
 
 from immuno_calculator import cutoff_multiplier_accuracies
 from logic import Logic
@@ -29,10 +30,24 @@ class TopPanel(QWidget):
 
     @Slot()
     def load_plate_released(self):
-        file_path, _ = QFileDialog.getOpenFileName(self, caption='Load plate data from file',
-                                                   filter='Excel sheets (*.xlsx)')
+        file_paths, _ = QFileDialog.getOpenFileNames(self, caption='Load plate data from files',
+                                                     filter='Excel sheets (*.xlsx)')
+        if len(file_paths) > 0:
+            self.logic.load_plate_files(file_paths)
+
+    @Slot()
+    def save_session_released(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, caption='Save session',
+                                                   filter='Endpoint titer sessions (*.etsession)')
+        if file_path != '':
+            self.logic.save_session(file_path)
+
+    @Slot()
+    def load_session_released(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, caption='Load session',
+                                                   filter='Endpoint titer sessions (*.etsession)')
         if file_path != '':
-            self.logic.load_plates(file_path)
+            self.logic.load_session(file_path)
 
 
 class LeftHalf(QWidget):
@@ -49,6 +64,24 @@ class LeftHalf(QWidget):
         self.load_plate.released.connect(parent.load_plate_released)
         self.layout.addWidget(self.load_plate)
 
+        # add 'Save session' and 'Load session' buttons
+        self.save_session = QPushButton(self, text='Save session')
+        self.save_session.setFixedWidth(100)
+        self.save_session.released.connect(parent.save_session_released)
+        self.layout.addWidget(self.save_session)
+
+        self.load_session = QPushButton(self, text='Load session')
+        self.load_session.setFixedWidth(100)
+        self.load_session.released.connect(parent.load_session_released)
+        self.layout.addWidget(self.load_session)
+
+        # add progress of loading plate files, only shown while loading
+        self.load_progress = QProgressBar(self)
+        self.load_progress.setFixedWidth(150)
+        self.load_progress.setFormat('%v/%m files')
+        self.load_progress.setVisible(False)
+        self.layout.addWidget(self.load_progress)
+
         self.setLayout(self.layout)
 
 
@@ -71,6 +104,40 @@ class RightHalf(QWidget):
         self.precision.currentIndexChanged.connect(self.precision_changed)
         self.layout.addWidget(self.precision)
 
+        # add a spin box for the time limit of a single fit
+        self.sample_seconds = QDoubleSpinBox(self)
+        self.sample_seconds.setRange(0.1, 60.)
+        self.sample_seconds.setSingleStep(0.5)
+        self.sample_seconds.setSuffix(' s per fit')
+        self.sample_seconds.setValue(parent.logic.fit_budget.sample_seconds)
+        self.sample_seconds.valueChanged.connect(self.sample_seconds_changed)
+        self.layout.addWidget(self.sample_seconds)
+
+        # add a check box for fitting every group with shared slope/asymmetry
+        self.joint_fit = QCheckBox(self, text='Joint fit')
+        self.joint_fit.toggled.connect(self.joint_fit_toggled)
+        self.layout.addWidget(self.joint_fit)
+
+        # add a check box for calculating titers at every accuracy in one pass
+        self.accuracy_sweep = QCheckBox(self, text='Sweep accuracies')
+        self.accuracy_sweep.toggled.connect(self.accuracy_sweep_toggled)
+        self.layout.addWidget(self.accuracy_sweep)
+
+        # add a check box for fitting every set of technical replicates once
+        self.collapse_replicates = QCheckBox(self, text='Collapse replicates')
+        self.collapse_replicates.toggled.connect(self.collapse_replicates_toggled)
+        self.layout.addWidget(self.collapse_replicates)
+
+        # add a check box for the fast interpolation-based titer estimate
+        self.triage = QCheckBox(self, text='Triage')
+        self.triage.toggled.connect(self.triage_toggled)
+        self.layout.addWidget(self.triage)
+
+        # add a check box for refitting plates while their dilutions are edited
+        self.live_preview = QCheckBox(self, text='Live preview')
+        self.live_preview.toggled.connect(self.live_preview_toggled)
+        self.layout.addWidget(self.live_preview)
+
         # add 'Build sigmoid' button
         self.build_sigmoid = QPushButton(self, text='Build sigmoid')
         self.build_sigmoid.setFixedWidth(100)
@@ -97,3 +164,32 @@ class RightHalf(QWidget):
     @Slot()
     def precision_changed(self, index: int):
         self.parent().logic.set_cutoff_multiplier_accuracy(cutoff_multiplier_accuracies[index])
+
+    @Slot()
+    def sample_seconds_changed(self, seconds: float):
+        self.parent().logic.set_sample_seconds(seconds)
+
+    @Slot()
+    def joint_fit_toggled(self, checked: bool):
+        self.parent().logic.set_joint_fit(checked)
+
+    @Slot()
+    def accuracy_sweep_toggled(self, checked: bool):
+        self.parent().logic.set_accuracy_sweep(checked)
+
+    @Slot()
+    def collapse_replicates_toggled(self, checked: bool):
+        self.parent().logic.set_collapse_replicates(checked)
+
+    @Slot()
+    def triage_toggled(self, checked: bool):
+        self.parent().logic.triage = checked
+
+    @Slot()
+    def live_preview_toggled(self, checked: bool):
+        self.parent().logic.live_preview = checked
+
+    def set_state(self, accuracy: float, joint_fit: bool, collapse_replicates: bool):
+        self.precision.setCurrentIndex(cutoff_multiplier_accuracies.index(accuracy))
+        self.joint_fit.setChecked(joint_fit)
+        self.collapse_replicates.setChecked(collapse_replicates)
@@ -0,0 +1,318 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import socket
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from fit_budget import FitBudget, fit_with_budget, SAMPLE_SECONDS
+from qc import to_matrix, screen
+
+
+# Filesystem-backed work queue for batch runs. The queue is a directory shared by all hosts:
+#
+#     groups.json   group metadata (negative controls, accuracy), written by `enqueue`
+#     pending/      jobs waiting for a worker
+#     claimed/      jobs taken by a worker, the file mtime is the lease heartbeat
+#     done/         finished jobs
+#     failed/       jobs that failed `max_attempts` times
+#     results/      partial results, one file per job
+#
+# Jobs are claimed by renaming them from pending/ to claimed/, which is atomic on a single filesystem, so any number of
+# workers on any number of hosts can consume the same queue. A claim whose lease has not been renewed in time is put
+# back to pending/ by whichever worker notices it first. `merge` assembles group cutoffs, titers and averages from the
+# partial results.
+
+LEASE_SECONDS = 60.
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 0.5
+
+
+def _write_json(path: Path, data):
+    # write a sibling file and swap it in, readers never see a half-written file
+    temp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    with open(temp_path, 'w', encoding='UTF8') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def _read_json(path: Path):
+    with open(path, encoding='UTF8') as f:
+        return json.load(f)
+
+
+def create_queue(queue_dir: str) -> Path:
+    queue = Path(queue_dir)
+    for name in ('pending', 'claimed', 'done', 'failed', 'results'):
+        (queue / name).mkdir(parents=True, exist_ok=True)
+    return queue
+
+
+def enqueue_groups(queue_dir: str, groups: list, accuracy: float, chunk_size: int | None = None):
+    """
+    Put samples of the groups to the queue. `groups` is a list of dicts with 'name', 'negative_control_indices' and
+    'samples' (list of dicts with 'name', 'xdata' and 'ydata'). Every group becomes one job, or several jobs of at most
+    `chunk_size` samples.
+    """
+    queue = create_queue(queue_dir)
+
+    metadata = _read_json(queue / 'groups.json') if (queue / 'groups.json').exists() else {'groups': dict()}
+    metadata['accuracy'] = accuracy
+    for group in groups:
+        metadata['groups'][group['name']] = {
+            'negative_control_indices': group['negative_control_indices'],
+            'sample_count': len(group['samples']),
+        }
+    _write_json(queue / 'groups.json', metadata)
+
+    job_count = 0
+    for group in groups:
+        samples = [dict(sample, group=group['name'], position=position)
+                   for position, sample in enumerate(group['samples'])]
+        size = chunk_size or max(len(samples), 1)
+        for start in range(0, len(samples), size):
+            job_id = f'{time.time_ns()}-{os.getpid()}-{job_count:06d}'
+            _write_json(queue / 'pending' / f'{job_id}.json',
+                        {'job_id': job_id, 'attempts': 0, 'samples': samples[start:start + size]})
+            job_count += 1
+    return job_count
+
+
+def requeue_expired(queue: Path, lease_seconds: float = LEASE_SECONDS, max_attempts: int = MAX_ATTEMPTS):
+    now = time.time()
+    for claimed_path in (queue / 'claimed').glob('*.json'):
+        try:
+            if now - claimed_path.stat().st_mtime < lease_seconds:
+                continue
+            # take the expired claim over first, so only one worker requeues it
+            reaping_path = claimed_path.with_name(f'{claimed_path.name}.reap-{os.getpid()}')
+            os.rename(claimed_path, reaping_path)
+        except FileNotFoundError:
+            continue
+        job = _read_json(reaping_path)
+        job['attempts'] += 1
+        target = 'pending' if job['attempts'] < max_attempts else 'failed'
+        print(f'Lease of job {job["job_id"]} expired, moving it to {target}')
+        _write_json(queue / target / claimed_path.name, job)
+        reaping_path.unlink()
+
+
+def claim_job(queue: Path) -> Path | None:
+    for pending_path in sorted((queue / 'pending').glob('*.json')):
+        claimed_path = queue / 'claimed' / pending_path.name
+        try:
+            os.rename(pending_path, claimed_path)
+        except FileNotFoundError:
+            # some other worker was faster
+            continue
+        os.utime(claimed_path)
+        return claimed_path
+    return None
+
+
+def process_job(job: dict, budget: FitBudget, heartbeat) -> list:
+    samples = job['samples']
+    ydata = list()
+    for sample in samples:
+        # the same orientation as Sample uses
+        y = sample['ydata']
+        ydata.append(y[::-1] if y[0] < y[-1] else y)
+    reasons = screen(*to_matrix(ydata))
+
+    results = list()
+    for sample, y, reason in zip(samples, ydata, reasons):
+        result = {'group': sample['group'], 'position': sample['position'], 'name': sample['name'],
+                  'xdata': sample['xdata'], 'ydata': list(y), 'qc_reason': reason,
+                  'popt': None, 'pcov': None, 'fit_status': None, 'fit_note': ''}
+        if reason is None:
+            popt, pcov, status, note = fit_with_budget(sample['xdata'], y, budget)
+            result.update({'popt': None if popt is None else popt.tolist(),
+                           'pcov': None if pcov is None else np.where(np.isfinite(pcov), pcov, None).tolist(),
+                           'fit_status': status, 'fit_note': note})
+        results.append(result)
+        heartbeat()
+    return results
+
+
+def work(queue_dir: str, budget: FitBudget | None = None, lease_seconds: float = LEASE_SECONDS,
+         max_attempts: int = MAX_ATTEMPTS, wait: bool = True):
+    """
+    Consume jobs until the queue is drained. With `wait` the worker keeps polling while other workers still hold
+    claims, so their jobs get picked up if their leases expire.
+    """
+    queue = create_queue(queue_dir)
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    processed = 0
+
+    while True:
+        requeue_expired(queue, lease_seconds, max_attempts)
+        claimed_path = claim_job(queue)
+        if claimed_path is None:
+            if not wait or not any((queue / 'claimed').iterdir()):
+                break
+            time.sleep(POLL_SECONDS)
+            continue
+
+        job = _read_json(claimed_path)
+
+        def heartbeat():
+            # renew the lease, a reaper may have taken the job over already
+            try:
+                os.utime(claimed_path)
+            except FileNotFoundError:
+                pass
+
+        try:
+            job_budget = budget or FitBudget()
+            job_budget.start_run()
+            results = process_job(job, job_budget, heartbeat)
+        except Exception as error:
+            print(f'Worker {worker_id} failed job {job["job_id"]}: {error!r}')
+            job['attempts'] += 1
+            target = 'pending' if job['attempts'] < max_attempts else 'failed'
+            _write_json(queue / target / claimed_path.name, job)
+            claimed_path.unlink(missing_ok=True)
+            continue
+
+        _write_json(queue / 'results' / claimed_path.name,
+                    {'job_id': job['job_id'], 'worker': worker_id, 'samples': results})
+        try:
+            os.rename(claimed_path, queue / 'done' / claimed_path.name)
+        except FileNotFoundError:
+            # the lease expired meanwhile and the job was requeued, the result written above is still valid
+            pass
+        processed += 1
+
+    return processed
+
+
+def merge(queue_dir: str, folder_name: str | None = None) -> list:
+    """
+    Assemble AnalyticalGroup objects from the partial results: cutoffs from the negative controls of all samples of
+    the group, then titers and averages from the stored fits, no fitting involved.
+    """
+    from immuno_calculator import Sample, AnalyticalGroup, build_common_plot, write_data_to_csv, diagnose_samples
+    from report import write_report
+    from xlsx_export import write_xlsx
+
+    queue = Path(queue_dir)
+    metadata = _read_json(queue / 'groups.json')
+    accuracy = metadata['accuracy']
+
+    group_samples = {name: dict() for name in metadata['groups']}
+    for result_path in sorted((queue / 'results').glob('*.json')):
+        for result in _read_json(result_path)['samples']:
+            sample = Sample(result['name'], xdata=result['xdata'], ydata=result['ydata'])
+            sample.qc_reason = result['qc_reason']
+            sample.bad_data = sample.qc_reason is not None
+            sample.fit_status, sample.fit_note = result['fit_status'], result['fit_note']
+            if result['popt'] is not None:
+                sample.popt = np.array(result['popt'])
+                sample.pcov = np.array(result['pcov'], dtype=float)
+            group_samples[result['group']][result['position']] = sample
+
+    groups = list()
+    for name, group_metadata in metadata['groups'].items():
+        samples = [group_samples[name][position] for position in sorted(group_samples[name])]
+        if len(samples) < group_metadata['sample_count']:
+            print(f'Group {name}: {group_metadata["sample_count"] - len(samples)} samples have no results yet')
+        if len(samples) == 0:
+            continue
+        diagnose_samples(samples)
+        group = AnalyticalGroup(name, samples)
+        group.negative_control_indices = group_metadata['negative_control_indices']
+        for sample in samples:
+            sample.group = group
+        group.sweep_accuracies([accuracy])
+        group.apply_sweep(accuracy)
+        groups.append(group)
+
+    failed = list((queue / 'failed').glob('*.json'))
+    if len(failed) > 0:
+        print(f'{len(failed)} jobs failed, their samples are missing from the results')
+
+    if folder_name is not None:
+        build_common_plot(groups, folder_name=folder_name)
+        write_data_to_csv(groups, folder_name, accuracy)
+        write_report(groups, f'{folder_name}/report.pdf', accuracy)
+        write_xlsx(groups, f'{folder_name}/results.xlsx', accuracy)
+    return groups
+
+
+def run_local(queue_dir: str, worker_count: int, lease_seconds: float = LEASE_SECONDS):
+    # start several worker processes against the queue and wait for them, handy for trying the queue on one machine
+    processes = [multiprocessing.Process(target=work, args=(queue_dir,), kwargs={'lease_seconds': lease_seconds})
+                 for _ in range(worker_count)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def groups_from_workbooks(file_paths: list, base_dilution: float, coefficient: float,
+                          negative_control_indices: list) -> list:
+    # every plate of every workbook becomes a group
+    from plate_reader import load_plate_blocks
+
+    groups = list()
+    for file_path in file_paths:
+        for name, rows, sample_names in load_plate_blocks(file_path):
+            xdata = [math.log10(base_dilution * coefficient ** i) for i in range(len(rows))]
+            samples = [{'name': str(sample_name), 'xdata': xdata,
+                        'ydata': [row[index] if index < len(row) else math.nan for row in rows]}
+                       for index, sample_name in enumerate(sample_names)]
+            groups.append({'name': f'{file_path}:{name}', 'negative_control_indices': negative_control_indices,
+                           'samples': samples})
+    return groups
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shard batch runs across worker processes through a shared folder')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    enqueue_parser = subparsers.add_parser('enqueue', help='put plates from workbooks to the queue')
+    enqueue_parser.add_argument('queue_dir')
+    enqueue_parser.add_argument('workbooks', nargs='+')
+    enqueue_parser.add_argument('--base-dilution', type=float, default=100.)
+    enqueue_parser.add_argument('--coefficient', type=float, default=3.)
+    enqueue_parser.add_argument('--negative-controls', type=int, nargs='+', default=[7])
+    enqueue_parser.add_argument('--accuracy', type=float, default=99.0)
+    enqueue_parser.add_argument('--chunk-size', type=int, default=None)
+
+    work_parser = subparsers.add_parser('work', help='consume jobs until the queue is drained')
+    work_parser.add_argument('queue_dir')
+    work_parser.add_argument('--lease', type=float, default=LEASE_SECONDS)
+    work_parser.add_argument('--sample-seconds', type=float, default=SAMPLE_SECONDS,
+                             help='time limit of a single fit')
+
+    run_parser = subparsers.add_parser('run', help='run several local worker processes')
+    run_parser.add_argument('queue_dir')
+    run_parser.add_argument('--workers', type=int, default=os.cpu_count())
+
+    merge_parser = subparsers.add_parser('merge', help='assemble group results')
+    merge_parser.add_argument('queue_dir')
+    merge_parser.add_argument('output_dir')
+
+    args = parser.parse_args()
+    if args.command == 'enqueue':
+        groups = groups_from_workbooks(args.workbooks, args.base_dilution, args.coefficient, args.negative_controls)
+        print(f'{enqueue_groups(args.queue_dir, groups, args.accuracy, args.chunk_size)} jobs enqueued')
+    elif args.command == 'work':
+        print(f'{work(args.queue_dir, FitBudget(sample_seconds=args.sample_seconds), args.lease)} jobs processed')
+    elif args.command == 'run':
+        run_local(args.queue_dir, args.workers)
+    elif args.command == 'merge':
+        os.makedirs(args.output_dir, exist_ok=True)
+        groups = merge(args.queue_dir, args.output_dir)
+        for group in groups:
+            print(f'{group.name}: cutoff={group.cutoff}, average titer={group.average_titer}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
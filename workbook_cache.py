@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+# bump whenever the parsers change what they return, so stale entries are never served
+FORMAT_VERSION = 3
+
+default_directory = os.environ.get('ENDPOINT_TITER_CACHE_DIR', str(Path.home() / '.cache' / 'endpoint_titer'))
+default_max_bytes = int(os.environ.get('ENDPOINT_TITER_CACHE_SIZE', 256 * 1024 * 1024))
+
+
+class WorkbookCache:
+    """
+    Cache of parsed workbooks. Every entry is a compressed NumPy archive with the plate blocks found in one workbook,
+    keyed by the content hash, size and modification time of the file. Least recently used entries are evicted once
+    the cache grows over `max_bytes`; max_bytes=0 disables the cache.
+
+    A plate block is a (name, reads, sample_names, wavelengths) tuple, every read being a list of lists of floats.
+    The reads of a block are stored as one stacked (reads, rows, columns) array.
+    """
+
+    def __init__(self, directory: str = default_directory, max_bytes: int = default_max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+
+    def get_key(self, file_path, kind: str) -> str:
+        stat = os.stat(file_path)
+        digest = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return f'{kind}-v{FORMAT_VERSION}-{digest.hexdigest()}-{stat.st_size}-{stat.st_mtime_ns}'
+
+    def load(self, key: str) -> list | None:
+        entry_path = self.directory / f'{key}.npz'
+        try:
+            with np.load(entry_path) as archive:
+                meta = json.loads(str(archive['meta']))
+                blocks = list()
+                for index, block in enumerate(meta):
+                    stacked = archive[f'reads_{index}']
+                    # reads were NaN-padded to one block, cut them back to their original shapes
+                    reads = [[row[:length].tolist() for row, length in zip(rows, row_lengths)]
+                             for rows, row_lengths in zip(stacked, block['row_lengths'])]
+                    blocks.append((block['name'], reads, block['sample_names'], block['wavelengths']))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError):
+            # broken entry, drop it and parse the workbook again
+            entry_path.unlink(missing_ok=True)
+            return None
+
+        # mark the entry as recently used
+        os.utime(entry_path)
+        return blocks
+
+    def store(self, key: str, blocks: list):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        meta = list()
+        arrays = dict()
+        for index, (name, reads, sample_names, wavelengths) in enumerate(blocks):
+            row_lengths = [[len(row) for row in rows] for rows in reads]
+            stacked = np.full((len(reads), max([len(rows) for rows in reads] + [0]),
+                               max([length for lengths in row_lengths for length in lengths] + [0])), np.nan)
+            for read_index, rows in enumerate(reads):
+                for row_index, row in enumerate(rows):
+                    stacked[read_index, row_index, :len(row)] = row
+            arrays[f'reads_{index}'] = stacked
+            meta.append({'name': name, 'row_lengths': row_lengths, 'sample_names': sample_names,
+                         'wavelengths': wavelengths})
+
+        entry_path = self.directory / f'{key}.npz'
+        temp_path = self.directory / f'{key}.{os.getpid()}.tmp.npz'
+        np.savez_compressed(temp_path, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(temp_path, entry_path)
+        self.evict()
+
+    def evict(self):
+        entries = list()
+        for entry_path in self.directory.glob('*.npz'):
+            if entry_path.name.endswith('.tmp.npz'):
+                # being written by another process
+                continue
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            entry_path.unlink(missing_ok=True)
+            total -= size
+
+    def parse(self, file_path, kind: str, parser) -> list:
+        # return parser(file_path) from the cache if the same file content has been parsed before
+        if self.max_bytes <= 0:
+            return parser(file_path)
+        key = self.get_key(file_path, kind)
+        blocks = self.load(key)
+        if blocks is None:
+            blocks = parser(file_path)
+            try:
+                self.store(key, blocks)
+            except (OSError, TypeError) as error:
+                # a cache that cannot be written must never break loading
+                print(f'Could not cache {file_path}: {error}')
+        return blocks
+
+
+workbook_cache = WorkbookCache()
@@ -0,0 +1,107 @@
+import math
+import re
+
+import numpy as np
+from openpyxl import Workbook
+
+from diagnostics import lacks_fit
+from summary import results_table, group_summary_rows, sweep_table, triage_flag, SUMMARY_COLUMNS
+from titers import confidence_level
+
+
+# Results workbook for sign-off: a summary sheet with one row per group, then one sheet per group with one row per
+# sample (readings, fitted parameters, fit diagnostics, titer and flags) and its accuracy sweep if there is one. The
+# workbook is written in openpyxl's write-only mode, rows are streamed out as they are produced, so memory does not
+# grow with the number of samples.
+
+SHEET_TITLE_LENGTH = 31
+invalid_title_characters = re.compile(r'[\[\]:*?/\\]')
+
+GROUP_COLUMNS = ['Group', 'Cutoff', 'Accuracy', 'Average titer', 'Standard error',
+                 f'{confidence_level * 100:g}% CI low', f'{confidence_level * 100:g}% CI high']
+# the summary sheet, the same in every workbook whether written by the GUI, the command line or batch
+SUMMARY_SHEET_COLUMNS = GROUP_COLUMNS + SUMMARY_COLUMNS
+PARAMETER_COLUMNS = ['a', 'b', 'c', 'R2', 'Adjusted R2', 'RMSE']
+RESULT_COLUMNS = ['Endpoint titer', 'Titer SE', 'Fit', 'QC', 'Bad data', 'Lack of fit', 'Outlier', 'Triage']
+
+
+def sample_columns(point_count: int) -> list:
+    return ['Sample'] + [f'OD {index + 1}' for index in range(point_count)] + PARAMETER_COLUMNS + RESULT_COLUMNS
+
+
+def cell(value):
+    # empty cells for missing values, plain Python numbers otherwise
+    if value is None:
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return 'yes' if value else ''
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return None if math.isnan(value) else float(value)
+    return str(value)
+
+
+def sheet_title(name: str, used: set) -> str:
+    # sheet titles are limited to 31 characters without []:*?/\ and have to be unique
+    base = invalid_title_characters.sub('_', str(name))[:SHEET_TITLE_LENGTH] or 'Group'
+    title, suffix = base, 2
+    while title.lower() in used:
+        tag = f' ({suffix})'
+        title, suffix = base[:SHEET_TITLE_LENGTH - len(tag)] + tag, suffix + 1
+    used.add(title.lower())
+    return title
+
+
+def write_workbook(file_path: str, summary: list, sheets):
+    """
+    Stream a workbook out: `summary` is the list of summary sheet rows (header first), `sheets` an iterable of
+    (name, rows) with rows an iterable of lists (header first). Sheets are created one at a time as they are consumed.
+    """
+    workbook = Workbook(write_only=True)
+    used = set()
+    summary_sheet = workbook.create_sheet(sheet_title('Summary', used))
+    for row in summary:
+        summary_sheet.append([cell(value) for value in row])
+    for name, rows in sheets:
+        sheet = workbook.create_sheet(sheet_title(name, used))
+        for row in rows:
+            sheet.append([cell(value) for value in row])
+    workbook.save(file_path)
+
+
+def sample_rows(group, point_count: int):
+    yield sample_columns(point_count)
+    for sample in group.samples:
+        readings = list(sample.ydata)[:point_count]
+        popt = [None] * 3 if sample.popt is None else list(sample.popt)
+        diagnostics = [None] * 2 if sample.diagnostics is None else \
+            [sample.diagnostics['adjusted_r2'], sample.diagnostics['rmse']]
+        yield [sample.name] + readings + [None] * (point_count - len(readings)) + popt + [sample.R2] + diagnostics + \
+            [None if sample.bad_data else sample.endpoint_titer, sample.titer_se, sample.fit_status,
+             sample.qc_reason, sample.bad_data, sample.diagnostics is not None and lacks_fit(sample.diagnostics),
+             sample.name in group.outliers, triage_flag(sample)]
+
+
+def sweep_rows(group):
+    columns, rows = sweep_table(group)
+    yield columns
+    yield from rows
+
+
+def group_sheets(groups: list, point_count: int):
+    for group in groups:
+        yield group.name, sample_rows(group, point_count)
+        if group.sweep is not None:
+            yield f'{group.name} sweep', sweep_rows(group)
+
+
+def write_xlsx(groups: list, file_path: str, accuracy: float):
+    summary = group_summary_rows(groups, results_table(groups))
+    rows = [SUMMARY_SHEET_COLUMNS]
+    for group, group_summary in zip(groups, summary):
+        low, high = group.average_titer_ci or (None, None)
+        rows.append([group.name, group.cutoff, accuracy, group.average_titer, group.average_titer_se, low, high] +
+                    group_summary)
+    point_count = max([len(sample.ydata) for group in groups for sample in group.samples], default=0)
+    write_workbook(file_path, rows, group_sheets(groups, point_count))